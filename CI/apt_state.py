@@ -0,0 +1,229 @@
+"""
+Parses the set of installed apt packages (with versions, sizes, and
+whether each was installed manually or automatically) from dpkg's status
+database, apt's extended states, and apt's history logs
+"""
+import re
+
+
+# packages in the base system. Like `apt-mark showmanual`, these count as
+# installed automatically unless apt recorded them as installed manually
+BASE_SYSTEM_PRIORITIES = ('required', 'important')
+# matches each package in a history log line, e.g.:
+#   "libfoo1:amd64 (1.2-3, automatic)" or "bar:amd64 (1.0-1, 1.1-1)"
+HISTORY_PKG_PATTERN = re.compile(r'([^\s,:()]+)(?::[\w-]+)? \(([^)]*)\)')
+
+
+def _char_order(char):
+    # dpkg sorts "~" before everything (even the end of the string),
+    # then letters, then other characters
+    if char == '~':
+        return -1
+    elif char.isdigit():
+        return 0
+    elif char.isalpha():
+        return ord(char)
+    else:
+        return ord(char) + 256
+
+
+def _compare_fragment(a, b):
+    """compares upstream versions or revisions the way dpkg does"""
+    ia = ib = 0
+    while ia < len(a) or ib < len(b):
+        # compare non-digit prefixes character by character
+        while (ia < len(a) and not a[ia].isdigit()) or (ib < len(b) and not b[ib].isdigit()):
+            ac = _char_order(a[ia]) if ia < len(a) else 0
+            bc = _char_order(b[ib]) if ib < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            ia += 1
+            ib += 1
+
+        # then compare digit runs numerically
+        a_digits = b_digits = ''
+        while ia < len(a) and a[ia].isdigit():
+            a_digits += a[ia]
+            ia += 1
+        while ib < len(b) and b[ib].isdigit():
+            b_digits += b[ib]
+            ib += 1
+        a_num = int(a_digits or 0)
+        b_num = int(b_digits or 0)
+        if a_num != b_num:
+            return a_num - b_num
+
+    return 0
+
+
+def compare_versions(a, b):
+    """
+    compares two Debian package version strings
+    ([epoch:]upstream_version[-debian_revision]). Returns a negative
+    number if `a` is older than `b`, 0 if they're equal, or a positive
+    number if `a` is newer
+    """
+    def _split(version):
+        # the epoch ends at the first colon (the upstream version may contain more)
+        epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+        upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+        return int(epoch or 0), upstream, revision
+
+    a_epoch, a_upstream, a_revision = _split(a)
+    b_epoch, b_upstream, b_revision = _split(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+
+    return _compare_fragment(a_upstream, b_upstream) or _compare_fragment(a_revision, b_revision)
+
+
+class AptPackage:
+    __slots__ = ('name', 'version', 'automatic', 'size', 'priority')
+
+    def __init__(self, name, version=None, automatic=False, size=None, priority=None):
+        self.name = name
+        self.version = version
+        self.automatic = automatic
+        # installed size in bytes & priority (only known from dpkg's
+        # status database)
+        self.size = size
+        self.priority = priority
+
+    def __repr__(self):
+        return f'AptPackage({self.name}={self.version}, {self.install_method})'
+
+    @property
+    def install_method(self):
+        return 'automatic' if self.automatic else 'manual'
+
+
+def iter_paragraphs(lines):
+    """
+    yields each paragraph of a deb822-format file (e.g., dpkg status)
+    as a dict, from an iterable of its lines
+    """
+    fields = dict()
+    key = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if fields:
+                yield fields
+            fields = dict()
+            key = None
+        elif line[0] in ' \t':
+            # continuation of multi-line field
+            if key is not None:
+                fields[key] += '\n' + line.strip()
+        else:
+            key, _, value = line.partition(':')
+            fields[key] = value.strip()
+
+    if fields:
+        yield fields
+
+
+class AptState:
+    def __init__(self):
+        self.packages = dict()
+
+    def __contains__(self, name):
+        return name in self.packages
+
+    def __len__(self):
+        return len(self.packages)
+
+    def get(self, name, default=None):
+        return self.packages.get(name, default)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        builds the installed package set from the apt sections of a
+        snapshot. dpkg's status database is authoritative when present;
+        history logs are used otherwise
+        """
+        state = cls()
+        dpkg_status = snapshot.get('dpkg_status')
+        if dpkg_status:
+            state.update_from_dpkg_status(dpkg_status.splitlines())
+            state.update_from_extended_states(
+                (snapshot.get('apt_extended_states') or '').splitlines(),
+                manual=state.manual_from_history(snapshot.get('apt_history', '').splitlines())
+            )
+        else:
+            state.update_from_history(snapshot.get('apt_history', '').splitlines())
+
+        return state
+
+    def update_from_history(self, lines):
+        """
+        replays apt history log entries (oldest first) to get the net
+        set of installed packages
+        """
+        for line in lines:
+            action, _, pkgs = line.partition(': ')
+            if action not in ('Install', 'Reinstall', 'Upgrade', 'Downgrade',
+                              'Remove', 'Purge'):
+                continue
+
+            for name, info in HISTORY_PKG_PATTERN.findall(pkgs):
+                info = [i.strip() for i in info.split(',')]
+                if action in ('Remove', 'Purge'):
+                    self.packages.pop(name, None)
+                elif action == 'Install':
+                    self.packages[name] = AptPackage(name,
+                                                     version=info[0],
+                                                     automatic='automatic' in info[1:])
+                else:
+                    # upgrades/downgrades list "old_version, new_version"
+                    pkg = self.packages.setdefault(name, AptPackage(name))
+                    pkg.version = info[-1]
+
+    @staticmethod
+    def manual_from_history(lines):
+        """names of packages apt history logs record as installed manually"""
+        manual = set()
+        for line in lines:
+            action, _, pkgs = line.partition(': ')
+            if action in ('Install', 'Reinstall'):
+                for name, info in HISTORY_PKG_PATTERN.findall(pkgs):
+                    if 'automatic' not in [i.strip() for i in info.split(',')[1:]]:
+                        manual.add(name)
+
+        return manual
+
+    def update_from_dpkg_status(self, lines):
+        self.packages = dict()
+        for fields in iter_paragraphs(lines):
+            if fields.get('Status', '').endswith(' installed'):
+                name = fields['Package']
+                size = fields.get('Installed-Size')
+                # Installed-Size is in KiB
+                size = int(size) * 1024 if size and size.isdigit() else None
+                self.packages[name] = AptPackage(name,
+                                                 version=fields.get('Version'),
+                                                 size=size,
+                                                 priority=fields.get('Priority'))
+
+    def update_from_extended_states(self, lines, manual=()):
+        """
+        sets whether each package was installed automatically from apt's
+        extended states. Packages not listed there were installed
+        manually, except base system packages that aren't in `manual`
+        (e.g., packages recorded as installed manually in the history)
+        """
+        listed = set()
+        for fields in iter_paragraphs(lines):
+            pkg = self.packages.get(fields.get('Package'))
+            if pkg is not None:
+                pkg.automatic = fields.get('Auto-Installed') == '1'
+                listed.add(pkg.name)
+
+        for name, pkg in self.packages.items():
+            if name not in listed:
+                pkg.automatic = pkg.priority in BASE_SYSTEM_PRIORITIES and name not in manual
+
+    def install_methods(self):
+        """{package name: 'manual' | 'automatic'} for installed packages"""
+        return {name: pkg.install_method for name, pkg in self.packages.items()}
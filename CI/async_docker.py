@@ -0,0 +1,160 @@
+"""
+Runs commands in many containers at once. Blocking Docker SDK calls are
+dispatched to a thread pool from an asyncio event loop, so waiting on
+several containers takes as long as the slowest one rather than the sum.
+Each command gets a real timeout: a container that's still running when
+its timeout expires (or when the task waiting on it is cancelled) is
+killed rather than left behind
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+
+import docker
+
+
+DEFAULT_MAX_WORKERS = 8
+# extra time given to the blocking container.wait() call, so that the
+# asyncio timeout always fires first and threads are never stuck for good
+WAIT_GRACE_PERIOD = 10
+
+
+class ContainerResult:
+    """
+    stand-in for a docker.models.containers.Container whose command has
+    exited and whose output was collected before it was removed (like
+    session_pool.ExecResult)
+    """
+    def __init__(self, container, exit_code, output):
+        self.container = container
+        self.exit_code = exit_code
+        self.output = output or b''
+        self.id = container.id
+        self.name = container.name
+        self.status = 'exited'
+
+    def __repr__(self):
+        return f'ContainerResult(container={self.name}, exit_code={self.exit_code})'
+
+    def logs(self, **kwargs):
+        return self.output
+
+    def wait(self, **kwargs):
+        return {'StatusCode': self.exit_code, 'Error': None}
+
+    # the container was already removed once its output was collected
+    def stop(self, **kwargs):
+        pass
+
+    def remove(self, **kwargs):
+        pass
+
+
+class AsyncRunner:
+    def __init__(self, client, max_workers=None):
+        self.client = client
+        if max_workers is None:
+            max_workers = int(getenv('CONTAINER_CONCURRENCY', DEFAULT_MAX_WORKERS))
+
+        self.max_workers = max(1, max_workers)
+        # at most max_workers threads are ever blocked waiting on
+        # containers, so the rest are free to start, kill & remove them
+        self._executor = ThreadPoolExecutor(max_workers=2 * self.max_workers)
+        self._loop = None
+        self._semaphore = None
+
+    @property
+    def loop(self):
+        # asyncio.run() requires Python 3.7+, and the CI scripts also run
+        # under 3.6, so the runner manages its own event loop
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            self._semaphore = None
+        return self._loop
+
+    def run_sync(self, coro):
+        """runs a coroutine to completion from synchronous code"""
+        return self.loop.run_until_complete(coro)
+
+    async def call(self, func, *args, **kwargs):
+        """runs a blocking function in the runner's thread pool"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    async def _kill(self, container, remove):
+        try:
+            if remove:
+                await self.call(container.remove, force=True)
+            else:
+                await self.call(container.kill)
+        except (docker.errors.APIError, docker.errors.NotFound):
+            # container already exited or was removed
+            pass
+
+    async def wait(self, container, timeout):
+        """
+        waits for `container` to exit, killing it and raising a
+        TimeoutError if it doesn't within `timeout` seconds
+        """
+        try:
+            return await asyncio.wait_for(
+                self.call(container.wait, timeout=timeout + WAIT_GRACE_PERIOD),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            await asyncio.shield(self._kill(container, remove=False))
+            raise TimeoutError(f"container {container.name} did not exit within "
+                               f"{timeout} seconds") from None
+        except asyncio.CancelledError:
+            await asyncio.shield(self._kill(container, remove=False))
+            raise
+
+    async def run(self, image, command, timeout=30, **kwargs):
+        """
+        runs `command` in a new container from `image` and returns a
+        ContainerResult once it exits. The container is removed once its
+        output has been collected, or killed and removed if it times out
+        or the task is cancelled
+        """
+        if self._semaphore is None:
+            # bind the semaphore to the loop this coroutine is running in
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        async with self._semaphore:
+            container = await self.call(self.client.containers.run,
+                                        image,
+                                        command=command,
+                                        detach=True,
+                                        **kwargs)
+            try:
+                status = await self.wait(container, timeout)
+                output = await self.call(container.logs)
+            except TimeoutError as e:
+                raise TimeoutError(f"Command {' '.join(command)} timed out after "
+                                   f"{timeout} seconds") from e
+            finally:
+                await asyncio.shield(self._kill(container, remove=True))
+
+        return ContainerResult(container, status['StatusCode'], output)
+
+    async def gather(self, coros):
+        """
+        runs coroutines concurrently and returns their results in order.
+        If any of them fails, the rest are cancelled (so their containers
+        are cleaned up) before the error is raised
+        """
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def close(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.close()
+        self._executor.shutdown(wait=False)
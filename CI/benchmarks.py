@@ -0,0 +1,307 @@
+"""
+Measures how long each image takes to become useful from a cold start
+(e.g., time to a Python prompt, to a ready notebook server, or to import
+torch). Each benchmark is run several times after discarding warmup
+runs, and percentiles of the results are saved to a JSON file keyed by
+image ID. Results for two images (e.g., a new build and the last one)
+can be compared to catch regressions
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from os import getenv
+from pathlib import Path
+
+import docker
+import requests
+
+from container import Container
+from image_tree import ImageTree
+
+
+DEFAULT_RESULTS_PATH = Path.home().joinpath('.cache', 'cdl-docker-stacks', 'benchmarks.json')
+DEFAULT_RUNS = 5
+DEFAULT_WARMUP = 1
+# a benchmark regresses if its time grows by more than this fraction
+# AND by more than MIN_REGRESSION_SECONDS (so noise in very short
+# benchmarks isn't flagged)
+DEFAULT_TOLERANCE = 0.25
+MIN_REGRESSION_SECONDS = 0.25
+PERCENTILES = (50, 90, 95)
+# lines the notebook server logs once it's ready to accept connections
+NOTEBOOK_SERVER_READY_LOGS = ['Serving notebooks from local directory', '/?token=']
+TOKEN_PATTERN = re.compile(r'\?token=([0-9a-f]+)')
+
+# image name -> [benchmark functions]. Images are also benchmarked with
+# all of their ancestors' benchmarks
+BENCHMARKS = dict()
+
+
+def benchmark(image_name):
+    """
+    registers a function that takes a Container, runs one iteration of a
+    benchmark, and returns the time taken in seconds
+    """
+    def decorator(func):
+        BENCHMARKS.setdefault(image_name, list()).append(func)
+        return func
+    return decorator
+
+
+def _timed_run(container, command, max_wait=120):
+    start = time.perf_counter()
+    c = container.run(command, detach=True, remove=False, tty=False, max_wait=max_wait)
+    elapsed = time.perf_counter() - start
+    try:
+        exit_code = c.wait()['StatusCode']
+        if exit_code != 0:
+            raise RuntimeError(f"{command} exited with status {exit_code}:\n"
+                               f"{c.logs().decode('utf-8')}")
+    finally:
+        c.remove(force=True)
+        container.curr_container_obj = None
+
+    return elapsed
+
+
+@benchmark('cdl-python')
+def python_prompt(container):
+    """docker run to an interactive Python prompt (that exits on EOF)"""
+    return _timed_run(container, 'python -i < /dev/null')
+
+
+@benchmark('cdl-jupyter')
+def notebook_server_ready(container):
+    """docker run to a notebook server accepting connections"""
+    start = time.perf_counter()
+    server = container.run(command=None, shell=None, max_wait=-1)
+    container.curr_container_obj = None
+    try:
+        container.wait_until_ready(server,
+                                   log_patterns=NOTEBOOK_SERVER_READY_LOGS,
+                                   port=container.expected_attrs.get('port', '8888'))
+        return time.perf_counter() - start
+    finally:
+        server.remove(force=True)
+
+
+@benchmark('cdl-jupyter')
+def kernel_ready(container, timeout=60):
+    """starting a kernel on a running notebook server until it's idle"""
+    port = container.expected_attrs.get('port', '8888')
+    server = container.run(command=None, shell=None, max_wait=-1)
+    container.curr_container_obj = None
+    try:
+        container.wait_until_ready(server, log_patterns=NOTEBOOK_SERVER_READY_LOGS, port=port)
+        server.reload()
+        ip_address = server.attrs['NetworkSettings']['IPAddress']
+        token = TOKEN_PATTERN.search(server.logs().decode('utf-8')).group(1)
+        api_url = f'http://{ip_address}:{port}/api/kernels'
+        headers = {'Authorization': f'token {token}'}
+
+        start = time.perf_counter()
+        response = requests.post(api_url, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        kernel_url = f"{api_url}/{response.json()['id']}"
+        while time.perf_counter() - start < timeout:
+            state = requests.get(kernel_url, headers=headers, timeout=timeout).json()
+            if state.get('execution_state') == 'idle':
+                return time.perf_counter() - start
+            time.sleep(0.05)
+
+        raise TimeoutError(f"kernel not ready after {timeout} seconds")
+    finally:
+        server.remove(force=True)
+
+
+@benchmark('cdl-pytorch')
+def import_torch(container):
+    """docker run to `import torch` finishing"""
+    return _timed_run(container, 'python -c "import torch"')
+
+
+def percentile(samples, q):
+    """q-th percentile of `samples`, interpolating between closest ranks"""
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(samples):
+    summary = {
+        'samples': samples,
+        'min': min(samples),
+        'max': max(samples),
+        'mean': sum(samples) / len(samples)
+    }
+    summary.update({f'p{q}': percentile(samples, q) for q in PERCENTILES})
+    return summary
+
+
+def run_benchmarks(container, benchmarks, runs=DEFAULT_RUNS, warmup=DEFAULT_WARMUP):
+    """
+    runs each benchmark `warmup` + `runs` times, and returns a dict of
+    stats for each from the last `runs` runs
+    """
+    results = dict()
+    for func in benchmarks:
+        samples = [func(container) for _ in range(warmup + runs)][warmup:]
+        results[func.__name__] = summarize(samples)
+        print(f"{func.__name__}: p50 {results[func.__name__]['p50']:.2f}s, "
+              f"p90 {results[func.__name__]['p90']:.2f}s ({runs} runs)")
+
+    return results
+
+
+def benchmarks_for(image_tree, image_name):
+    image = image_tree.get_image(image_name)
+    return [func for ancestor in image.ancestors for func in BENCHMARKS.get(ancestor.name, list())]
+
+
+def load_results(path):
+    try:
+        return json.loads(Path(path).read_text())
+    except FileNotFoundError:
+        return dict()
+
+
+def save_results(results, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(json.dumps(results, indent=2))
+    os.replace(tmp_path, path)
+
+
+def previous_record(results, record):
+    """most recent record for the same image tag as `record`, but a different image"""
+    candidates = [(image_id, r) for image_id, r in results.items()
+                  if r['tag'] == record['tag'] and image_id != record['image_id']]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: c[1]['timestamp'])[1]
+
+
+def compare(old, new, tolerance=DEFAULT_TOLERANCE, stat='p50'):
+    """
+    returns a list of (benchmark, old seconds, new seconds) for
+    benchmarks that got slower by more than `tolerance` (a fraction)
+    """
+    regressions = list()
+    for name, new_stats in new['benchmarks'].items():
+        old_stats = old['benchmarks'].get(name)
+        if old_stats is None:
+            continue
+        old_time, new_time = old_stats[stat], new_stats[stat]
+        if (
+                new_time - old_time > MIN_REGRESSION_SECONDS and
+                new_time > old_time * (1 + tolerance)
+        ):
+            regressions.append((name, old_time, new_time))
+
+    return regressions
+
+
+def _resolve_ref(image_tree, ref, org):
+    # image name (e.g., "cdl-python") -> tag for the current Python version
+    if '/' in ref or ':' in ref:
+        return ref
+    return f'{org}/{image_tree.get_node(ref, image_tree.python_version)}'
+
+
+def _find_record(results, client, ref):
+    # `ref` may be an image ID, or a tag of a local image
+    if ref in results:
+        return results[ref]
+    try:
+        return results[client.images.get(ref).id]
+    except (KeyError, docker.errors.ImageNotFound):
+        sys.exit(f"no benchmark results for {ref}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--results', default=getenv('BENCHMARK_RESULTS', DEFAULT_RESULTS_PATH),
+                        help="JSON file of results, keyed by image ID (default: "
+                             f"$BENCHMARK_RESULTS or {DEFAULT_RESULTS_PATH})")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="max allowed fractional slowdown (default: %(default)s)")
+    parser.add_argument('--stat', default='p50', help="statistic to compare (default: p50)")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    subparsers = parser.add_subparsers(dest='mode')
+    run_parser = subparsers.add_parser('run', help="benchmark an image")
+    run_parser.add_argument('image', help="image name (for the current $PYTHON_VERSION) or tag")
+    run_parser.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS)
+    run_parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP,
+                            help="runs to discard before measuring (default: %(default)s)")
+    run_parser.add_argument('--baseline', default=None,
+                            help="image tag or ID to compare against, or 'previous' "
+                                 "for the last image benchmarked with the same tag")
+    compare_parser = subparsers.add_parser('compare', help="compare saved results")
+    compare_parser.add_argument('old', help="image tag or ID")
+    compare_parser.add_argument('new', help="image tag or ID")
+    args = parser.parse_args()
+
+    os.environ.setdefault('GITHUB_WORKSPACE', args.repo_root)
+    image_tree = ImageTree.load(args.repo_root)
+    client = docker.client.from_env()
+    results = load_results(args.results)
+    org = getenv('DOCKER_HUB_ORG', 'contextlab')
+    if args.mode == 'run':
+        ref = _resolve_ref(image_tree, args.image, org)
+        image = client.images.get(ref)
+        image_name = ref.split('/')[-1].split(':')[0]
+        # always start fresh containers, rather than exec-ing in sessions
+        container = Container(image, sessions=0)
+        try:
+            benchmark_results = run_benchmarks(container,
+                                               benchmarks_for(image_tree, image_name),
+                                               runs=args.runs,
+                                               warmup=args.warmup)
+        finally:
+            container.close()
+
+        new = {
+            'image_id': image.id,
+            'tag': ref,
+            'python_version': getenv('PYTHON_VERSION'),
+            'timestamp': time.time(),
+            'runs': args.runs,
+            'warmup': args.warmup,
+            'benchmarks': benchmark_results
+        }
+        results[image.id] = new
+        save_results(results, args.results)
+        if args.baseline == 'previous':
+            old = previous_record(results, new)
+            if old is None:
+                print(f"no previous results for {ref} to compare against")
+        elif args.baseline is not None:
+            old = _find_record(results, client, _resolve_ref(image_tree, args.baseline, org))
+        else:
+            old = None
+    elif args.mode == 'compare':
+        old = _find_record(results, client, args.old)
+        new = _find_record(results, client, args.new)
+    else:
+        parser.error("mode must be 'run' or 'compare'")
+
+    if old is None:
+        sys.exit(0)
+
+    regressions = compare(old, new, tolerance=args.tolerance, stat=args.stat)
+    for name, old_time, new_time in regressions:
+        print(f"REGRESSION: {name} {args.stat} {old_time:.2f}s -> {new_time:.2f}s "
+              f"({new_time / old_time - 1:+.0%})")
+    if not regressions:
+        print(f"no regressions beyond {args.tolerance:.0%} "
+              f"({old['tag']} {old['image_id'][:19]} -> {new['tag']} {new['image_id'][:19]})")
+
+    sys.exit(1 if regressions else 0)
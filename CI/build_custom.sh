@@ -4,23 +4,6 @@
 set -e
 
 image_name=$1
-image_dir="$GITHUB_WORKSPACE/$image_name"
-custom_args_file="$image_dir/ci/custom-args.sh"
-
-# params used for all custom builds
-params="--rm --force-rm
-        -f $image_dir/Dockerfile
-        -t $DOCKER_HUB_ORG/$image_name:${PYTHON_VERSION}-custom
-        --build-arg PYTHON_VERSION"
-
-# get custom arg names from file
-custom_args=($(grep ^export $custom_args_file | cut -d ' ' -f 2 | cut -d '=' -f 1))
-
-for arg in "${custom_args[@]}"; do
-    params="$params --build-arg $arg"
-done
-
-params="$params $image_dir"
-
-source $custom_args_file
-docker build $params
\ No newline at end of file
+# build-arg values are read from $image_name/ci/custom-args.sh. Layers
+# are shared with the default build of the image via BuildKit's cache
+python "$GITHUB_WORKSPACE/CI/build_planner.py" "$image_name" --custom
@@ -4,43 +4,51 @@
 set -e
 
 image_name=$1
-image_dir="$GITHUB_WORKSPACE/$image_name"
 images_logfile="$BUILD_DATA_DIR/images_python$PYTHON_VERSION.txt"
 build_times_logfile="$BUILD_DATA_DIR/build_times_python$PYTHON_VERSION.txt"
 image_sizes_logfile="$BUILD_DATA_DIR/image_sizes_python$PYTHON_VERSION.txt"
 
-# params used for all builds (arbitrary tag for non-final image)
-params="--rm --force-rm --squash -f $image_dir/Dockerfile"
+build_cache_logfile="$BUILD_DATA_DIR/build_cache.jsonl"
 
-# set tag for image & pass python version as build-arg to non-base image builds
+# tag for image (python version is passed as a build-arg to non-base
+# image builds by build_planner.py)
 if [[ "$image_name" == "cdl-base" ]]; then
     image_tag="$DOCKER_HUB_ORG/$image_name:latest"
 else
     image_tag="$DOCKER_HUB_ORG/$image_name:$PYTHON_VERSION"
-    params="$params --build-arg PYTHON_VERSION"
 fi
 
-params="$params -t $image_tag $image_dir"
-
 # some runner output formatting to help readability when building multiple images
 term_width=$(tput cols)
 printf '=%.0s' $(seq $term_width)
 echo
 figlet -kw $term_width "building $image_name"
 
-# build image, record time taken & final size
+# build image with BuildKit (reusing cached layers), record time taken,
+# cache hit ratio & final size
 SECONDS=0
-docker build $params
+python "$GITHUB_WORKSPACE/CI/build_planner.py" "$image_name" --stats "$build_cache_logfile"
 duration=$SECONDS
 echo "finished in $duration seconds"
 
 image_size=$(docker image ls --filter "reference=$image_tag" --format "{{.Size}}")
 echo "resulting image size is $image_size"
 
-# store some build info for later use
-echo "$image_name" >> "$images_logfile"
-echo "$duration" >> "$build_times_logfile"
-echo "$image_size" >> "$image_sizes_logfile"
+# store some build info for later use (lock keeps lines in the three
+# files aligned when multiple images are built in parallel)
+(
+    flock 9
+    echo "$image_name" >> "$images_logfile"
+    echo "$duration" >> "$build_times_logfile"
+    echo "$image_size" >> "$image_sizes_logfile"
+) 9>"$BUILD_DATA_DIR/.build-data.lock"
+
+# record per-layer & per-package metrics for regression reports. This
+# is just monitoring, so failing to record them doesn't fail the build
+python "$GITHUB_WORKSPACE/CI/build_metrics.py" record "$image_tag" \
+    --duration "$duration" \
+    --output "$BUILD_DATA_DIR/build_metrics.jsonl" \
+    || echo "warning: failed to record build metrics for $image_tag"
 
 # more output formatting for readability
 yes '' | head -n 10
\ No newline at end of file
@@ -0,0 +1,294 @@
+"""
+Records structured per-image and per-layer build metrics to a JSON-lines
+file, and compares two sets of metrics to flag images, layers, and
+packages whose build time or size grew
+"""
+import argparse
+import fcntl
+import json
+import re
+import sys
+import time
+from os import getenv
+from pathlib import Path
+
+import docker
+
+from image_tree import ImageTree
+
+
+# run inside the image to get the installed size of each conda & pip
+# package (must be compatible with every Python version images are
+# built for)
+PACKAGE_SIZES_SCRIPT = """
+import json, os, sys
+prefix = sys.prefix
+sizes = {'conda': {}, 'pip': {}}
+meta_dir = os.path.join(prefix, 'conda-meta')
+conda_files = set()
+for fname in os.listdir(meta_dir):
+    if not fname.endswith('.json'):
+        continue
+    with open(os.path.join(meta_dir, fname)) as f:
+        record = json.load(f)
+    paths = record.get('paths_data', {}).get('paths')
+    if paths and all('size_in_bytes' in p for p in paths):
+        size = sum(p['size_in_bytes'] for p in paths)
+    else:
+        size = 0
+        for path in record.get('files', []):
+            try:
+                size += os.lstat(os.path.join(prefix, path)).st_size
+            except OSError:
+                pass
+    conda_files.update(record.get('files', []))
+    sizes['conda'][record['name']] = size
+site_packages = next(p for p in sys.path if p.endswith('site-packages'))
+for dname in os.listdir(site_packages):
+    record_path = os.path.join(site_packages, dname, 'RECORD')
+    rel_path = os.path.relpath(record_path, prefix)
+    if not dname.endswith('.dist-info') or rel_path in conda_files:
+        continue
+    name = dname[:-len('.dist-info')].rsplit('-', 1)[0]
+    size = 0
+    try:
+        with open(record_path) as f:
+            for line in f:
+                fields = line.rstrip().rsplit(',', 2)
+                if len(fields) == 3 and fields[2].isdigit():
+                    size += int(fields[2])
+    except OSError:
+        pass
+    sizes['pip'][name] = size
+print(json.dumps(sizes))
+"""
+# layers created by running this script (see cdl-python/warm_caches.py)
+# hold precompiled bytecode & other caches, and are tagged so their size
+# cost can be tracked separately from package installs
+WARM_CACHES_SCRIPT = 'warm_caches.py'
+
+
+def _instruction(created_by):
+    """extract the Dockerfile instruction type from a layer's CreatedBy"""
+    nop = re.search(r'#\(nop\)\s+([A-Z]+)', created_by)
+    if nop is not None:
+        return nop.group(1)
+    elif created_by.startswith('merge '):
+        # layer created by --squash
+        return 'SQUASH'
+    elif created_by.split(' ', 1)[0].isupper():
+        # BuildKit records the instruction itself (e.g., "COPY ... # buildkit")
+        return created_by.split(' ', 1)[0]
+    else:
+        return 'RUN'
+
+
+def _package_sizes(client, image_ref):
+    try:
+        output = client.containers.run(image_ref,
+                                       command=['python', '-c', PACKAGE_SIZES_SCRIPT],
+                                       entrypoint='',
+                                       detach=False,
+                                       remove=True,
+                                       tty=False)
+    except (docker.errors.ContainerError, docker.errors.APIError):
+        # image doesn't have conda/Python (e.g., cdl-base)
+        return None
+
+    return json.loads(output.decode('utf-8'))
+
+
+def collect_metrics(client, image_tag, duration=None):
+    image = client.images.get(image_tag)
+    # history is ordered newest to oldest
+    history = list(reversed(image.history()))
+    build_start = None if duration is None else time.time() - duration
+
+    layers = list()
+    prev_created = None
+    for ix, entry in enumerate(history):
+        created = entry.get('Created')
+        created_by = entry.get('CreatedBy', '')
+        own_layer = build_start is None or created >= build_start - 1
+        if prev_created is None or not own_layer:
+            step_seconds = None
+        else:
+            step_seconds = created - max(prev_created, build_start or prev_created)
+
+        layers.append({
+            'index': ix,
+            'instruction': _instruction(created_by),
+            'created_by': created_by,
+            'size': entry.get('Size', 0),
+            'created': created,
+            'step_seconds': step_seconds,
+            'from_parent': not own_layer,
+            'warm_cache': _instruction(created_by) == 'RUN' and WARM_CACHES_SCRIPT in created_by
+        })
+        prev_created = created
+
+    packages = _package_sizes(client, image_tag)
+    # attribute package sizes to this image's installs by comparing
+    # against the parent image's packages
+    packages_added = None
+    if packages is not None:
+        parent_ref = _parent_ref(image_tag)
+        parent_packages = None if parent_ref is None else _package_sizes(client, parent_ref)
+        if parent_packages is not None:
+            packages_added = {
+                source: {
+                    name: size - parent_packages[source].get(name, 0)
+                    for name, size in pkgs.items()
+                    if size != parent_packages[source].get(name)
+                } for source, pkgs in packages.items()
+            }
+
+    return {
+        'run_id': getenv('GITHUB_RUN_ID'),
+        'timestamp': time.time(),
+        'image': image_tag.split('/')[-1].split(':')[0],
+        'tag': image_tag,
+        'image_id': image.id,
+        'python_version': getenv('PYTHON_VERSION'),
+        'build_seconds': duration,
+        'size': image.attrs.get('Size'),
+        # added by this image's cache-warming layers
+        'warm_cache_size': sum(l['size'] for l in layers
+                               if l['warm_cache'] and not l['from_parent']),
+        'layers': layers,
+        'packages': packages,
+        'packages_added': packages_added
+    }
+
+
+def _parent_ref(image_tag):
+    # parent image reference from the image's Dockerfile, resolved with
+    # the same tree used to build it
+    repo_root = getenv('GITHUB_WORKSPACE', str(Path(__file__).resolve().parents[1]))
+    image_name = image_tag.split('/')[-1].split(':')[0]
+    try:
+        image_tree = ImageTree.load(repo_root)
+        parent_node = image_tree.get_node(image_name, getenv('PYTHON_VERSION')).parent
+    except ValueError:
+        return None
+
+    if parent_node is None:
+        return None
+
+    org = image_tag.split('/')[0]
+    return f'{org}/{parent_node}'
+
+
+def append_metrics(metrics, output_path):
+    # lock so records from parallel builds don't interleave
+    with open(output_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(metrics, separators=(',', ':')) + '\n')
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_metrics(path):
+    """returns the most recent record for each (image, python version)"""
+    records = dict()
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[(record['image'], record['python_version'])] = record
+
+    return records
+
+
+def _grew(old, new, threshold, minimum):
+    if old is None or new is None:
+        return False
+    return new - old > minimum and (old == 0 or (new - old) / old > threshold)
+
+
+def compare_metrics(old_records, new_records, threshold=0.1, min_bytes=10 * 1024 ** 2,
+                    min_seconds=30):
+    """
+    returns a list of human-readable regressions: images, layers, or
+    packages whose size or build time grew by more than `threshold`
+    (as a fraction of the old value) and by more than the absolute
+    minimums
+    """
+    regressions = list()
+    for key, new in sorted(new_records.items()):
+        old = old_records.get(key)
+        if old is None:
+            continue
+
+        label = f'{new["image"]} (Python {new["python_version"]})'
+        if _grew(old['size'], new['size'], threshold, min_bytes):
+            regressions.append(f'{label}: image size {old["size"]} -> {new["size"]} bytes')
+        if _grew(old['build_seconds'], new['build_seconds'], threshold, min_seconds):
+            regressions.append(f'{label}: build time {old["build_seconds"]:.0f} -> '
+                               f'{new["build_seconds"]:.0f} seconds')
+        # records from before cache-warming layers were tagged don't
+        # have a size for them
+        if _grew(old.get('warm_cache_size'), new.get('warm_cache_size'), threshold, min_bytes):
+            regressions.append(f'{label}: cache-warming layers {old["warm_cache_size"]} -> '
+                               f'{new["warm_cache_size"]} bytes')
+
+        # match layers by the instruction that created them
+        old_layers = {l['created_by']: l for l in old['layers'] if not l['from_parent']}
+        for layer in new['layers']:
+            old_layer = old_layers.get(layer['created_by'])
+            if layer['from_parent'] or old_layer is None:
+                continue
+
+            desc = f'{layer["instruction"]} layer {layer["index"]} ({layer["created_by"][:60]}...)'
+            if _grew(old_layer['size'], layer['size'], threshold, min_bytes):
+                regressions.append(f'{label}: {desc} size {old_layer["size"]} -> '
+                                   f'{layer["size"]} bytes')
+            if _grew(old_layer['step_seconds'], layer['step_seconds'], threshold, min_seconds):
+                regressions.append(f'{label}: {desc} build time '
+                                   f'{old_layer["step_seconds"]:.0f} -> '
+                                   f'{layer["step_seconds"]:.0f} seconds')
+
+        for source, pkgs in (new.get('packages_added') or dict()).items():
+            old_pkgs = (old.get('packages_added') or dict()).get(source, dict())
+            for name, size in pkgs.items():
+                if _grew(old_pkgs.get(name, 0), size, threshold, min_bytes):
+                    regressions.append(f'{label}: {source} package {name} adds '
+                                       f'{old_pkgs.get(name, 0)} -> {size} bytes')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="record metrics for a built image")
+    record_parser.add_argument('image_tag')
+    record_parser.add_argument('--duration', type=float, default=None,
+                               help="total build time, in seconds")
+    record_parser.add_argument('--output', required=True, help="JSON-lines file to append to")
+    report_parser = subparsers.add_parser('report', help="compare metrics from two runs")
+    report_parser.add_argument('old')
+    report_parser.add_argument('new')
+    report_parser.add_argument('--threshold', type=float, default=0.1,
+                               help="fractional increase to flag (default: 0.1)")
+    report_parser.add_argument('--min-mb', type=float, default=10,
+                               help="ignore size increases smaller than this (default: 10)")
+    report_parser.add_argument('--min-seconds', type=float, default=30,
+                               help="ignore build time increases smaller than this (default: 30)")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        client = docker.client.from_env()
+        append_metrics(collect_metrics(client, args.image_tag, args.duration), args.output)
+    elif args.command == 'report':
+        regressions = compare_metrics(load_metrics(args.old),
+                                      load_metrics(args.new),
+                                      threshold=args.threshold,
+                                      min_bytes=args.min_mb * 1024 ** 2,
+                                      min_seconds=args.min_seconds)
+        for regression in regressions:
+            print(regression)
+        if not regressions:
+            print("no regressions found")
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
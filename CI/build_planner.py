@@ -0,0 +1,186 @@
+"""
+Builds an image with BuildKit, reusing layers cached by previous builds
+of the same image & Python version. The default and custom variants of
+an image share cache, and published images carry inline cache metadata,
+so steps whose inputs haven't changed are reused rather than rebuilt.
+Reports the fraction of build steps served from cache
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+from os import getenv
+from pathlib import Path
+
+from build_metrics import append_metrics
+from image_tree import ImageTree
+
+
+# BuildKit's plain-text progress output, e.g.:
+#   #6 [2/5] RUN wget --quiet https://...
+#   #6 CACHED
+#   #7 [3/5] RUN if [ -n "$APT_PACKAGES" ]; ...
+#   #7 DONE 41.3s
+STEP_PATTERN = re.compile(r'#(\d+) \[(?:[\w.-]+ )?\d+/\d+\] ([A-Z]+)')
+CACHED_PATTERN = re.compile(r'#(\d+) CACHED')
+DONE_PATTERN = re.compile(r'#(\d+) DONE (\d+(?:\.\d+)?)s')
+
+
+class CacheStats:
+    """tracks which build steps were served from cache"""
+    def __init__(self):
+        # BuildKit vertex ID -> Dockerfile instruction, for build steps
+        # (FROM steps are pulled, not built, so aren't counted)
+        self.steps = dict()
+        self.cached = set()
+        self.step_seconds = dict()
+
+    def feed(self, line):
+        match = STEP_PATTERN.match(line)
+        if match is not None:
+            if match.group(2) != 'FROM':
+                self.steps[match.group(1)] = match.group(2)
+            return
+
+        match = CACHED_PATTERN.match(line)
+        if match is not None:
+            self.cached.add(match.group(1))
+            return
+
+        match = DONE_PATTERN.match(line)
+        if match is not None:
+            self.step_seconds[match.group(1)] = float(match.group(2))
+
+    @property
+    def hit_ratio(self):
+        if not self.steps:
+            return None
+        return len(self.cached & self.steps.keys()) / len(self.steps)
+
+    def to_dict(self):
+        return {
+            'steps': len(self.steps),
+            'cached': len(self.cached & self.steps.keys()),
+            'hit_ratio': self.hit_ratio,
+            # time spent on steps that had to be run
+            'uncached_seconds': sum(secs for vertex, secs in self.step_seconds.items()
+                                    if vertex in self.steps and vertex not in self.cached)
+        }
+
+
+class BuildPlanner:
+    def __init__(self, image_tree, org=None, python_version=None):
+        self.tree = image_tree
+        if org is None:
+            org = getenv('DOCKER_HUB_ORG', 'contextlab')
+        if python_version is None:
+            python_version = self.tree.python_version
+
+        self.org = org
+        self.python_version = python_version
+
+    def tag(self, image, custom=False):
+        if custom:
+            return f'{self.org}/{image.name}:{self.python_version}-custom'
+        return f'{self.org}/{self.tree.get_node(image, self.python_version)}'
+
+    def cache_sources(self, image):
+        """
+        images to import layer cache from: both variants of this image
+        for the current Python version. Local images are used if present;
+        otherwise BuildKit fetches the (published) image's cache metadata
+        """
+        return [self.tag(image), self.tag(image, custom=True)]
+
+    def build_args(self, image, custom=False):
+        build_args = {'BUILDKIT_INLINE_CACHE': '1'}
+        if image.python_specific:
+            build_args['PYTHON_VERSION'] = self.python_version
+        if custom:
+            build_args.update(self._custom_args(image))
+
+        return build_args
+
+    def _custom_args(self, image):
+        # source the file (like build_custom.sh did) rather than parsing
+        # it, so values are expanded the same way
+        custom_args_file = image.dirpath.joinpath('ci', 'custom-args.sh')
+        arg_names = [line.split()[1].split('=')[0]
+                     for line in custom_args_file.read_text().splitlines()
+                     if line.startswith('export ')]
+        output = subprocess.run(['bash', '-c', f'source "{custom_args_file}" && env -0'],
+                                stdout=subprocess.PIPE,
+                                check=True).stdout.decode('utf-8')
+        env = dict(var.split('=', 1) for var in output.split('\0') if '=' in var)
+        return {name: env[name] for name in arg_names if name in env}
+
+    def build_command(self, image, custom=False):
+        cmd = ['docker', 'build',
+               '--progress=plain',
+               '-f', str(image.dirpath.joinpath('Dockerfile')),
+               '-t', self.tag(image, custom=custom)]
+        for ref in self.cache_sources(image):
+            cmd.extend(['--cache-from', ref])
+        for name, value in self.build_args(image, custom=custom).items():
+            cmd.extend(['--build-arg', f'{name}={value}'])
+
+        cmd.append(str(image.dirpath))
+        return cmd
+
+    def build(self, image, custom=False):
+        """
+        builds `image`, streaming BuildKit's output. Returns the build's
+        exit code and a dict of cache stats
+        """
+        if isinstance(image, str):
+            image = self.tree.get_image(image)
+
+        cmd = self.build_command(image, custom=custom)
+        env = dict(os.environ, DOCKER_BUILDKIT='1')
+        stats = CacheStats()
+        start = time.time()
+        with subprocess.Popen(cmd,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              env=env) as proc:
+            for raw_line in proc.stdout:
+                line = raw_line.decode('utf-8', errors='replace')
+                sys.stdout.write(line)
+                stats.feed(line)
+
+        result = stats.to_dict()
+        result.update({
+            'image': image.name,
+            'tag': self.tag(image, custom=custom),
+            'python_version': self.python_version,
+            'custom': custom,
+            'returncode': proc.returncode,
+            'build_seconds': time.time() - start
+        })
+        return proc.returncode, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('image')
+    parser.add_argument('--custom', action='store_true',
+                        help="build the custom variant, with args from ci/custom-args.sh")
+    parser.add_argument('--stats', default=None,
+                        help="JSON-lines file to append cache stats to")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    planner = BuildPlanner(ImageTree.load(args.repo_root))
+    returncode, result = planner.build(args.image, custom=args.custom)
+    if result['hit_ratio'] is not None:
+        print(f"{result['tag']}: {result['cached']}/{result['steps']} steps cached "
+              f"({result['hit_ratio']:.0%}), {result['uncached_seconds']:.0f} seconds "
+              f"in uncached steps")
+    if args.stats is not None:
+        append_metrics(result, args.stats)
+
+    sys.exit(returncode)
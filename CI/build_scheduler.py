@@ -0,0 +1,162 @@
+"""
+Builds images in parallel, following the dependency structure of the
+ImageTree. Each image starts building as soon as its parent finishes,
+and images downstream of a failed build are skipped. Images can be built
+for multiple Python versions at once, in which case images shared
+between versions (e.g., cdl-base) are only built once
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import cpu_count, getenv
+from pathlib import Path
+
+from image_tree import ImageTree
+
+
+class BuildScheduler:
+    def __init__(self, image_tree, to_build, max_workers=None, build_cmd=None,
+                 python_versions=None):
+        self.tree = image_tree
+        if isinstance(to_build, str):
+            to_build = to_build.split(':')
+        if python_versions is None:
+            python_versions = [self.tree.python_version]
+        elif isinstance(python_versions, str):
+            python_versions = python_versions.split(',')
+
+        self.python_versions = python_versions
+        # one BuildNode per image & Python version combination
+        self.nodes = self.tree.build_nodes(python_versions,
+                                           [self.tree.get_image(name) for name in to_build])
+        if max_workers is None:
+            max_workers = int(getenv('MAX_BUILD_WORKERS', cpu_count() or 1))
+
+        self.max_workers = max(1, max_workers)
+        if build_cmd is None:
+            build_cmd = [str(Path(__file__).resolve().parent.joinpath('build_default.sh'))]
+
+        self.build_cmd = build_cmd
+        # maps each node to the nearest of its ancestors that's also
+        # being built (None if all ancestors are pre-built or pulled)
+        self.dependencies = {node: self._build_parent(node) for node in self.nodes}
+        # 'success', 'failed', or 'skipped' for each finished node
+        self.status = dict()
+        self.durations = dict()
+
+    def _build_parent(self, node):
+        for ancestor in reversed(node.ancestors[:-1]):
+            if ancestor in self.nodes:
+                return ancestor
+
+        return None
+
+    def _critical_path_length(self, node):
+        # number of nodes (including this one) on the longest chain of
+        # to-be-built descendants. Longer chains are started first
+        children = [n for n, dep in self.dependencies.items() if dep is node]
+        return 1 + max((self._critical_path_length(c) for c in children), default=0)
+
+    def _build(self, node):
+        env = dict(os.environ)
+        if node.python_version is not None:
+            env['PYTHON_VERSION'] = node.python_version
+        elif 'PYTHON_VERSION' not in env:
+            env['PYTHON_VERSION'] = self.python_versions[0]
+
+        start = time.time()
+        proc = subprocess.run(self.build_cmd + [node.name],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              env=env)
+        self.durations[node] = time.time() - start
+        # output is buffered & printed all at once so logs from
+        # concurrent builds don't interleave
+        sys.stdout.write(proc.stdout.decode('utf-8', errors='replace'))
+        sys.stdout.flush()
+        return proc.returncode
+
+    def _skip_downstream(self, node):
+        for n, dep in self.dependencies.items():
+            if dep is node and n not in self.status:
+                self.status[n] = 'skipped'
+                print(f"skipping {n}: upstream build of {node} failed")
+                self._skip_downstream(n)
+
+    def run(self):
+        start = time.time()
+        pending = list(self.nodes)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [node for node in pending
+                         if self.dependencies[node] is None or
+                         self.status.get(self.dependencies[node]) == 'success']
+                ready.sort(key=self._critical_path_length, reverse=True)
+                for node in ready:
+                    pending.remove(node)
+                    running[executor.submit(self._build, node)] = node
+
+                if not running:
+                    # remaining nodes all depend on a failed build
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    if future.result() == 0:
+                        self.status[node] = 'success'
+                    else:
+                        self.status[node] = 'failed'
+                        self._skip_downstream(node)
+                        pending = [n for n in pending if n not in self.status]
+
+        self.wall_time = time.time() - start
+        return all(status == 'success' for status in self.status.values())
+
+    def summary(self):
+        lines = [f"{'image':<28}{'status':<10}duration (s)"]
+        for node in self.nodes:
+            duration = self.durations.get(node)
+            duration = '-' if duration is None else f'{duration:.0f}'
+            lines.append(f"{str(node):<28}{self.status.get(node, 'skipped'):<10}{duration}")
+
+        lines.append(f"total build time: {sum(self.durations.values()):.0f} seconds")
+        lines.append(f"wall-clock time: {self.wall_time:.0f} seconds "
+                     f"({self.max_workers} workers)")
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('images',
+                        help="colon-separated list of images to build "
+                             "(e.g., cdl-python:cdl-jupyter), or 'all'")
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        help="max number of concurrent builds (default: "
+                             "$MAX_BUILD_WORKERS or number of CPUs)")
+    parser.add_argument('-p', '--python-versions',
+                        default=getenv('PYTHON_VERSION'),
+                        help="comma-separated list of Python versions to build "
+                             "images for (default: $PYTHON_VERSION)")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    image_tree = ImageTree.load(args.repo_root)
+    if args.images == 'all':
+        args.images = [img.name for img in image_tree.root_image.children[0].descendants]
+
+    scheduler = BuildScheduler(image_tree,
+                               args.images,
+                               max_workers=args.workers,
+                               python_versions=args.python_versions)
+    succeeded = scheduler.run()
+    print(scheduler.summary())
+    sys.exit(0 if succeeded else 1)
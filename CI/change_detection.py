@@ -0,0 +1,222 @@
+"""
+Determines which images need to be rebuilt or retested by hashing their
+effective build & test inputs and comparing against a manifest of the
+hashes from the last published build, rather than diffing commits
+"""
+import argparse
+import ast
+import hashlib
+import json
+from os import getenv
+from pathlib import Path
+
+from image_tree import ImageTree
+
+
+# files outside of image directories that affect how every image is
+# built. Shared test files are found by following imports from conftest.py
+SHARED_BUILD_FILES = ['CI/build_default.sh']
+
+
+class ChangeDetector:
+    def __init__(self, image_tree, manifest_path=None):
+        self.tree = image_tree
+        self.root_dir = self.tree.root_dir
+        self.python_version = self.tree.python_version
+        if manifest_path is None:
+            manifest_path = getenv('HASH_MANIFEST',
+                                   self.root_dir.parent.joinpath('hash-manifest.json'))
+        self.manifest_path = Path(manifest_path)
+        self.manifest = self._load_manifest()
+        self._build_hashes = dict()
+        self._test_hashes = dict()
+        self._test_files = None
+
+    def _load_manifest(self):
+        try:
+            return json.loads(self.manifest_path.read_text())
+        except FileNotFoundError:
+            return None
+
+    def _hash_files(self, hasher, paths, relative_to):
+        for path in sorted(set(paths)):
+            if path.is_dir():
+                self._hash_files(hasher,
+                                 (p for p in path.rglob('*') if p.is_file()),
+                                 relative_to)
+            else:
+                hasher.update(str(path.relative_to(relative_to)).encode())
+                hasher.update(path.read_bytes())
+
+    def _dockerfile_inputs(self, image):
+        dockerfile = image.dockerfile
+        build_args = {name: '' if value is None else value
+                      for name, value in dockerfile.arg_values().items()}
+        copy_sources = list()
+        for src in dockerfile.copy_sources():
+            copy_sources.extend(image.dirpath.glob(src))
+
+        # PYTHON_VERSION is passed as a build-arg to all non-base images
+        if 'PYTHON_VERSION' in build_args and image.name != 'cdl-base':
+            build_args['PYTHON_VERSION'] = self.python_version
+
+        return build_args, copy_sources
+
+    def build_hash(self, image):
+        """
+        hash of everything that determines the contents of the built
+        image: the Dockerfile, files COPY'd into it, the effective
+        build-args, and the parent image's build hash
+        """
+        if image in self._build_hashes:
+            return self._build_hashes[image]
+
+        hasher = hashlib.sha256()
+        build_args, copy_sources = self._dockerfile_inputs(image)
+        hasher.update(json.dumps(build_args, sort_keys=True).encode())
+        self._hash_files(hasher,
+                         [image.dirpath.joinpath('Dockerfile')] + copy_sources,
+                         self.root_dir)
+        self._hash_files(hasher,
+                         [self.root_dir.joinpath(f) for f in SHARED_BUILD_FILES],
+                         self.root_dir)
+        if image.parent is self.tree.root_image:
+            # external base image (e.g., debian) is identified by name only
+            hasher.update(str(image.parent).encode())
+        else:
+            hasher.update(self.build_hash(image.parent).encode())
+
+        self._build_hashes[image] = hasher.hexdigest()
+        return self._build_hashes[image]
+
+    def _shared_test_files(self):
+        if self._test_files is not None:
+            return self._test_files
+
+        ci_dir = self.root_dir.joinpath('CI')
+        to_visit = [self.root_dir.joinpath('conftest.py')]
+        test_files = set()
+        while to_visit:
+            path = to_visit.pop()
+            if path in test_files or not path.is_file():
+                continue
+
+            test_files.add(path)
+            for node in ast.walk(ast.parse(path.read_text())):
+                if isinstance(node, ast.ImportFrom) and node.module is not None:
+                    modules = [node.module]
+                elif isinstance(node, ast.Import):
+                    modules = [alias.name for alias in node.names]
+                else:
+                    continue
+                to_visit.extend(ci_dir.joinpath(f'{m}.py') for m in modules)
+
+        self._test_files = test_files
+        return test_files
+
+    def test_hash(self, image):
+        """
+        hash of everything that determines the tests run on the image:
+        its build hash, its own tests, the shared test infrastructure,
+        and its parent's tests (which are inherited)
+        """
+        if image in self._test_hashes:
+            return self._test_hashes[image]
+
+        hasher = hashlib.sha256(self.build_hash(image).encode())
+        self._hash_files(hasher, [image.dirpath.joinpath('ci')], self.root_dir)
+        self._hash_files(hasher, self._shared_test_files(), self.root_dir)
+        if image.parent is not self.tree.root_image:
+            hasher.update(self.test_hash(image.parent).encode())
+
+        self._test_hashes[image] = hasher.hexdigest()
+        return self._test_hashes[image]
+
+    def current_hashes(self):
+        return {
+            img_name: {
+                'build': self.build_hash(self.tree.get_image(img_name)),
+                'test': self.test_hash(self.tree.get_image(img_name))
+            } for img_name in self.tree.all_images
+        }
+
+    def changed_images(self):
+        """
+        returns lists of images to rebuild and retest (in build order),
+        based on which images' hashes differ from the manifest's.
+        Descendants of changed images are included
+        """
+        published = (self.manifest or dict()).get(self.python_version, dict())
+        current = self.current_hashes()
+        # images shared across Python versions are only recorded by the
+        # job that pushes them (see update_manifest). Other jobs rebuild
+        # them only when one of their children is rebuilt (whose build
+        # hash includes theirs)
+        unrecorded_shared = [img_name for img_name in current
+                             if not self.tree.get_image(img_name).python_specific
+                             and img_name not in published]
+        to_rebuild = list()
+        to_retest = list()
+        for img_name, hashes in current.items():
+            if img_name in unrecorded_shared:
+                continue
+            published_hashes = published.get(img_name, dict())
+            if hashes['build'] != published_hashes.get('build'):
+                to_rebuild.append(img_name)
+            if hashes['test'] != published_hashes.get('test'):
+                to_retest.append(img_name)
+
+        # sort into build order. Descendants are already included, since
+        # parents' hashes feed into their children's
+        if to_rebuild:
+            to_rebuild = self.tree.get_dependents(to_rebuild)
+        if to_retest:
+            to_retest = self.tree.get_dependents(to_retest + to_rebuild)
+
+        shared_parents = [img_name for img_name in unrecorded_shared
+                          if any(self.tree.get_image(img).parent.name == img_name
+                                 for img in to_rebuild)]
+        return shared_parents + to_rebuild, to_retest
+
+    def update_manifest(self, exclude_shared=False):
+        """
+        record current hashes as the last published ones. If
+        `exclude_shared` is True, images shared across Python versions
+        (e.g., cdl-base) aren't recorded, since they're pushed by
+        another job
+        """
+        manifest = self.manifest or dict()
+        hashes = self.current_hashes()
+        if exclude_shared:
+            hashes = {img_name: img_hashes for img_name, img_hashes in hashes.items()
+                      if self.tree.get_image(img_name).python_specific}
+
+        manifest[self.python_version] = hashes
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        self.manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        self.manifest = manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('action', choices=['changed', 'update-manifest'])
+    parser.add_argument('--manifest', default=None, help="(default: $HASH_MANIFEST)")
+    parser.add_argument('--exclude-shared', action='store_true',
+                        help="with update-manifest, don't record hashes for images "
+                             "shared across Python versions (e.g., cdl-base:latest)")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    detector = ChangeDetector(ImageTree.load(args.repo_root), manifest_path=args.manifest)
+    if args.action == 'changed':
+        if detector.manifest is None:
+            print(f"no manifest found at {detector.manifest_path}")
+        rebuild, retest = detector.changed_images()
+        print(f"to rebuild: {':'.join(rebuild) or 0}")
+        print(f"to retest: {':'.join(retest) or 0}")
+    else:
+        detector.update_manifest(exclude_shared=args.exclude_shared)
+        print(f"updated hashes for Python {detector.python_version} in "
+              f"{detector.manifest_path}")
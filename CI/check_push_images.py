@@ -0,0 +1,136 @@
+"""
+Checks the push engine (push_images.py) against a local registry:2
+container. Pushes a stand-in for each image in the tree (a tiny image
+built on its parent's stand-in, tagged under a separate org) and checks
+that no image starts pushing before its parent has finished, and that a
+rerun with an existing state file only pushes images it doesn't list
+"""
+import argparse
+import io
+import json
+import sys
+import tempfile
+from os import getenv
+from pathlib import Path
+
+import docker
+
+from image_tree import ImageTree
+from push_images import PushEngine, local_registry
+
+
+BASE_IMAGE = 'busybox:latest'
+DEFAULT_ORG = 'cdl-push-check'
+
+
+def build_stand_ins(client, nodes, org):
+    """builds a small image for each of `nodes` (and their ancestors)"""
+    built = list()
+    for node in nodes:
+        for ancestor in node.ancestors:
+            if ancestor in built:
+                continue
+            parent = BASE_IMAGE if ancestor.parent is None else f'{org}/{ancestor.parent}'
+            dockerfile = f'FROM {parent}\nRUN echo "{ancestor}" > /{ancestor.name}\n'
+            client.images.build(fileobj=io.BytesIO(dockerfile.encode()),
+                                tag=f'{org}/{ancestor}',
+                                rm=True)
+            built.append(ancestor)
+
+    return built
+
+
+def check_order(engine):
+    """messages for each image whose push started before its parent's finished"""
+    errors = list()
+    for node, parent in engine.dependencies.items():
+        result = engine.results.get(node, dict())
+        if parent is None or result.get('status') != 'pushed':
+            continue
+        parent_result = engine.results.get(parent, dict())
+        if parent_result.get('status') == 'pushed':
+            started = result['pushed_at'] - result['seconds']
+            if started < parent_result['pushed_at']:
+                errors.append(f"{node} started pushing before {parent} finished")
+
+    return errors
+
+
+def check_statuses(engine, expected):
+    """messages for each image whose push result isn't `expected[node]`"""
+    return [f"{node}: expected {status}, got {engine.results.get(node, dict()).get('status')}"
+            for node, status in expected.items()
+            if engine.results.get(node, dict()).get('status') != status]
+
+
+def run_checks(client, nodes, org, registry, state_path):
+    errors = list()
+
+    def _run(expected):
+        engine = PushEngine(client, nodes, org=org, registry=registry, state_path=state_path)
+        succeeded = engine.run()
+        print(engine.summary())
+        if not succeeded:
+            errors.append("push engine reported a failure")
+        errors.extend(check_statuses(engine, expected))
+        errors.extend(check_order(engine))
+        return engine
+
+    print("pushing all images...")
+    engine = _run({node: 'pushed' for node in nodes})
+    # simulate a run interrupted before the images nothing depends on
+    # were pushed, by removing them from the state file
+    leaves = [node for node in nodes if node not in engine.dependencies.values()]
+    state = engine.state
+    for node in leaves:
+        state.pop(engine.remote_ref(node), None)
+    engine.state_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+    print(f"resuming after removing {len(leaves)} images from the state file...")
+    _run({node: 'pushed' if node in leaves else 'up-to-date' for node in nodes})
+    print("rerunning with every image recorded as pushed...")
+    _run({node: 'up-to-date' for node in nodes})
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--python-version', default=getenv('PYTHON_VERSION', '3.8'),
+                        help="Python version to push stand-ins for (default: "
+                             "$PYTHON_VERSION or 3.8)")
+    parser.add_argument('--port', type=int, default=5000,
+                        help="port to run the registry on (default: %(default)s)")
+    parser.add_argument('--org', default=DEFAULT_ORG,
+                        help="org to tag stand-in images with (default: %(default)s)")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    image_tree = ImageTree.load(args.repo_root)
+    nodes = image_tree.build_nodes([args.python_version])
+    client = docker.client.from_env()
+    built = list()
+    try:
+        print(f"building stand-ins for {len(nodes)} images...")
+        built = build_stand_ins(client, nodes, args.org)
+        with local_registry(client, args.port) as registry, \
+                tempfile.TemporaryDirectory() as tmp_dir:
+            errors = run_checks(client,
+                                nodes,
+                                args.org,
+                                registry,
+                                Path(tmp_dir).joinpath('push-state.json'))
+    finally:
+        # children first, so each parent is no longer in use by the
+        # time its tags are removed
+        for node in reversed(built):
+            for ref in (f'{args.org}/{node}', f'localhost:{args.port}/{args.org}/{node}'):
+                try:
+                    client.images.remove(ref)
+                except docker.errors.ImageNotFound:
+                    pass
+
+    for error in errors:
+        print(f"error: {error}")
+    sys.exit(1 if errors else 0)
@@ -1,68 +1,273 @@
 import json
+import operator
+import re
+import sys
+from collections import namedtuple
+from functools import lru_cache
+
 from packaging.specifiers import Specifier
 
+from import_sweep import DEFAULT_TIMEOUT, sweep_imports
+
+
+VersionMismatch = namedtuple('VersionMismatch',
+                             ['name', 'source', 'spec', 'installed', 'reason'])
+
+SPEC_DELIMITERS = ('==', '<=', '>=', '!=', '~=', '<', '>', '=')
+NUMERIC_VERSION = re.compile(r'\d+(\.\d+)*')
+# comparisons that can be done directly on release tuples (for purely
+# numeric versions) without building a Specifier
+RELEASE_COMPARISONS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
 
 class CondaEnvironment:
-    def __init__(self, container):
+    def __init__(self, container=None, snapshot=None):
         self.container = container
         self.run_kwargs = dict(detach=False, remove=True, tty=False)
+        # output of conda commands, collected from a single container
+        # when the Container was created
+        if snapshot is None:
+            snapshot = getattr(container, 'snapshot', None)
+        self.snapshot = snapshot
         self.config = self.parse_config()
 
-        self.installed_packages = Permadict()
-        self.requested_packages = Permadict()
-        self.pinned_packages = Permadict()
+        self.installed_packages = PackageIndex()
+        self.requested_packages = PackageIndex()
+        self.pinned_packages = PackageIndex()
         self.parse_packages()
 
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        creates a CondaEnvironment from a (possibly cached) snapshot,
+        without needing a running container
+        """
+        return cls(snapshot=snapshot)
+
     def parse_config(self):
+        if self.snapshot is not None and self.snapshot['conda_config'] is not None:
+            if self.snapshot.get('conda_config_partial') and self.container is not None:
+                return CondaConfig(self.snapshot['conda_config'], self._run_config_cmd)
+            return self.snapshot['conda_config']
+        elif self.container is None:
+            raise ValueError("snapshot has no conda environment info and no "
+                             "container was given to collect it from")
+
+        return self._run_config_cmd()
+
+    def _run_config_cmd(self):
         config_cmd = 'conda config --show --json'
         raw_config = self.container.run(command=config_cmd, **self.run_kwargs)
         return json.loads(raw_config)
 
     def parse_packages(self):
-        installed_cmd = 'conda env export --name base --json --no-builds'
-        requested_cmd = f'{installed_cmd} --from-history'
-        raw_installed = self.container.run(command=installed_cmd, **self.run_kwargs)
-        raw_requested = self.container.run(command=requested_cmd, **self.run_kwargs)
-        installed = json.loads(raw_installed)
-        requested = json.loads(raw_requested)
+        if self.snapshot is not None and self.snapshot['conda_installed'] is not None:
+            installed = self.snapshot['conda_installed']
+            requested = self.snapshot['conda_requested']
+        else:
+            installed_cmd = 'conda env export --name base --json --no-builds'
+            requested_cmd = f'{installed_cmd} --from-history'
+            raw_installed = self.container.run(command=installed_cmd, **self.run_kwargs)
+            raw_requested = self.container.run(command=requested_cmd, **self.run_kwargs)
+            installed = json.loads(raw_installed)
+            requested = json.loads(raw_requested)
 
         for pkg_spec in installed['dependencies']:
             if isinstance(pkg_spec, dict):
                 pip_specs = pkg_spec['pip']
                 for pip_spec in pip_specs:
-                    pkg = Package(pip_spec)
-                    self.installed_packages[pkg.name] = pkg
+                    self.installed_packages.add(Package(pip_spec, source='pip'))
             else:
-                pkg = Package(pkg_spec)
-                self.installed_packages[pkg.name] = pkg
+                self.installed_packages.add(Package(pkg_spec, source='conda'))
 
         for pkg_spec in requested['dependencies']:
-            pkg = Package(pkg_spec)
-            self.requested_packages[pkg.name] = pkg
+            self.requested_packages.add(Package(pkg_spec))
 
         for pkg_spec in self.config.get('pinned_packages'):
-            pkg = Package(pkg_spec)
-            self.pinned_packages[pkg.name] = pkg
+            self.pinned_packages.add(Package(pkg_spec))
+
+    def check_versions(self, specs=None):
+        """
+        checks all package specs against the installed packages in a
+        single pass. `specs` maps a label for where the specs came from
+        (e.g., 'pinned', 'build-arg') to an iterable of spec strings or
+        Packages (default: pinned & requested packages). Returns a
+        VersionReport listing every spec that isn't satisfied
+        """
+        if specs is None:
+            specs = {
+                'pinned': self.pinned_packages.values(),
+                'requested': self.requested_packages.values()
+            }
+
+        report = VersionReport()
+        for source, source_specs in specs.items():
+            for spec in source_specs:
+                if not isinstance(spec, Package):
+                    spec = Package(spec)
+
+                installed_pkg = self.installed_packages.get(spec.name)
+                if installed_pkg is None:
+                    report.append(VersionMismatch(spec.name, source, str(spec),
+                                                  None, 'not installed'))
+                elif not installed_pkg.matches_version(spec):
+                    report.append(VersionMismatch(spec.name, source, str(spec),
+                                                  installed_pkg.version,
+                                                  'version mismatch'))
+
+        return report
+
+    def import_sweep(self, packages=None, workers=None, timeout=DEFAULT_TIMEOUT):
+        """
+        imports the top-level modules of `packages` (default: every
+        installed package) in parallel in a single container. Returns an
+        import_sweep.ImportSweep with any failures and import times
+        """
+        if self.container is None:
+            raise ValueError("importing packages requires a container")
+        if packages is None:
+            packages = [pkg for name in self.installed_packages
+                        for pkg in self.installed_packages.get_all(name)]
+
+        return sweep_imports(self.container, packages, workers=workers, timeout=timeout)
+
+
+class CondaConfig(dict):
+    """
+    conda config read from .condarc files (see conda_meta.py), which
+    only has some of conda's keys. The first time a key it doesn't have
+    is looked up (or all keys are listed), the rest are filled in from
+    `load_full` (e.g., the output of `conda config --show`)
+    """
+    def __init__(self, values, load_full):
+        super().__init__(values)
+        self._load_full = load_full
+
+    def _fill(self):
+        if self._load_full is not None:
+            load_full, self._load_full = self._load_full, None
+            for key, value in load_full().items():
+                self.setdefault(key, value)
+
+    def __missing__(self, key):
+        self._fill()
+        if not dict.__contains__(self, key):
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self._fill()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        self._fill()
+        return super().__iter__()
+
+    def __len__(self):
+        self._fill()
+        return super().__len__()
+
+    def keys(self):
+        self._fill()
+        return super().keys()
+
+    def values(self):
+        self._fill()
+        return super().values()
+
+    def items(self):
+        self._fill()
+        return super().items()
+
+
+class VersionReport(list):
+    """list of VersionMismatches that formats as a table"""
+    def __str__(self):
+        if not self:
+            return 'all package versions match'
+
+        rows = [VersionMismatch('package', 'source', 'spec', 'installed', 'problem')]
+        rows.extend(m._replace(installed=m.installed or '-') for m in self)
+        widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+        lines = ['  '.join(str(field).ljust(w) for field, w in zip(row, widths)).rstrip()
+                 for row in rows]
+        lines.insert(1, '  '.join('-' * w for w in widths))
+        return f'{len(self)} package version problem(s):\n' + '\n'.join(lines)
+
+
+@lru_cache(maxsize=None)
+def _compile_specifier(delimiter, version, partial_version):
+    """
+    converts a conda-style version spec into a (cached)
+    packaging.specifiers.Specifier, or None if any version matches.
+    `partial_version` is True if the version has no minor or patch
+    component
+    """
+    if version is None or version == '*':
+        return None
+    elif delimiter == '=':
+        delimiter = '=='
+
+    if (
+            delimiter in ('==', '!=') and
+            partial_version and
+            not version.endswith('.*')
+    ):
+        version = f'{version}.*'
+    elif delimiter not in ('==', '!=') and version.endswith('.*'):
+        version = version.split('.*')[0]
+
+    return Specifier(f'{delimiter}{version}')
+
+
+@lru_cache(maxsize=None)
+def _specifier_contains(specifier, version):
+    return specifier.contains(version)
 
 
 class Package:
-    def __init__(self, pkg_spec):
-        self.name = None
+    __slots__ = ('name', 'source', 'delimiter', 'version', 'major_version',
+                 'minor_version', 'patch_version', 'extra_labels', 'release')
+
+    def __init__(self, pkg_spec, source=None):
+        # where the package was installed from ('conda' or 'pip'), if
+        # it's an installed package rather than a spec
+        self.source = source
+        self.delimiter = None
+        self.version = None
         self.major_version = None
         self.minor_version = None
         self.patch_version = None
         self.extra_labels = None
+        # version as a tuple of ints (trailing zeros dropped) for purely
+        # numeric versions, for fast comparisons. None otherwise
+        self.release = None
 
-        for spec_delim in ['==', '<=', '>=', '!=', '~=', '<', '>', '=']:
+        for spec_delim in SPEC_DELIMITERS:
             if spec_delim in pkg_spec:
                 self.delimiter = spec_delim
                 name, version = pkg_spec.split(self.delimiter)
-                self.name = name
                 self._parse_version(version)
                 break
         else:
             # just package name, no specifier
-            self.delimiter = None
+            name = pkg_spec
+
+        # names are repeated across installed/requested/pinned packages
+        # and every spec checked against them
+        self.name = sys.intern(name)
 
     def __repr__(self):
         return f'Package({str(self)})'
@@ -73,18 +278,6 @@ class Package:
         else:
             return f'{self.name}{self.delimiter}{self.version}'
 
-    @property
-    def version(self):
-        full_version = self.major_version
-        if self.minor_version is not None:
-            full_version += f'.{self.minor_version}'
-        if self.patch_version is not None:
-            full_version += f'.{self.patch_version}'
-        if self.extra_labels is not None:
-            full_version += self.extra_labels
-
-        return full_version
-
     def _parse_version(self, version_str):
         parts = version_str.split('.')
         self.major_version = parts.pop(0)
@@ -106,6 +299,21 @@ class Package:
             if patch_version != '':
                 self.patch_version = patch_version
 
+        version = self.major_version
+        if self.minor_version is not None:
+            version += f'.{self.minor_version}'
+        if self.patch_version is not None:
+            version += f'.{self.patch_version}'
+        if self.extra_labels is not None:
+            version += self.extra_labels
+        self.version = version
+
+        if NUMERIC_VERSION.fullmatch(version):
+            release = [int(part) for part in version.split('.')]
+            while len(release) > 1 and release[-1] == 0:
+                release.pop()
+            self.release = tuple(release)
+
     def matches_version(self, other):
         """
         returns true of self.version fits within the specification
@@ -114,36 +322,83 @@ class Package:
         if not isinstance(other, Package):
             other = Package(other)
 
-        if other.version is None or other.version == '*':
-            return True
-        elif other.delimiter == '=':
-            other_delim = '=='
-        else:
-            other_delim = other.delimiter
-
+        partial_version = other.minor_version is None or other.patch_version is None
+        compare = RELEASE_COMPARISONS.get(other.delimiter)
         if (
-                other_delim in ('==', '!=') and
-                (other.minor_version is None or other.patch_version is None) and
-                not other.version.endswith('.*')
+                compare is not None and
+                self.release is not None and
+                other.release is not None and
+                not (partial_version and other.delimiter in ('=', '==', '!='))
         ):
-            other_version = f'{other.version}.*'
-        elif other_delim not in ('==', '!=') and other.version.endswith('.*'):
-            other_version = other.version.split('.*')[0]
-        else:
-            other_version = other.version
+            return compare(self.release, other.release)
 
-        other_spec = Specifier(f'{other_delim}{other_version}')
-        return other_spec.contains(self.version)
+        other_spec = _compile_specifier(other.delimiter, other.version, partial_version)
+        if other_spec is None:
+            return True
 
+        return _specifier_contains(other_spec, self.version)
 
-class Permadict(dict):
+
+class PackageIndex:
     """
-    dict subclass that raises an exception on setting a value for a key
-    that already exists
+    mapping of package names to Packages, backed by a single list. A
+    package installed by both conda and pip is stored once per source
+    rather than raising; lookups by name return the conda-installed one
     """
-    def __setitem__(self, k, v):
-        try:
-            self.__getitem__(k)
-            raise ValueError(f"entry for {k} already exists")
-        except KeyError:
-            super().__setitem__(k, v)
+    __slots__ = ('_packages', '_positions')
+
+    def __init__(self, packages=()):
+        self._packages = list()
+        # package name -> tuple of indices into self._packages, with the
+        # conda-installed package first
+        self._positions = dict()
+        for pkg in packages:
+            self.add(pkg)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, name):
+        return self._packages[self._positions[name][0]]
+
+    def add(self, pkg):
+        positions = self._positions.get(pkg.name, ())
+        for ix in positions:
+            if self._packages[ix].source == pkg.source:
+                raise ValueError(f"entry for {pkg.name} already exists")
+
+        if pkg.source == 'conda':
+            positions = (len(self._packages),) + positions
+        else:
+            positions += (len(self._packages),)
+
+        self._positions[pkg.name] = positions
+        self._packages.append(pkg)
+
+    def get(self, name, default=None, source=None):
+        for ix in self._positions.get(name, ()):
+            pkg = self._packages[ix]
+            if source is None or pkg.source == source:
+                return pkg
+
+        return default
+
+    def get_all(self, name):
+        """all packages named `name`, from every source"""
+        return [self._packages[ix] for ix in self._positions.get(name, ())]
+
+    def keys(self):
+        return self._positions.keys()
+
+    def values(self):
+        return [self._packages[positions[0]] for positions in self._positions.values()]
+
+    def items(self):
+        return [(name, self._packages[positions[0]])
+                for name, positions in self._positions.items()]
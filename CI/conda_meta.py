@@ -0,0 +1,257 @@
+"""
+Reads conda environment info directly from the static files conda
+maintains (conda-meta/*.json records, conda-meta/history, .condarc) and
+pip's *.dist-info metadata, rather than running conda commands, which
+each take seconds to start up. Produces the same data as `conda config
+--show --json` and `conda env export --json --no-builds [--from-history]`,
+plus the installed size of each package
+"""
+import ast
+import io
+import json
+import tarfile
+from pathlib import PurePosixPath
+
+
+STAGING_DIR = '/tmp/cdl-conda-meta'
+
+# copies the relevant files into a single directory so they can be
+# pulled out of the container in one archive (no conda/Python needed)
+STAGE_SCRIPT = f"""
+shopt -s nullglob
+if command -v conda > /dev/null; then
+    prefix=$(dirname $(dirname $(command -v conda)))
+    mkdir -p {STAGING_DIR}
+    echo $prefix > {STAGING_DIR}/prefix
+    cp -r $prefix/conda-meta {STAGING_DIR}/
+    [ -f $prefix/.condarc ] && cp $prefix/.condarc {STAGING_DIR}/condarc-system
+    [ -f ~/.condarc ] && cp ~/.condarc {STAGING_DIR}/condarc-user
+    dist_info=($prefix/lib/python*/site-packages/*.dist-info/METADATA
+               $prefix/lib/python*/site-packages/*.dist-info/RECORD
+               $prefix/lib/python*/site-packages/*.egg-info/PKG-INFO
+               $prefix/lib/python*/site-packages/*.egg-info)
+    dist_info=($(for f in "${{dist_info[@]}}"; do [ -f "$f" ] && echo "$f"; done))
+    if [ ${{#dist_info[@]}} -gt 0 ]; then
+        cp --parents "${{dist_info[@]}}" {STAGING_DIR}/
+    fi
+fi
+"""
+
+
+def _parse_condarc(text):
+    """
+    parses the subset of YAML written by `conda config` (top-level keys
+    with scalar values or lists of scalars)
+    """
+    def _scalar(value):
+        value = value.strip().strip('\'"')
+        if value in ('true', 'True'):
+            return True
+        elif value in ('false', 'False'):
+            return False
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    config = dict()
+    key = None
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if line.lstrip().startswith('- ') and key is not None:
+            config[key].append(_scalar(line.lstrip()[2:]))
+        elif ':' in line and not line[0].isspace():
+            key, _, value = line.partition(':')
+            key = key.strip()
+            value = value.strip()
+            if value in ('', '[]'):
+                config[key] = list()
+            elif value.startswith('['):
+                config[key] = [_scalar(v) for v in value.strip('[]').split(',') if v.strip()]
+            else:
+                config[key] = _scalar(value)
+
+    return config
+
+
+def _default_config(prefix):
+    # conda's defaults for the keys the tests use. Other keys are only
+    # known if they're set in a .condarc (see CondaEnvironment.config)
+    return {
+        'auto_update_conda': True,
+        'channel_priority': 'flexible',
+        'channels': ['defaults'],
+        'envs_dirs': [f'{prefix}/envs', '/root/.conda/envs'],
+        'notify_outdated_conda': True,
+        'pinned_packages': list(),
+        'pkgs_dirs': [f'{prefix}/pkgs', '/root/.conda/pkgs'],
+        'root_prefix': prefix,
+        'show_channel_urls': None,
+    }
+
+
+def _merge_configs(prefix, system_rc, user_rc):
+    # like conda, values in the user's .condarc take precedence, and
+    # list values from both files are combined
+    config = _default_config(prefix)
+    explicit = dict()
+    for rc in (system_rc, user_rc):
+        for key, value in rc.items():
+            if isinstance(value, list) and isinstance(explicit.get(key), list):
+                explicit[key] = value + [v for v in explicit[key] if v not in value]
+            else:
+                explicit[key] = value
+
+    config.update(explicit)
+    return config
+
+
+def _requested_specs(history_text):
+    """
+    replays conda-meta/history to get the user-requested specs, like
+    `conda env export --from-history`
+    """
+    specs = dict()
+    for line in history_text.splitlines():
+        if not line.startswith('# ') or ' specs: ' not in line:
+            continue
+
+        action, _, raw_specs = line[2:].partition(' specs: ')
+        try:
+            spec_list = ast.literal_eval(raw_specs.strip())
+        except (ValueError, SyntaxError):
+            continue
+
+        for spec in spec_list:
+            # drop channel prefix (e.g., "conda-forge::numpy=1.19")
+            spec = spec.split('::')[-1]
+            name = spec.split('[')[0]
+            for delim in ('=', '<', '>', '!', '~', ' '):
+                name = name.split(delim)[0]
+
+            if action == 'remove':
+                specs.pop(name, None)
+            elif action in ('update', 'neutered'):
+                specs[name] = spec
+
+    return list(specs.values())
+
+
+def _parse_dist_metadata(text):
+    name = version = None
+    for line in text.splitlines():
+        if line.startswith('Name:'):
+            name = line.partition(':')[2].strip()
+        elif line.startswith('Version:'):
+            version = line.partition(':')[2].strip()
+        elif not line.strip():
+            # end of headers
+            break
+        if name is not None and version is not None:
+            break
+
+    return name, version
+
+
+def _record_size(text):
+    # RECORD lines are "path,hash,size" (size is empty for RECORD itself)
+    size = 0
+    for line in text.splitlines():
+        fields = line.rstrip().rsplit(',', 2)
+        if len(fields) == 3 and fields[2].isdigit():
+            size += int(fields[2])
+
+    return size
+
+
+def parse_staged_archive(archive):
+    """
+    parses the tar archive of STAGING_DIR (as bytes) into a dict with
+    the same 'conda_config', 'conda_installed' & 'conda_requested'
+    values as the conda command-based snapshot, plus 'package_sizes'
+    ({'conda': {name: bytes}, 'pip': {name: bytes}}). 'conda_config'
+    only has keys set in a .condarc and defaults for a few common ones,
+    so 'conda_config_partial' is True
+    """
+    files = dict()
+    with tarfile.open(fileobj=io.BytesIO(archive), mode='r|*') as tar:
+        for member in tar:
+            if member.isfile():
+                # strip leading staging directory name
+                path = PurePosixPath(*PurePosixPath(member.name).parts[1:])
+                files[str(path)] = tar.extractfile(member).read().decode('utf-8', errors='replace')
+
+    prefix = files['prefix'].strip()
+    config = _merge_configs(prefix,
+                            _parse_condarc(files.get('condarc-system', '')),
+                            _parse_condarc(files.get('condarc-user', '')))
+
+    conda_deps = list()
+    conda_files = set()
+    conda_sizes = dict()
+    channels = list()
+    for path, content in sorted(files.items()):
+        if path.startswith('conda-meta/') and path.endswith('.json'):
+            record = json.loads(content)
+            conda_deps.append(f"{record['name']}={record['version']}")
+            conda_files.update(record.get('files', list()))
+            paths = record.get('paths_data', dict()).get('paths')
+            if paths and all('size_in_bytes' in p for p in paths):
+                conda_sizes[record['name']] = sum(p['size_in_bytes'] for p in paths)
+            # short channel name (e.g., "conda-forge"), falling back to
+            # parsing ".../conda-forge/linux-64" URLs for older records
+            channel = record.get('schannel')
+            if not channel and record.get('channel'):
+                channel = record['channel'].rstrip('/').split('/')[-2]
+            if channel and channel not in channels:
+                channels.append(channel)
+
+    pip_deps = list()
+    pip_sizes = dict()
+    prefix_rel = prefix.lstrip('/')
+    records = {str(PurePosixPath(path).parent): content
+               for path, content in files.items() if path.endswith('.dist-info/RECORD')}
+    for path, content in sorted(files.items()):
+        if (
+                not path.startswith(prefix_rel) or
+                '-info' not in path or
+                path.endswith('/RECORD')
+        ):
+            continue
+        # path of metadata file/dir relative to the environment prefix
+        rel_path = path[len(prefix_rel):].lstrip('/')
+        if rel_path in conda_files:
+            # installed by conda, not pip
+            continue
+        name, version = _parse_dist_metadata(content)
+        if name is not None:
+            pip_deps.append(f'{name}=={version}')
+            record = records.get(str(PurePosixPath(path).parent))
+            if record is not None:
+                pip_sizes[name] = _record_size(record)
+
+    installed_deps = sorted(conda_deps)
+    if pip_deps:
+        installed_deps.append({'pip': sorted(pip_deps)})
+
+    installed = {
+        'name': 'base',
+        'channels': channels,
+        'dependencies': installed_deps,
+        'prefix': prefix
+    }
+    requested = {
+        'name': 'base',
+        'channels': config['channels'],
+        'dependencies': _requested_specs(files.get('conda-meta/history', '')),
+        'prefix': prefix
+    }
+    return {
+        'conda_config': config,
+        # config only has some of conda's keys
+        'conda_config_partial': True,
+        'conda_installed': installed,
+        'conda_requested': requested,
+        'package_sizes': {'conda': conda_sizes, 'pip': pip_sizes}
+    }
@@ -1,12 +1,22 @@
-from os import getenv
+import socket
+import threading
+import time
+from os import getenv, getpid
 from pathlib import Path
 
 import docker
-import requests
+
+from apt_state import AptState
+from async_docker import AsyncRunner
+from dockerfile import parse_dockerfile
+from introspection_cache import IntrospectionCache
+from layer_index import load_index
+from session_pool import ExecResult, SessionPool
+from snapshot import snapshot_backend, take_snapshot
 
 
 class Container:
-    def __init__(self, image):
+    def __init__(self, image, sessions=None, worker_id=None):
         self.image = image
         self.client = self.image.client
         self.image_name_full = self.image.tags[0]
@@ -20,12 +30,56 @@ class Container:
         # used by the manage_containers fixture to set container name
         # based on the currently running test function and remove all
         # containers once the test finishes
-        self.curr_container_name = None
+        self._curr_container_name = None
         self.curr_container_obj = None
+        # when tests are split across processes with pytest-xdist, each
+        # worker gets its own namespace for container names & labels
+        if worker_id is None:
+            worker_id = getenv('PYTEST_XDIST_WORKER')
+        self.worker_id = worker_id
+        self.labels = {'cdl-ci.worker': f'{worker_id or "main"}-{getpid()}'}
+        # optionally, run simple commands via `docker exec` in a pool of
+        # long-lived containers instead of starting a new one for each
+        if sessions is None:
+            sessions = int(getenv('CONTAINER_SESSIONS', 0))
+        if sessions > 0:
+            self.sessions = SessionPool(self.client,
+                                        self.image_name_full,
+                                        size=sessions,
+                                        labels=self.labels)
+        else:
+            self.sessions = None
+        # waits on containers with real timeouts, and runs batches of
+        # commands concurrently (see run_many)
+        self.runner = AsyncRunner(self.client)
         # collect expected image/container attributes for testing
         self.expected_attrs = self._get_expected_attrs()
+        # collect conda & apt environment info from a single container,
+        # or from the on-disk cache if this image was already inspected
+        self.snapshot = self._get_snapshot()
         # parse installed apt packages for testing
         self.apt_packages = self._get_apt_packages()
+        # index of the files in each of the image's layers, built the
+        # first time a test uses it
+        self._layer_index = None
+
+    @property
+    def layer_index(self):
+        if self._layer_index is None:
+            self._layer_index = load_index(self.client, self.image)
+        return self._layer_index
+
+    @property
+    def curr_container_name(self):
+        return self._curr_container_name
+
+    @curr_container_name.setter
+    def curr_container_name(self, name):
+        # a new name is set at the start of each test function, so use
+        # this as the signal to reset session state between tests
+        if self.sessions is not None and name != self._curr_container_name:
+            self.sessions.reset()
+        self._curr_container_name = name
 
     def _attrs_from_custom_args(self):
         filepath = self.image_dir.joinpath('ci', 'custom-args.sh')
@@ -48,19 +102,18 @@ class Container:
         return expected_attrs
 
     def _attrs_from_dockerfile(self):
-        filepath = self.image_dir.joinpath('Dockerfile')
-        file_lines = filepath.read_text().splitlines()
+        dockerfile = parse_dockerfile(self.image_dir.joinpath('Dockerfile'))
         expected_attrs = dict()
-        for line in file_lines:
-            if line.startswith('ARG '):
-                attr = line.replace('ARG ', '').split('=')[0]
-                value = line.replace(f'ARG {attr}=', '').strip('"')
-                if value == 'true':
-                    value = True
-                elif value == 'false':
-                    value = False
+        for attr, value in dockerfile.arg_values().items():
+            if value is None:
+                # declared without a default
+                value = ''
+            elif value == 'true':
+                value = True
+            elif value == 'false':
+                value = False
 
-                expected_attrs[attr.lower()] = value
+            expected_attrs[attr.lower()] = value
 
         return expected_attrs
 
@@ -83,23 +136,23 @@ class Container:
         expected_attrs['python_version'] = getenv('PYTHON_VERSION')
         return expected_attrs
 
-    def _get_apt_packages(self):
-        apt_log = self.run('cat /var/log/apt/history.log',
-                           detach=False,
-                           remove=True)
-        apt_packages = dict()
-        for line in apt_log.splitlines():
-            if line.startswith('Install:'):
-                packages = line.replace('Install: ', '').split('), ')
-                for pkg_spec in packages:
-                    pkg_name = pkg_spec.split(':')[0]
-                    if pkg_spec.endswith('automatic'):
-                        install_method = 'automatic'
-                    else:
-                        install_method = 'manual'
-                    apt_packages[pkg_name] = install_method
+    def container_name(self, test_func_name):
+        if self.worker_id is None:
+            return f'{test_func_name}_container'
+        else:
+            return f'{test_func_name}_{self.worker_id}_container'
 
-        return apt_packages
+    def _get_snapshot(self):
+        backend = snapshot_backend()
+        cache = IntrospectionCache(namespace=backend)
+        return cache.get_or_create(
+            self.image.id,
+            lambda: take_snapshot(self.client, self.image_name_full, backend)
+        )
+
+    def _get_apt_packages(self):
+        self.apt_state = AptState.from_snapshot(self.snapshot)
+        return self.apt_state.install_methods()
 
     def run(self,
             command=None,
@@ -117,9 +170,12 @@ class Container:
             publish_port=False,
             port_container=None,
             port_local=None,
+            name=None,
             **kwargs):
         if workdir is None:
             workdir = self.expected_attrs.get('workdir')
+        if name is None:
+            name = self.curr_container_name
         if mountpoint_container is not None or mountpoint_local is not None:
             mount = True
         if port_container is not None or port_local is not None:
@@ -149,29 +205,30 @@ class Container:
             ports = None
 
         if command is not None:
-            cmd = [shell]
-            if shell_flags is not None:
-                if isinstance(shell_flags, str):
-                    shell_flags = shell_flags.split()
-
-                cmd.extend(shell_flags)
-
-            if isinstance(command, str):
-                command = [command]
-
-            cmd.extend(command)
+            cmd = self._build_cmd(command, shell, shell_flags)
         else:
             cmd = None
-            
+
+        if (
+                self.sessions is not None and
+                cmd is not None and
+                volumes is None and
+                ports is None and
+                max_wait >= 0 and
+                set(kwargs).issubset({'environment'})
+        ):
+            return self._run_in_session(cmd, detach, workdir, max_wait, tty=tty, **kwargs)
+
         container = self.client.containers.run(self.image_name_full,
                                                command=cmd,
-                                               name=self.curr_container_name,
+                                               name=name,
                                                detach=detach,
                                                remove=remove,
                                                tty=tty,
                                                working_dir=workdir,
                                                volumes=volumes,
                                                ports=ports,
+                                               labels=self.labels,
                                                **kwargs)
         # if detach is True, returns a docker.containers.Container instance
         if detach:
@@ -179,7 +236,7 @@ class Container:
             # (e.g., when testing notebook server)
             if max_wait >= 0:
                 try:
-                    container.wait(timeout=max_wait)
+                    self.runner.run_sync(self.runner.wait(container, max_wait))
                 except docker.errors.NotFound:
                     # unlikely to happen, but would be raised if remove is
                     # True and container was removed before container.wait()
@@ -188,12 +245,16 @@ class Container:
                         pass
                     else:
                         raise
-                except requests.ConnectionError as e:
+                except TimeoutError as e:
                     # command didn't finish running in max_wait seconds
+                    # (the container has been killed)
                     _cmd = '' if cmd is None else ''.join(cmd)
+                    _test_func = self.curr_container_name.replace('_container', '')
+                    if self.worker_id is not None:
+                        _test_func = _test_func.replace(f'_{self.worker_id}', '')
                     raise TimeoutError(
                         f"Command {_cmd} during test function "
-                        f"\"{self.curr_container_name.replace('_container', '')}\" "
+                        f"\"{_test_func}\" "
                         f"timed out after {max_wait} seconds"
                     ) from e
 
@@ -209,3 +270,150 @@ class Container:
             container = container.decode('utf-8').strip()
 
         return container
+
+    @staticmethod
+    def _build_cmd(command, shell='/bin/bash', shell_flags='-c'):
+        cmd = [shell]
+        if shell_flags is not None:
+            if isinstance(shell_flags, str):
+                shell_flags = shell_flags.split()
+
+            cmd.extend(shell_flags)
+
+        if isinstance(command, str):
+            command = [command]
+
+        cmd.extend(command)
+        return cmd
+
+    def run_many(self,
+                 commands,
+                 shell='/bin/bash',
+                 shell_flags='-c',
+                 max_wait=30,
+                 workdir=None,
+                 **kwargs):
+        """
+        runs each of `commands` in its own new container concurrently
+        (even if sessions are enabled, since each session runs one
+        command at a time), and returns a list of finished containers,
+        in the same order as `commands`, whose `logs()` and `exit_code`
+        can be checked. Takes as long as the
+        slowest command rather than the sum of all of them. Raises a
+        TimeoutError if any command doesn't finish within `max_wait`
+        seconds, after killing all of their containers
+        """
+        if workdir is None:
+            workdir = self.expected_attrs.get('workdir')
+
+        cmds = [self._build_cmd(command, shell, shell_flags) for command in commands]
+        coros = [self.runner.run(self.image_name_full,
+                                 cmd,
+                                 timeout=max_wait,
+                                 # outside of tests (e.g., in CLI tools),
+                                 # let Docker name containers
+                                 name=(None if self.curr_container_name is None
+                                       else f'{self.curr_container_name}_{i}'),
+                                 tty=True,
+                                 working_dir=workdir,
+                                 labels=self.labels,
+                                 **kwargs)
+                 for i, cmd in enumerate(cmds)]
+
+        return self.runner.run_sync(self.runner.gather(coros))
+
+    def wait_until_ready(self,
+                         container,
+                         log_patterns=(),
+                         port=None,
+                         timeout=60,
+                         grace_period=2):
+        """
+        blocks until `container` (e.g., a server started with
+        max_wait=-1) has written all of `log_patterns` to its logs, or
+        until `port` accepts connections (after which the log patterns
+        are given `grace_period` more seconds to appear). Raises a
+        TimeoutError if neither happens within `timeout` seconds
+        """
+        patterns_found = threading.Event()
+
+        def _follow_logs():
+            remaining = list(log_patterns)
+            logs = ''
+            for chunk in container.logs(stream=True, follow=True):
+                logs += chunk.decode('utf-8', errors='replace')
+                remaining = [p for p in remaining if p not in logs]
+                if not remaining:
+                    patterns_found.set()
+                    return
+
+        if log_patterns:
+            threading.Thread(target=_follow_logs, daemon=True).start()
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if patterns_found.wait(timeout=0.25):
+                return
+            if port is not None and self._port_open(container, port):
+                patterns_found.wait(timeout=min(grace_period, deadline - time.time()))
+                return
+
+            container.reload()
+            if container.status == 'exited':
+                raise RuntimeError(
+                    f"container {container.name} exited before becoming ready:\n"
+                    f"{container.logs().decode('utf-8')}"
+                )
+
+        raise TimeoutError(f"container {container.name} not ready after "
+                           f"{timeout} seconds")
+
+    @staticmethod
+    def _port_open(container, port):
+        container.reload()
+        ip_address = container.attrs.get('NetworkSettings', {}).get('IPAddress')
+        if not ip_address:
+            return False
+        try:
+            with socket.create_connection((ip_address, int(port)), timeout=0.25):
+                return True
+        except OSError:
+            return False
+
+    def _run_in_session(self, cmd, detach, workdir, max_wait, tty=False, environment=None):
+        # mirror client.containers.run(detach=False), which returns
+        # stdout (and stderr, which a TTY merges into it) and raises an
+        # error if the command fails
+        merge_output = tty and not detach
+        exit_code, session, stdout, stderr = self.sessions.exec(cmd,
+                                                                workdir=workdir,
+                                                                environment=environment,
+                                                                max_wait=max_wait,
+                                                                merge_output=merge_output)
+        if detach:
+            return ExecResult(session, exit_code, stdout, stderr)
+
+        if exit_code != 0:
+            raise docker.errors.ContainerError(session,
+                                               exit_code,
+                                               cmd,
+                                               self.image_name_full,
+                                               stdout if merge_output else stderr)
+
+        return (stdout or b'').decode('utf-8').strip()
+
+    def close(self):
+        if self.sessions is not None:
+            self.sessions.close()
+        self.runner.close()
+
+        # remove any containers left over from this process (e.g., if a
+        # test was interrupted), without touching other workers' containers
+        label_filter = [f'{k}={v}' for k, v in self.labels.items()]
+        leftovers = self.client.containers.list(all=True,
+                                                filters={'label': label_filter})
+        for container in leftovers:
+            try:
+                container.remove(force=True)
+            except (docker.errors.APIError, docker.errors.NotFound):
+                pass
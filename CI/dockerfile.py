@@ -0,0 +1,465 @@
+"""
+Parses Dockerfiles into a list of instructions and the build stages
+they form, following the same rules as `docker build`: parser directives
+(e.g., "# escape=`"), comments, line continuations, JSON (exec) and
+shell forms, quoting, and variable substitution ($VAR, ${VAR},
+${VAR:-default}, ${VAR:+alternate}) with ARG scoping (ARGs declared
+before the first FROM are only visible in FROM lines unless re-declared
+in a stage). Parsed Dockerfiles are cached, so each file is only read
+once per process
+"""
+import json
+import re
+from collections import namedtuple
+from pathlib import Path
+
+
+DIRECTIVE_PATTERN = re.compile(r'#\s*([a-zA-Z][a-zA-Z0-9]*)\s*=\s*(.+?)\s*$')
+FLAG_PATTERN = re.compile(r'--([a-zA-Z][\w-]*)(?:=(\S*))?\s*')
+VAR_NAME_PATTERN = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+# instructions whose arguments may be written as a JSON array
+EXEC_FORM_INSTRUCTIONS = ('RUN', 'CMD', 'ENTRYPOINT', 'COPY', 'ADD', 'SHELL', 'VOLUME')
+# instructions whose leading --flag[=value] options are parsed out
+FLAG_INSTRUCTIONS = ('FROM', 'RUN', 'COPY', 'ADD')
+
+# `args` is a list for instructions in exec form, otherwise the raw
+# (unsubstituted) argument string
+Instruction = namedtuple('Instruction', ['keyword', 'flags', 'args', 'exec_form', 'lineno'])
+# value of a build-arg or environment variable, and the names of the
+# build-args it was derived from (including its own)
+Variable = namedtuple('Variable', ['value', 'deps'])
+
+_cache = dict()
+
+
+def _find_closing_brace(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+def _expand(text, i, scope, escape, used):
+    """
+    expands the variable reference starting at text[i] ("$"). Returns
+    its value and the index just past the reference
+    """
+    if text.startswith('${', i):
+        end = _find_closing_brace(text, i + 1)
+        if end == -1:
+            # unterminated, so taken literally
+            return text[i:], len(text)
+
+        expr = text[i + 2:end]
+        match = VAR_NAME_PATTERN.match(expr)
+        if match is None:
+            return text[i:end + 1], end + 1
+
+        name = match.group()
+        modifier = expr[match.end():]
+        variable = scope.get(name)
+        used.add(name)
+        if variable is not None:
+            used.update(variable.deps)
+
+        value = None if variable is None else variable.value
+        for operator in (':-', ':+', '-', '+'):
+            if modifier.startswith(operator):
+                word = _lex(modifier[len(operator):], scope, escape, split=False, used=used)
+                word = word[0] if word else ''
+                if operator == ':-':
+                    value = word if not value else value
+                elif operator == '-':
+                    value = word if value is None else value
+                elif operator == ':+':
+                    value = word if value else ''
+                else:
+                    value = word if value is not None else ''
+                break
+
+        return value or '', end + 1
+
+    match = VAR_NAME_PATTERN.match(text, i + 1)
+    if match is None:
+        return '$', i + 1
+
+    name = match.group()
+    variable = scope.get(name)
+    used.add(name)
+    if variable is None:
+        return '', match.end()
+
+    used.update(variable.deps)
+    return variable.value or '', match.end()
+
+
+def _lex(text, scope, escape='\\', split=True, used=None):
+    """
+    processes quotes, escapes, and variable references in `text` like
+    `docker build` does, and splits it into words on unquoted whitespace
+    (if `split` is True). Names of variables referenced are added to
+    `used`
+    """
+    if used is None:
+        used = set()
+
+    words = list()
+    word = list()
+    in_word = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == escape and i + 1 < len(text):
+            word.append(text[i + 1])
+            in_word = True
+            i += 2
+        elif char == "'":
+            end = text.find("'", i + 1)
+            if end == -1:
+                end = len(text)
+            # no substitution inside single quotes
+            word.append(text[i + 1:end])
+            in_word = True
+            i = end + 1
+        elif char == '"':
+            i += 1
+            while i < len(text) and text[i] != '"':
+                if text[i] == escape and i + 1 < len(text) and text[i + 1] in ('"', '$', escape):
+                    word.append(text[i + 1])
+                    i += 2
+                elif text[i] == '$':
+                    value, i = _expand(text, i, scope, escape, used)
+                    word.append(value)
+                else:
+                    word.append(text[i])
+                    i += 1
+            in_word = True
+            i += 1
+        elif char == '$':
+            value, i = _expand(text, i, scope, escape, used)
+            word.append(value)
+            in_word = True
+        elif char.isspace() and split:
+            if in_word:
+                words.append(''.join(word))
+                word = list()
+                in_word = False
+            i += 1
+        else:
+            word.append(char)
+            in_word = True
+            i += 1
+
+    if in_word:
+        words.append(''.join(word))
+
+    return words
+
+
+class Stage:
+    """a build stage: a FROM instruction and the instructions after it"""
+    def __init__(self, index, base, name, base_deps, parent):
+        self.index = index
+        # image (or earlier stage) the stage is built from, with
+        # variables substituted
+        self.base = base
+        # name given with "FROM <base> AS <name>", if any
+        self.name = name
+        # build-args the base image reference depends on
+        self.base_deps = base_deps
+        # earlier Stage this stage is built from, or None if it's built
+        # from an external image
+        self.parent = parent
+        self.instructions = list()
+        self._args = dict()
+        self._env = dict()
+
+    def __repr__(self):
+        name = '' if self.name is None else f' AS {self.name}'
+        return f'Stage({self.index}: FROM {self.base}{name})'
+
+    @property
+    def root(self):
+        """the stage's earliest ancestor stage, built from an external image"""
+        return self if self.parent is None else self.parent.root
+
+    @property
+    def args(self):
+        """build-args declared in the stage, and their values"""
+        return {name: var.value for name, var in self._args.items()}
+
+    @property
+    def env(self):
+        return {name: var.value for name, var in self._env.items()}
+
+    @property
+    def scope(self):
+        # environment variables take precedence over build-args
+        return dict(self._args, **self._env)
+
+
+class Dockerfile:
+    def __init__(self, text, path=None):
+        self.path = path
+        self.directives = dict()
+        self.escape = '\\'
+        self.instructions = self._parse(text)
+        # build-args (as a sorted tuple of items) -> (global build-args, stages)
+        self._resolved = dict()
+
+    def __repr__(self):
+        return f'Dockerfile({self.path})'
+
+    def _parse(self, text):
+        lines = text.splitlines()
+        # parser directives must come before anything else, including
+        # blank lines and comments
+        n_directives = 0
+        for line in lines:
+            match = DIRECTIVE_PATTERN.match(line)
+            if match is None:
+                break
+            self.directives[match.group(1).lower()] = match.group(2)
+            n_directives += 1
+
+        self.escape = self.directives.get('escape', '\\')
+        instructions = list()
+        logical_line = list()
+        start = None
+        for lineno, line in enumerate(lines[n_directives:], start=n_directives + 1):
+            stripped = line.strip()
+            # comment & empty lines are skipped, even within a
+            # continued instruction
+            if not stripped or stripped.startswith('#'):
+                continue
+            if start is None:
+                start = lineno
+
+            line = line.rstrip()
+            if line.endswith(self.escape):
+                logical_line.append(line[:-1])
+                continue
+
+            logical_line.append(line)
+            instructions.append(self._parse_instruction(''.join(logical_line), start))
+            logical_line = list()
+            start = None
+
+        if logical_line:
+            # file ended with a line continuation
+            instructions.append(self._parse_instruction(''.join(logical_line), start))
+
+        return instructions
+
+    @staticmethod
+    def _parse_instruction(line, lineno):
+        parts = line.strip().split(None, 1)
+        keyword = parts[0].upper()
+        args = parts[1] if len(parts) > 1 else ''
+        flags = dict()
+        if keyword in FLAG_INSTRUCTIONS:
+            match = FLAG_PATTERN.match(args)
+            while match is not None:
+                flags[match.group(1)] = match.group(2)
+                args = args[match.end():]
+                match = FLAG_PATTERN.match(args)
+
+        exec_form = False
+        if keyword in EXEC_FORM_INSTRUCTIONS and args.startswith('['):
+            try:
+                parsed = json.loads(args)
+            except ValueError:
+                # not valid JSON, so treated as shell form
+                pass
+            else:
+                if isinstance(parsed, list) and all(isinstance(a, str) for a in parsed):
+                    args = parsed
+                    exec_form = True
+
+        return Instruction(keyword, flags, args, exec_form, lineno)
+
+    def _split_raw(self, text):
+        """
+        splits `text` into words on unquoted whitespace, leaving quotes,
+        escapes, and variable references in place
+        """
+        words = list()
+        start = None
+        quote = None
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if start is None and not char.isspace():
+                start = i
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in ('"', "'"):
+                quote = char
+            elif char == self.escape:
+                i += 1
+            elif char.isspace() and start is not None:
+                words.append(text[start:i])
+                start = None
+            i += 1
+
+        if start is not None:
+            words.append(text[start:])
+        return words
+
+    def _substitute(self, text, scope):
+        used = set()
+        words = _lex(text, scope, self.escape, split=False, used=used)
+        return (words[0] if words else ''), frozenset(used)
+
+    def resolve(self, build_args=None):
+        """
+        groups the instructions into build stages and resolves the
+        values of build-args and environment variables in each, with
+        `build_args` overriding declared defaults
+        """
+        return self._resolve_cached(build_args)[1]
+
+    def _resolve_cached(self, build_args):
+        build_args = build_args or dict()
+        key = tuple(sorted(build_args.items()))
+        if key not in self._resolved:
+            self._resolved[key] = self._resolve(build_args)
+        return self._resolved[key]
+
+    def _resolve(self, build_args):
+        global_args = dict()
+        stages = list()
+        stage = None
+        for instruction in self.instructions:
+            if instruction.keyword == 'FROM':
+                used = set()
+                words = _lex(instruction.args, global_args, self.escape, used=used)
+                base = words[0] if words else ''
+                name = None
+                if len(words) >= 3 and words[1].lower() == 'as':
+                    name = words[2].lower()
+                # stage names are case-insensitive
+                parent = next((s for s in reversed(stages) if s.name == base.lower()), None)
+                stage = Stage(len(stages), base, name, frozenset(used), parent)
+                stages.append(stage)
+            elif instruction.keyword == 'ARG':
+                if stage is None:
+                    self._declare_args(instruction, global_args, global_args, build_args)
+                else:
+                    self._declare_args(instruction, stage._args, global_args, build_args,
+                                       scope=stage.scope)
+            elif stage is None:
+                # only ARG may come before the first FROM
+                continue
+            elif instruction.keyword == 'ENV':
+                self._set_env(instruction, stage)
+
+            if stage is not None and instruction.keyword != 'FROM':
+                stage.instructions.append(instruction)
+
+        return global_args, stages
+
+    def _declare_args(self, instruction, args, global_args, build_args, scope=None):
+        if scope is None:
+            scope = args
+
+        for raw_word in self._split_raw(instruction.args):
+            name, has_default, raw_default = raw_word.partition('=')
+            if has_default:
+                default, deps = self._substitute(raw_default, scope)
+            elif name in global_args:
+                # re-declaring a global build-arg in a stage inherits its
+                # default
+                default, deps = global_args[name]
+            else:
+                default, deps = None, frozenset()
+
+            args[name] = Variable(build_args.get(name, default), deps | {name})
+
+    def _set_env(self, instruction, stage):
+        # all values are substituted before any are set, so variables
+        # set earlier in the same ENV instruction aren't visible
+        scope = stage.scope
+        raw_words = self._split_raw(instruction.args)
+        if raw_words and '=' not in raw_words[0]:
+            # legacy "ENV <key> <value>" form
+            name = raw_words[0]
+            raw_value = instruction.args.strip()[len(name):].strip()
+            stage._env[name] = Variable(*self._substitute(raw_value, scope))
+            return
+
+        for raw_word in raw_words:
+            name, _, raw_value = raw_word.partition('=')
+            stage._env[name] = Variable(*self._substitute(raw_value, scope))
+
+    @property
+    def stages(self):
+        """build stages, with default build-arg values"""
+        return self.resolve()
+
+    @property
+    def final_stage(self):
+        return self.stages[-1]
+
+    @property
+    def global_args(self):
+        """build-args declared before the first FROM, and their defaults"""
+        return {name: var.value for name, var in self._resolve_cached(None)[0].items()}
+
+    def declares_arg(self, name):
+        """whether a build-arg named `name` is declared anywhere in the file"""
+        return (
+            name in self.global_args or
+            any(name in stage.args for stage in self.stages)
+        )
+
+    def arg_values(self, build_args=None):
+        """
+        values of the build-args that apply to the final image: those
+        declared globally or in the final stage
+        """
+        global_args, stages = self._resolve_cached(build_args)
+        values = {name: var.value for name, var in global_args.items()}
+        values.update(stages[-1].args)
+        return values
+
+    def copy_sources(self, build_args=None):
+        """
+        source paths (relative to the build context) of files COPY'd or
+        ADD'ed into the image. Files copied from other stages or images
+        (COPY --from) aren't included
+        """
+        sources = list()
+        for stage in self.resolve(build_args):
+            for instruction in stage.instructions:
+                if instruction.keyword not in ('COPY', 'ADD') or 'from' in instruction.flags:
+                    continue
+                if instruction.exec_form:
+                    words = instruction.args
+                else:
+                    words = _lex(instruction.args, stage.scope, self.escape)
+                sources.extend(words[:-1])
+
+        return sources
+
+
+def parse_dockerfile(path):
+    """
+    returns the parsed Dockerfile at `path`, re-parsing it only if it
+    has changed since it was last parsed
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _cache.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, Dockerfile(path.read_text(), path=path))
+        _cache[path] = cached
+
+    return cached[1]
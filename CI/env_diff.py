@@ -0,0 +1,220 @@
+"""
+Compares the environments of two images (e.g., the same image built at
+different times, or the default and custom builds of an image): conda,
+pip, and apt packages added, removed, upgraded, or downgraded, changes
+to the conda config, and the change in size of each package. Snapshots
+are read from the introspection cache when available, so containers are
+only started for images that haven't already been inspected
+"""
+import argparse
+import gzip
+import json
+import re
+from pathlib import Path
+
+import docker
+from packaging.version import InvalidVersion, Version
+
+from apt_state import AptState, compare_versions
+from conda_environment import CondaEnvironment
+from introspection_cache import IntrospectionCache
+from snapshot import snapshot_backend, take_snapshot
+
+
+PACKAGE_SOURCES = ('conda', 'pip', 'apt')
+CHANGE_TYPES = ('added', 'removed', 'upgraded', 'downgraded')
+IMAGE_ID_PATTERN = re.compile(r'(sha256:)?[0-9a-f]{64}')
+
+
+def load_snapshot(ref, client=None, backend=None):
+    """
+    returns (image_id, snapshot) for `ref`, which may be a path to a
+    saved snapshot (JSON, optionally gzipped, e.g. an introspection
+    cache entry), an image ID, or an image name. Image IDs are looked up
+    in the introspection cache before contacting the Docker daemon
+    """
+    if backend is None:
+        backend = snapshot_backend()
+
+    path = Path(ref)
+    if path.is_file():
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            return None, json.load(f)
+
+    cache = IntrospectionCache(namespace=backend)
+    if IMAGE_ID_PATTERN.fullmatch(ref):
+        image_id = ref if ref.startswith('sha256:') else f'sha256:{ref}'
+        snapshot = cache.get(image_id)
+        if snapshot is not None:
+            return image_id, snapshot
+
+    if client is None:
+        client = docker.client.from_env()
+
+    image = client.images.get(ref)
+    snapshot = cache.get_or_create(image.id,
+                                   lambda: take_snapshot(client, image.id, backend))
+    return image.id, snapshot
+
+
+def installed_packages(snapshot):
+    """
+    returns {source: {name: (version, size)}} for conda, pip, and apt
+    packages in a snapshot. Sizes are None if unknown
+    """
+    packages = {source: dict() for source in PACKAGE_SOURCES}
+    sizes = snapshot.get('package_sizes') or dict()
+    if snapshot.get('conda_config') is not None:
+        conda_env = CondaEnvironment.from_snapshot(snapshot)
+        for name in conda_env.installed_packages:
+            for pkg in conda_env.installed_packages.get_all(name):
+                size = sizes.get(pkg.source, dict()).get(name)
+                packages[pkg.source][name] = (pkg.version, size)
+
+    for name, pkg in AptState.from_snapshot(snapshot).packages.items():
+        packages['apt'][name] = (pkg.version, pkg.size)
+
+    return packages
+
+
+def _compare_versions(source, old, new):
+    if source != 'apt':
+        try:
+            old_version, new_version = Version(old), Version(new)
+        except InvalidVersion:
+            # conda versions aren't always PEP 440-compliant (e.g.,
+            # openssl's "1.1.1h"), but dpkg's ordering handles them
+            pass
+        else:
+            return (old_version > new_version) - (old_version < new_version)
+
+    return compare_versions(old, new)
+
+
+def _size_delta(old_size, new_size):
+    if old_size is None or new_size is None:
+        return None
+    return new_size - old_size
+
+
+def diff_packages(source, old_packages, new_packages):
+    changes = {change: list() for change in CHANGE_TYPES}
+    for name in sorted(set(old_packages) | set(new_packages)):
+        old_version, old_size = old_packages.get(name, (None, 0))
+        new_version, new_size = new_packages.get(name, (None, 0))
+        if old_version is None:
+            change = 'added'
+        elif new_version is None:
+            change = 'removed'
+        elif old_version == new_version:
+            continue
+        elif _compare_versions(source, old_version, new_version) < 0:
+            change = 'upgraded'
+        else:
+            change = 'downgraded'
+
+        changes[change].append({
+            'name': name,
+            'old_version': old_version,
+            'new_version': new_version,
+            'size_delta': _size_delta(old_size, new_size)
+        })
+
+    return changes
+
+
+def diff_config(old_config, new_config):
+    old_config = old_config or dict()
+    new_config = new_config or dict()
+    changes = dict()
+    for key in sorted(set(old_config) | set(new_config)):
+        old_value = old_config.get(key)
+        new_value = new_config.get(key)
+        if old_value != new_value:
+            changes[key] = {'old': old_value, 'new': new_value}
+
+    return changes
+
+
+def diff_snapshots(old, new):
+    """
+    returns the differences between two snapshots as a JSON-serializable
+    dict
+    """
+    old_packages = installed_packages(old)
+    new_packages = installed_packages(new)
+    diff = {
+        source: diff_packages(source, old_packages[source], new_packages[source])
+        for source in PACKAGE_SOURCES
+    }
+    diff['conda_config'] = diff_config(old.get('conda_config'), new.get('conda_config'))
+    return diff
+
+
+def diff_images(old_ref, new_ref, client=None, backend=None):
+    old_id, old_snapshot = load_snapshot(old_ref, client=client, backend=backend)
+    new_id, new_snapshot = load_snapshot(new_ref, client=client, backend=backend)
+    diff = diff_snapshots(old_snapshot, new_snapshot)
+    diff['old'] = {'ref': old_ref, 'image_id': old_id}
+    diff['new'] = {'ref': new_ref, 'image_id': new_id}
+    return diff
+
+
+def _format_size(size):
+    if size is None:
+        return '?'
+    return f'{size / 1024 ** 2:+.1f} MB'
+
+
+def format_summary(diff):
+    """human-readable summary of the output of `diff_images`"""
+    lines = [f"{diff['old']['ref']} -> {diff['new']['ref']}"]
+    symbols = {'added': '+', 'removed': '-', 'upgraded': '^', 'downgraded': 'v'}
+    for source in PACKAGE_SOURCES:
+        changes = diff[source]
+        entries = [e for change in CHANGE_TYPES for e in changes[change]]
+        if not entries:
+            lines.append(f'{source}: no changes')
+            continue
+
+        deltas = [e['size_delta'] for e in entries]
+        total = None if None in deltas else sum(deltas)
+        counts = ', '.join(f'{len(changes[change])} {change}' for change in CHANGE_TYPES)
+        lines.append(f'{source}: {counts} ({_format_size(total)})')
+        for change in CHANGE_TYPES:
+            for entry in changes[change]:
+                if change == 'added':
+                    versions = entry['new_version']
+                elif change == 'removed':
+                    versions = entry['old_version']
+                else:
+                    versions = f"{entry['old_version']} -> {entry['new_version']}"
+                lines.append(f"  {symbols[change]} {entry['name']} {versions} "
+                             f"({_format_size(entry['size_delta'])})")
+
+    if diff['conda_config']:
+        lines.append('conda config:')
+        for key, values in diff['conda_config'].items():
+            lines.append(f"  ~ {key}: {values['old']} -> {values['new']}")
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old', help="image name, image ID, or saved snapshot file")
+    parser.add_argument('new', help="image name, image ID, or saved snapshot file")
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help="also write the full diff as JSON to this file ('-' for stdout)")
+    parser.add_argument('--backend', choices=['meta', 'conda'], default=None,
+                        help="introspection backend (default: $CONDA_INTROSPECTION or 'meta')")
+    args = parser.parse_args()
+
+    diff = diff_images(args.old, args.new, backend=args.backend)
+    if args.json_path == '-':
+        print(json.dumps(diff, indent=2))
+    else:
+        print(format_summary(diff))
+        if args.json_path is not None:
+            Path(args.json_path).write_text(json.dumps(diff, indent=2))
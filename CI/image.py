@@ -1,3 +1,6 @@
+from dockerfile import parse_dockerfile
+
+
 class Image:
     def __init__(self, name, tree):
         self.name = name
@@ -5,9 +8,15 @@ class Image:
         self.parent = None
         self.children = list()
         self.dirpath = self.tree.root_dir.joinpath(self.name)
-        # CI builds run in parallel as job matrix, divided by Python
-        # version. Some images only get built for specific Python versions
-        self.python_compat = True
+        # Python version the image's parent is pinned to (e.g., "3.6"
+        # for "FROM contextlab/cdl-python:3.6"), if any
+        self.pinned_python = None
+        # whether the Dockerfile takes a PYTHON_VERSION build-arg
+        self.declares_python_version = False
+        # computed on first access, and reset by the tree whenever
+        # images are linked
+        self._ancestors = None
+        self._descendants = None
 
     def __repr__(self):
         return f"Image({self.name})"
@@ -16,37 +25,75 @@ class Image:
         return self.name
 
     @property
-    def ancestors(self):
-        ancs = list()
-        if self.parent is not self.tree.root_image:
-            ancs.extend(self.parent.ancestors)
+    def python_compat(self):
+        # CI builds run in parallel as job matrix, divided by Python
+        # version. Some images only get built for specific Python versions
+        return self.compatible_with(self.tree.python_version)
 
-        ancs.append(self)
-        return ancs
+    @property
+    def python_specific(self):
+        """
+        whether a separate version of the image is built for each Python
+        version (False for images like cdl-base, which are built once)
+        """
+        return (
+            self.declares_python_version or
+            self.pinned_python is not None or
+            (self.parent is not None and self.parent.python_specific)
+        )
+
+    def compatible_with(self, python_version):
+        """whether the image can be built for `python_version`"""
+        if self.pinned_python is not None and self.pinned_python != python_version:
+            return False
+        return self.parent is None or self.parent.compatible_with(python_version)
+
+    @property
+    def ancestors(self):
+        """
+        the image's parent, grandparent, etc. (excluding the root image),
+        outermost first, followed by the image itself
+        """
+        if self._ancestors is None:
+            if self.parent is None or self.parent is self.tree.root_image:
+                self._ancestors = (self,)
+            else:
+                self._ancestors = self.parent.ancestors + (self,)
+
+        return self._ancestors
 
     @property
     def descendants(self):
-        descs = list()
-        for child in self.children:
-            descs.extend(child.descendants)
+        """the image followed by all images built on top of it, depth-first"""
+        if self._descendants is None:
+            descs = (self,)
+            for child in self.children:
+                descs += child.descendants
+            self._descendants = descs
+
+        return self._descendants
+
+    @property
+    def depth(self):
+        """number of images between this one and the root image, plus one"""
+        return len(self.ancestors)
 
-        return [self] + descs
+    def _clear_cache(self):
+        self._ancestors = None
+        self._descendants = None
+
+    @property
+    def dockerfile(self):
+        return parse_dockerfile(self.dirpath.joinpath('Dockerfile'))
 
     def _parse_parent_from_dockerfile(self):
-        def _value_from_arg(var, _dockerfile):
-            # handles instance where base image can bet set via a build-arg
-            var_name = var.lstrip('$')
-            declaration = f'ARG {var_name}='
-            arg_line = next(l for l in _dockerfile if l.startswith(declaration))
-            return arg_line.replace(declaration, '')
-
-        dockerfile = self.dirpath.joinpath('Dockerfile').read_text().splitlines()
-        from_line = next(l for l in dockerfile if l.startswith('FROM'))
-        parent_info = from_line.replace('FROM ', '')
-        if parent_info.startswith('$'):
-            parent_info = _value_from_arg(parent_info, dockerfile)
-
-        image_tag = parent_info.replace('contextlab/', '')
+        dockerfile = self.dockerfile
+        self.declares_python_version = dockerfile.declares_arg('PYTHON_VERSION')
+        # for multi-stage builds, the image's parent is the external
+        # image its final stage is (ultimately) built from. Build-args
+        # in the reference (e.g., "FROM $BASE_IMAGE") take their defaults
+        base_stage = dockerfile.final_stage.root
+        image_tag = base_stage.base.replace('contextlab/', '')
         try:
             parent_image, parent_tag = image_tag.split(':')
         except ValueError:
@@ -57,12 +104,12 @@ class Image:
         if (
                 parent_tag is not None and
                 parent_tag[0].isdigit() and
-                parent_tag != self.tree.python_version
+                'PYTHON_VERSION' not in base_stage.base_deps
         ):
             # if the image's parent is tagged with a pinned Python
-            # version, the image should only be built for that entry in
-            # the job matrix
-            self.python_compat = False
+            # version (rather than one set by the PYTHON_VERSION
+            # build-arg), the image should only be built for that version
+            self.pinned_python = parent_tag
 
         return parent_image
 
@@ -82,3 +129,39 @@ class Image:
             self.children.append(child)
 
 
+class BuildNode:
+    """
+    an Image built for a specific Python version. Images that aren't
+    Python version-specific (e.g., cdl-base) have a single node, with a
+    python_version of None
+    """
+    def __init__(self, image, python_version, parent):
+        self.image = image
+        self.python_version = python_version
+        self.parent = parent
+        self._ancestors = None
+
+    def __repr__(self):
+        return f"BuildNode({self.name}:{self.tag})"
+
+    def __str__(self):
+        return f"{self.name}:{self.tag}"
+
+    @property
+    def name(self):
+        return self.image.name
+
+    @property
+    def tag(self):
+        return 'latest' if self.python_version is None else self.python_version
+
+    @property
+    def ancestors(self):
+        # a node's parent never changes once it's created
+        if self._ancestors is None:
+            if self.parent is None:
+                self._ancestors = (self,)
+            else:
+                self._ancestors = self.parent.ancestors + (self,)
+
+        return self._ancestors
@@ -0,0 +1,353 @@
+"""
+Exports images to (and imports them from) a directory of content-
+addressed, compressed blobs, in place of gzipped `docker save` archives.
+The output of `docker save` is streamed straight into the compressor, so
+the uncompressed archive is never written to disk, and files shared
+between images (e.g., cdl-base's & cdl-python's layers) are only stored
+once. When importing, layers that already exist locally are left out of
+the archive sent to `docker load`
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+from os import getenv
+from pathlib import Path
+
+import docker
+
+from image_tree import ImageTree
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CHUNK_SIZE = 4 * 1024 ** 2
+# files in the archive at most this large (image configs, manifests,
+# etc.) are stored inline in the image's index rather than as blobs
+INLINE_MAX_SIZE = 64 * 1024
+
+
+class ChunkReader(io.RawIOBase):
+    """file-like wrapper around an iterable of bytes chunks"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+
+        n_bytes = min(len(b), len(self._buffer))
+        b[:n_bytes] = self._buffer[:n_bytes]
+        self._buffer = self._buffer[n_bytes:]
+        return n_bytes
+
+
+class HashingReader:
+    """file-like wrapper that hashes (sha256) & counts the bytes read through it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+
+def chain_ids(diff_ids):
+    """
+    layer chain IDs (which identify a layer along with all layers below
+    it) for an image's list of layer diff IDs
+    """
+    chains = list()
+    chain = None
+    for diff_id in diff_ids:
+        if chain is None:
+            chain = diff_id
+        else:
+            chain = 'sha256:' + hashlib.sha256(f'{chain} {diff_id}'.encode()).hexdigest()
+        chains.append(chain)
+
+    return chains
+
+
+class BlobStore:
+    def __init__(self, root_dir, compression=None):
+        self.root_dir = Path(root_dir)
+        self.blob_dir = self.root_dir.joinpath('blobs')
+        self.index_dir = self.root_dir.joinpath('images')
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+        self.compression = compression
+        self.suffix = '.zst' if compression == 'zstd' else '.gz'
+
+    def blob_path(self, digest):
+        # blobs may have been written with either compression
+        for suffix in ('.zst', '.gz'):
+            path = self.blob_dir.joinpath(f'{digest}{suffix}')
+            if path.is_file():
+                return path
+
+        return None
+
+    def write_blob(self, fileobj):
+        """
+        compresses `fileobj` into the store while hashing it. Returns
+        the digest and the number of (compressed) bytes written, or 0 if
+        an identical blob already existed
+        """
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        reader = HashingReader(fileobj)
+        tmp_path = self.blob_dir.joinpath(f'.{os.getpid()}-{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            if self.compression == 'zstd':
+                # compresses in parallel across all cores
+                compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+                compressor.copy_stream(reader, f, read_size=CHUNK_SIZE)
+            else:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gz:
+                    shutil.copyfileobj(reader, gz, CHUNK_SIZE)
+
+        digest = reader.hasher.hexdigest()
+        if self.blob_path(digest) is not None:
+            tmp_path.unlink()
+            return digest, 0
+
+        written = tmp_path.stat().st_size
+        os.replace(tmp_path, self.blob_dir.joinpath(f'{digest}{self.suffix}'))
+        return digest, written
+
+    def open_blob(self, digest):
+        path = self.blob_path(digest)
+        if path is None:
+            raise FileNotFoundError(f"no blob {digest} in {self.blob_dir}")
+        if path.suffix == '.gz':
+            return gzip.open(path, 'rb')
+        elif zstandard is None:
+            raise ValueError(f"reading {path} requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+    def index_path(self, ref):
+        return self.index_dir.joinpath(ref.replace('/', '_').replace(':', '_') + '.json')
+
+    def read_index(self, ref):
+        return json.loads(self.index_path(ref).read_text())
+
+    def write_index(self, ref, index):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path(ref).write_text(json.dumps(index))
+
+    def read_member(self, entry):
+        if entry['type'] == 'inline':
+            return base64.b64decode(entry['content'])
+        with self.open_blob(entry['digest']) as f:
+            return f.read()
+
+
+def _archive_digest(name):
+    """
+    digest of a file in a `docker save` archive if it's named by it (as
+    all files in the OCI layout used by Docker 25+ are), else None
+    """
+    match = re.fullmatch(r'blobs/sha256/([0-9a-f]{64})', name)
+    return match.group(1) if match else None
+
+
+def export_image(client, ref, store):
+    """
+    streams `docker save` output for `ref` into `store`. Returns a dict
+    of transfer stats
+    """
+    image = client.images.get(ref)
+    start = time.time()
+    stats = {'ref': ref, 'bytes_read': 0, 'bytes_written': 0, 'blobs_new': 0,
+             'blobs_reused': 0}
+    members = list()
+    # blobs are named by the digest of their uncompressed content (for
+    # layers, their diff ID), so a layer shared with an image exported
+    # earlier is only stored once. In OCI-layout archives, files are
+    # named by that digest, so stored ones don't need to be read at all
+    archive = io.BufferedReader(ChunkReader(image.save(chunk_size=CHUNK_SIZE, named=ref)),
+                                buffer_size=CHUNK_SIZE)
+    with tarfile.open(fileobj=archive, mode='r|') as tar:
+        for member in tar:
+            entry = {'name': member.name, 'mode': member.mode, 'mtime': member.mtime}
+            if member.isdir():
+                entry['type'] = 'dir'
+            elif member.issym():
+                entry.update(type='symlink', linkname=member.linkname)
+            elif member.islnk():
+                entry.update(type='link', linkname=member.linkname)
+            elif member.size <= INLINE_MAX_SIZE:
+                content = tar.extractfile(member).read()
+                entry.update(type='inline', size=member.size,
+                             content=base64.b64encode(content).decode('ascii'))
+            else:
+                digest = _archive_digest(member.name)
+                if digest is None or store.blob_path(digest) is None:
+                    digest, written = store.write_blob(tar.extractfile(member))
+                else:
+                    written = 0
+
+                if written:
+                    stats['blobs_new'] += 1
+                    stats['bytes_written'] += written
+                else:
+                    stats['blobs_reused'] += 1
+                entry.update(type='blob', size=member.size, digest=digest)
+
+            stats['bytes_read'] += member.size if member.isfile() else 0
+            members.append(entry)
+
+    store.write_index(ref, {'ref': ref, 'image_id': image.id, 'members': members})
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def local_chain_ids(client):
+    """chain IDs of all layers present in the local image store"""
+    chains = set()
+    for image in client.images.list(all=True):
+        chains.update(chain_ids(image.attrs.get('RootFS', dict()).get('Layers', list())))
+
+    return chains
+
+
+def _tar_stream(members, store, stats):
+    """
+    generates a tar archive of `members` in chunks, written from a
+    separate thread through a pipe so it's never held in memory
+    """
+    read_fd, write_fd = os.pipe()
+    errors = list()
+
+    def _write():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe, tarfile.open(fileobj=pipe, mode='w|') as tar:
+                for entry in members:
+                    info = tarfile.TarInfo(entry['name'])
+                    info.mode = entry['mode']
+                    info.mtime = entry['mtime']
+                    if entry['type'] == 'dir':
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                    elif entry['type'] in ('symlink', 'link'):
+                        info.type = tarfile.SYMTYPE if entry['type'] == 'symlink' else tarfile.LNKTYPE
+                        info.linkname = entry['linkname']
+                        tar.addfile(info)
+                    else:
+                        info.size = entry['size']
+                        if entry['type'] == 'inline':
+                            tar.addfile(info, io.BytesIO(base64.b64decode(entry['content'])))
+                        else:
+                            with store.open_blob(entry['digest']) as blob:
+                                tar.addfile(info, blob)
+                        stats['bytes_loaded'] += entry['size']
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_write, daemon=True)
+    thread.start()
+    with os.fdopen(read_fd, 'rb') as pipe:
+        while True:
+            chunk = pipe.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def import_image(client, ref, store, present_chains=None):
+    """
+    loads `ref` from `store`, leaving out layers that already exist
+    locally. Returns a dict of transfer stats
+    """
+    if present_chains is None:
+        present_chains = local_chain_ids(client)
+
+    start = time.time()
+    index = store.read_index(ref)
+    members = {entry['name']: entry for entry in index['members']}
+    manifest = json.loads(store.read_member(members['manifest.json']))[0]
+    config = json.loads(store.read_member(members[manifest['Config']]))
+    # `docker load` only reads a layer's file if the layer (identified
+    # by its chain ID) isn't already in the local store
+    skip = {layer_path
+            for layer_path, chain in zip(manifest['Layers'],
+                                         chain_ids(config['rootfs']['diff_ids']))
+            if chain in present_chains}
+
+    stats = {'ref': ref, 'layers_total': len(manifest['Layers']), 'layers_skipped': len(skip),
+             'bytes_loaded': 0}
+    to_send = [entry for entry in index['members'] if entry['name'] not in skip]
+    client.images.load(_tar_stream(to_send, store, stats))
+    present_chains.update(chain_ids(config['rootfs']['diff_ids']))
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('images',
+                        help="colon-separated list of images (e.g., cdl-python:cdl-jupyter)")
+    parser.add_argument('--store', default=getenv('IMAGE_DIR'),
+                        help="directory to export to/import from (default: $IMAGE_DIR)")
+    parser.add_argument('-p', '--python-versions', default=getenv('PYTHON_VERSION'),
+                        help="comma-separated list of Python versions (default: $PYTHON_VERSION)")
+    parser.add_argument('--org', default=getenv('DOCKER_HUB_ORG', 'contextlab'))
+    parser.add_argument('--compression', choices=['zstd', 'gzip'], default=None,
+                        help="(default: zstd if the zstandard package is installed, else gzip)")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    image_tree = ImageTree.load(args.repo_root)
+    # parents are listed before children, so shared layers are stored
+    # (or loaded) once, by the first image that has them
+    nodes = image_tree.build_nodes(args.python_versions.split(','), args.images.split(':'))
+    refs = [f'{args.org}/{node}' for node in nodes]
+    client = docker.client.from_env()
+    store = BlobStore(args.store, compression=args.compression)
+    if args.action == 'export':
+        for ref in refs:
+            print(f"exporting {ref}...")
+            stats = export_image(client, ref, store)
+            print(f"  read {stats['bytes_read'] / 1024 ** 2:.1f} MB, wrote "
+                  f"{stats['bytes_written'] / 1024 ** 2:.1f} MB ({stats['blobs_new']} new, "
+                  f"{stats['blobs_reused']} reused blobs) in {stats['seconds']:.0f} seconds")
+    else:
+        present_chains = local_chain_ids(client)
+        for ref in refs:
+            print(f"importing {ref}...")
+            stats = import_image(client, ref, store, present_chains=present_chains)
+            print(f"  loaded {stats['layers_total'] - stats['layers_skipped']} of "
+                  f"{stats['layers_total']} layers ({stats['bytes_loaded'] / 1024 ** 2:.1f} MB) "
+                  f"in {stats['seconds']:.0f} seconds")
@@ -1,33 +1,173 @@
 """
-Implements a simple m-ary tree of image dependencies
+Implements a simple m-ary tree of image dependencies. The tree can be
+saved to a small index file and loaded from it without re-parsing every
+Dockerfile, as long as none of their contents have changed
 """
+import hashlib
+import json
+import os
 from os import getenv
 from pathlib import Path
 
-from image import Image
+from image import BuildNode, Image
+
+
+DEFAULT_INDEX_PATH = Path.home().joinpath('.cache', 'cdl-docker-stacks', 'image-tree.json')
+# bump when the index format changes, to invalidate existing indexes
+INDEX_VERSION = 2
+
+
+def _dockerfile_paths(root_dir):
+    return sorted(Path(root_dir).rglob('Dockerfile'))
+
+
+def _dockerfile_hashes(root_dir):
+    # hashes of contents rather than mtimes, which are reset by every
+    # fresh checkout (e.g., in each CI job)
+    return {str(path.relative_to(root_dir)): hashlib.sha256(path.read_bytes()).hexdigest()
+            for path in _dockerfile_paths(root_dir)}
 
 
 class ImageTree:
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, index=None):
         self.root_dir = Path(root_dir)
         self.images = dict()
+        # (image name, Python version) -> BuildNode
+        self.nodes = dict()
         self.root_image = None
         self.python_version = getenv("PYTHON_VERSION")
+        # computed on first access, and reset whenever images are linked
+        self._order = None
+        self._closure = None
 
-        self._create_tree()
+        if index is None:
+            self._create_tree()
+        else:
+            self._create_tree_from_index(index)
 
     def _create_tree(self):
-        dockerfile_paths = self.root_dir.rglob('Dockerfile')
-        dockerfile_paths = list(dockerfile_paths)
-        for df_path in dockerfile_paths:
+        for df_path in _dockerfile_paths(self.root_dir):
             image_name = df_path.parent.name
             image = self.get_image(image_name, create_new=True)
             image.add_to_tree()
 
+    def _create_tree_from_index(self, index):
+        for image_name, entry in index['images'].items():
+            image = Image(image_name, tree=self)
+            image.pinned_python = entry['pinned_python']
+            image.declares_python_version = entry['declares_python_version']
+            self.images[image_name] = image
+            if entry['parent'] is None:
+                image.dirpath = None
+                self.root_image = image
+
+        for image_name, entry in index['images'].items():
+            if entry['parent'] is not None:
+                self.link_images(parent=entry['parent'], child=image_name)
+
+    def to_index(self):
+        """
+        returns a JSON-serializable dict from which the tree can be
+        rebuilt without parsing Dockerfiles
+        """
+        return {
+            'version': INDEX_VERSION,
+            'root_dir': str(self.root_dir.resolve()),
+            'dockerfiles': _dockerfile_hashes(self.root_dir),
+            'images': {
+                image.name: {
+                    'parent': None if image.parent is None else image.parent.name,
+                    'pinned_python': image.pinned_python,
+                    'declares_python_version': image.declares_python_version
+                } for image in self.images.values()
+            },
+            'order': [image.name for image in self.topological_order]
+        }
+
+    def write_index(self, index_path=None):
+        if index_path is None:
+            index_path = getenv('IMAGE_TREE_INDEX', DEFAULT_INDEX_PATH)
+
+        index_path = Path(index_path)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so concurrent readers (e.g.,
+        # pytest-xdist workers) never see a partial index
+        tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(self.to_index(), indent=2))
+        os.replace(tmp_path, index_path)
+        return index_path
+
+    @classmethod
+    def from_index(cls, root_dir, index_path=None):
+        """
+        loads the tree from an index file written by `write_index`.
+        Raises a ValueError if the index is out of date (i.e., a
+        Dockerfile was added, removed, or modified since it was written)
+        """
+        if index_path is None:
+            index_path = getenv('IMAGE_TREE_INDEX', DEFAULT_INDEX_PATH)
+
+        index = json.loads(Path(index_path).read_text())
+        root_dir = Path(root_dir)
+        if (
+                index.get('version') != INDEX_VERSION or
+                index.get('root_dir') != str(root_dir.resolve())
+        ):
+            raise ValueError(f"{index_path} was written for a different "
+                             f"repository or index version")
+
+        if index['dockerfiles'] != _dockerfile_hashes(root_dir):
+            raise ValueError(f"{index_path} is out of date")
+
+        return cls(root_dir, index=index)
+
+    @classmethod
+    def load(cls, root_dir, index_path=None):
+        """
+        loads the tree from the index file if it's up to date, otherwise
+        parses the Dockerfiles and (re)writes the index
+        """
+        try:
+            return cls.from_index(root_dir, index_path=index_path)
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        tree = cls(root_dir)
+        try:
+            tree.write_index(index_path)
+        except OSError:
+            # e.g., read-only home directory. The index is just a cache
+            pass
+
+        return tree
+
     @property
     def all_images(self):
         return self.get_dependents(self.root_image.children[0])
 
+    @property
+    def topological_order(self):
+        """
+        all images except the root image, sorted so each comes after its
+        parent (shallowest first, ties in depth-first order)
+        """
+        if self._order is None:
+            descendants = self.root_image.children[0].descendants
+            self._order = tuple(sorted(descendants, key=lambda img: img.depth))
+        return self._order
+
+    @property
+    def closure(self):
+        """maps each image's name to the set of its descendants' names (including itself)"""
+        if self._closure is None:
+            self._closure = {name: frozenset(desc.name for desc in image.descendants)
+                             for name, image in self.images.items()}
+        return self._closure
+
+    def is_ancestor(self, ancestor, image):
+        """whether `image` is `ancestor` or is built on top of it"""
+        return str(image) in self.closure[str(ancestor)]
+
     def create_image(self, image_name):
         image = Image(image_name, tree=self)
         image.add_to_tree()
@@ -40,18 +180,62 @@ class ImageTree:
         elif isinstance(edited_img_names, Image):
             edited_img_names = [str(edited_img_names)]
 
-        dependent_imgs = list()
+        dependents = set()
         for img_name in edited_img_names:
             # image must exist at this point, or raise error
-            image = self.get_image(img_name, create_new=False)
-            dependent_imgs.extend(image.descendants)
+            self.get_image(img_name, create_new=False)
+            dependents.update(self.closure[img_name])
+
+        # topological_order is sorted by number of intermediate parents
+        # between each image & self.root_image. Filter out images not
+        # compatible with current CI build's Python version
+        return [img.name for img in self.topological_order
+                if img.name in dependents and img.python_compat]
+
+    def get_node(self, image, python_version):
+        """
+        returns the BuildNode for `image` built for `python_version`,
+        linked to its parent's node for the same Python version (or the
+        version the parent is pinned to)
+        """
+        if not isinstance(image, Image):
+            image = self.get_image(image)
+        if not image.compatible_with(python_version):
+            raise ValueError(f"{image} can't be built for Python {python_version}")
+        if not image.python_specific:
+            python_version = None
+
+        key = (image.name, python_version)
+        if key not in self.nodes:
+            if image.parent is self.root_image:
+                parent_node = None
+            else:
+                parent_node = self.get_node(image.parent, python_version)
+            self.nodes[key] = BuildNode(image, python_version, parent_node)
 
-        unique_deps = list(set(dependent_imgs))
-        # sort by number of intermediate parents between image and self.root_image
-        sorted_deps = sorted(unique_deps, key=lambda img: len(img.ancestors))
-        # filter out images not compatible with current CI build's Python version
-        compat_deps = [img.name for img in sorted_deps if img.python_compat]
-        return compat_deps
+        return self.nodes[key]
+
+    def build_nodes(self, python_versions, images=None):
+        """
+        returns the BuildNodes for every compatible combination of
+        `images` (default: all images) and `python_versions`, sorted so
+        parents come before their children. Images that aren't Python
+        version-specific are only included once
+        """
+        if images is None:
+            images = self.root_image.children[0].descendants
+
+        nodes = list()
+        for python_version in python_versions:
+            for image in images:
+                if not isinstance(image, Image):
+                    image = self.get_image(image)
+                if image.compatible_with(python_version):
+                    node = self.get_node(image, python_version)
+                    if node not in nodes:
+                        nodes.append(node)
+
+        return sorted(nodes, key=lambda node: len(node.ancestors))
 
     def get_image(self, image_name, create_new=False):
         try:
@@ -69,11 +253,15 @@ class ImageTree:
         if not isinstance(child, Image):
             child = self.get_image(child, create_new=True)
 
-        if not parent.python_compat:
-            child.python_compat = False
-
         parent.add_child(child)
         child.add_parent(parent)
+        self._clear_cache()
+
+    def _clear_cache(self):
+        for image in self.images.values():
+            image._clear_cache()
+        self._order = None
+        self._closure = None
 
     # def get_structure(self, root_image=None):
     #     if root_image is None:
@@ -89,3 +277,21 @@ class ImageTree:
     #         root_image = self.root_image
     #
     #     structure = self.get_structure(root_image=root_image)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--index', default=None,
+                        help=f"index file to refresh (default: $IMAGE_TREE_INDEX "
+                             f"or {DEFAULT_INDEX_PATH})")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    # writes the index if it's missing or out of date, and lists images
+    # with parents before children
+    image_tree = ImageTree.load(args.repo_root, index_path=args.index)
+    print('\n'.join(image.name for image in image_tree.topological_order))
@@ -0,0 +1,223 @@
+"""
+Imports the top-level modules of every installed conda & pip package to
+catch packages that are installed but broken, and profiles how long each
+takes to import. All imports run in a single container, in parallel, each
+in a fresh interpreter with `-X importtime` (on Python 3.6, which doesn't
+support it, only each module's total import time is measured)
+"""
+import argparse
+import json
+import sys
+
+
+DEFAULT_TIMEOUT = 120
+# entries per module in the import-time profile
+PROFILE_SIZE = 10
+
+# run inside the container with a JSON {"conda": [names], "pip": [names]}
+# argument (must be compatible with every Python version images are built
+# for). Maps each package to the top-level modules it installed into
+# site-packages, imports them all, and prints the results as JSON
+SWEEP_SCRIPT = """
+import json, os, re, subprocess, sys, sysconfig
+from concurrent.futures import ThreadPoolExecutor
+
+packages, workers, timeout, profile_size = json.loads(sys.argv[1])
+prefix = sys.prefix
+site_packages = sysconfig.get_paths()['purelib']
+site_rel = os.path.relpath(site_packages, prefix) + '/'
+importtime = sys.version_info >= (3, 7)
+# not meant to be imported (or imported only by their packages' tests)
+skip = {'test', 'tests', 'testing', 'docs', 'doc', 'examples', 'benchmarks', 'setup'}
+
+def canonical(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def top_level(path):
+    name = path.split('/', 1)[0]
+    if '/' not in path:
+        if not path.endswith(('.py', '.so')):
+            return None
+        name = path.split('.', 1)[0]
+    if name.isidentifier() and not name.startswith('_') and name not in skip:
+        return name
+    return None
+
+def conda_files():
+    meta_dir = os.path.join(prefix, 'conda-meta')
+    for fname in os.listdir(meta_dir):
+        if fname.endswith('.json'):
+            with open(os.path.join(meta_dir, fname)) as f:
+                record = json.load(f)
+            files = [p[len(site_rel):] for p in record.get('files', [])
+                     if p.startswith(site_rel)]
+            yield record['name'], files
+
+def pip_files():
+    for dname in os.listdir(site_packages):
+        info_dir = os.path.join(site_packages, dname)
+        # "-" in names is escaped as "_" in dist-info & egg-info names
+        if dname.endswith('.dist-info'):
+            listing, sep = 'RECORD', ','
+            name = dname[:-len('.dist-info')].rsplit('-', 1)[0]
+        elif dname.endswith('.egg-info') and os.path.isdir(info_dir):
+            listing, sep = 'top_level.txt', None
+            name = dname[:-len('.egg-info')].split('-', 1)[0]
+        else:
+            continue
+        try:
+            with open(os.path.join(info_dir, listing)) as f:
+                lines = [l.strip() for l in f if l.strip()]
+        except OSError:
+            continue
+        if sep is None:
+            yield name, [l + '/' for l in lines]
+        else:
+            yield name, [l.split(sep, 1)[0] for l in lines]
+
+modules = {}
+for source, listing in (('conda', conda_files), ('pip', pip_files)):
+    wanted = {canonical(name): name for name in packages.get(source, [])}
+    if not wanted:
+        continue
+    for name, files in listing():
+        package = wanted.get(canonical(name))
+        if package is None:
+            continue
+        for path in files:
+            module = top_level(path)
+            if module is not None:
+                modules.setdefault(module, package)
+
+code = ('import time; start = time.perf_counter(); import {}; '
+        'print(time.perf_counter() - start)')
+
+def sweep(module):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else [])
+    cmd += ['-c', code.format(module)]
+    result = {'module': module, 'package': modules[module], 'seconds': None,
+              'error': None, 'profile': []}
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result['error'] = 'timed out after {} seconds'.format(timeout)
+        return result
+    errors = []
+    profile = []
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:'):
+            fields = line[len('import time:'):].split('|')
+            if fields[0].strip().isdigit():
+                profile.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+        else:
+            errors.append(line)
+    if proc.returncode != 0:
+        result['error'] = '\\n'.join(errors[-5:]) or 'exit code {}'.format(proc.returncode)
+    else:
+        result['seconds'] = float(proc.stdout.split()[-1])
+    result['profile'] = sorted(profile, key=lambda p: p[1], reverse=True)[:profile_size]
+    return result
+
+with ThreadPoolExecutor(max_workers=workers or len(os.sched_getaffinity(0))) as pool:
+    results = list(pool.map(sweep, sorted(modules)))
+
+print(json.dumps({'python_version': sys.version.split()[0],
+                  'importtime': importtime,
+                  'results': results}))
+"""
+
+
+class ImportSweep:
+    def __init__(self, sweep):
+        self.python_version = sweep['python_version']
+        # whether per-module profiles are available (Python 3.7+)
+        self.importtime = sweep['importtime']
+        self.results = sweep['results']
+
+    @property
+    def failures(self):
+        """results for modules that couldn't be imported"""
+        return [r for r in self.results if r['error'] is not None]
+
+    def slowest(self, n=20):
+        """(module, package, seconds) for the slowest imports"""
+        timed = [(r['module'], r['package'], r['seconds'])
+                 for r in self.results if r['seconds'] is not None]
+        return sorted(timed, key=lambda r: r[2], reverse=True)[:n]
+
+    def report(self, n=20):
+        lines = [f'imported {len(self.results) - len(self.failures)} of '
+                 f'{len(self.results)} modules (Python {self.python_version})']
+        if self.failures:
+            lines.append('failed to import:')
+            for result in self.failures:
+                error = result['error'].replace('\n', '\n      ')
+                lines.append(f'  {result["module"]} ({result["package"]}):\n      {error}')
+
+        lines.append('slowest imports:')
+        profiles = {r['module']: r['profile'] for r in self.results}
+        for module, package, seconds in self.slowest(n):
+            lines.append(f'  {seconds:8.3f}s  {module} ({package})')
+            # largest contributors by self time, from -X importtime
+            for name, self_us, _ in profiles[module][:3]:
+                lines.append(f'             {self_us / 1e6:8.3f}s  {name}')
+
+        return '\n'.join(lines)
+
+
+def sweep_imports(container, packages, workers=None, timeout=DEFAULT_TIMEOUT):
+    """
+    imports the top-level modules of each of `packages` (installed
+    conda_environment.Packages) in a single container, `workers` at a
+    time (default: one per available CPU). Returns an ImportSweep
+    """
+    names = dict()
+    for pkg in packages:
+        names.setdefault(pkg.source or 'conda', list()).append(pkg.name)
+
+    args = json.dumps([names, workers, timeout, PROFILE_SIZE])
+    # a sweep of every package can take much longer than commands run in
+    # sessions are allowed to, so this always runs in a new container
+    # (max_wait=-1) and is only limited by the per-import timeout
+    output = container.run(command=[SWEEP_SCRIPT, args],
+                           shell='python',
+                           detach=False,
+                           remove=True,
+                           tty=False,
+                           max_wait=-1)
+    return ImportSweep(json.loads(output.splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('image', help="image tag or ID")
+    parser.add_argument('-n', '--top', type=int, default=20,
+                        help="number of slowest imports to list")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="imports to run at once (default: one per CPU)")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="max seconds per import (default: %(default)s)")
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help="also write the full results as JSON to this file")
+    args = parser.parse_args()
+
+    # imported here because conda_environment imports this module
+    import docker
+    from conda_environment import CondaEnvironment
+    from container import Container
+
+    image = docker.client.from_env().images.get(args.image)
+    container = Container(image, sessions=0)
+    try:
+        conda_env = CondaEnvironment(container)
+        sweep = conda_env.import_sweep(workers=args.workers, timeout=args.timeout)
+    finally:
+        container.close()
+
+    print(sweep.report(args.top))
+    if args.json_path is not None:
+        with open(args.json_path, 'w') as f:
+            json.dump(sweep.results, f, indent=2)
+
+    sys.exit(1 if sweep.failures else 0)
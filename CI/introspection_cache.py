@@ -0,0 +1,126 @@
+"""
+On-disk cache of image introspection snapshots, keyed by the image's
+content digest. Since images are immutable, a snapshot never needs to be
+recomputed for the same image ID
+"""
+import fcntl
+import gzip
+import json
+import os
+from contextlib import contextmanager
+from os import getenv
+from pathlib import Path
+
+from snapshot import SNAPSHOT_VERSION
+
+
+DEFAULT_CACHE_DIR = Path.home().joinpath('.cache', 'cdl-docker-stacks', 'introspection')
+DEFAULT_MAX_SIZE_MB = 64
+
+
+class IntrospectionCache:
+    def __init__(self, cache_dir=None, max_size_mb=None, enabled=None, namespace=None):
+        if cache_dir is None:
+            cache_dir = getenv('INTROSPECTION_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_size_mb is None:
+            max_size_mb = float(getenv('INTROSPECTION_CACHE_MAX_MB', DEFAULT_MAX_SIZE_MB))
+        if enabled is None:
+            # set NO_INTROSPECTION_CACHE to any non-empty value to bypass
+            enabled = not getenv('NO_INTROSPECTION_CACHE')
+
+        self.cache_dir = Path(cache_dir)
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        self.enabled = enabled
+        # separates entries created by different introspection backends
+        self.namespace = namespace
+
+    def _path(self, image_id):
+        digest = image_id.split(':')[-1]
+        prefix = f'v{SNAPSHOT_VERSION}'
+        if self.namespace is not None:
+            prefix = f'{prefix}-{self.namespace}'
+        return self.cache_dir.joinpath(f'{prefix}-{digest}.json.gz')
+
+    @contextmanager
+    def lock(self, image_id):
+        """
+        exclusive lock on the entry for `image_id`, so that when tests
+        are run across multiple processes, only one of them introspects
+        the image and the rest read the result from the cache
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        lock_path = self._path(image_id).with_suffix('.lock')
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, image_id):
+        """returns the cached snapshot for `image_id`, or None"""
+        if not self.enabled:
+            return None
+
+        path = self._path(image_id)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, EOFError, ValueError):
+            # missing, or partially written/corrupted
+            return None
+
+        # bump modification time so eviction is least-recently-used
+        path.touch()
+        return snapshot
+
+    def get_or_create(self, image_id, create):
+        """
+        returns the cached snapshot for `image_id`, calling `create()`
+        to take (and cache) a new one if there isn't one
+        """
+        with self.lock(image_id):
+            snapshot = self.get(image_id)
+            if snapshot is None:
+                snapshot = create()
+                self.put(image_id, snapshot)
+
+        return snapshot
+
+    def put(self, image_id, snapshot):
+        if not self.enabled:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(image_id)
+        # write to a temporary file first so concurrent readers never
+        # see a partially written entry
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = list()
+        for path in self.cache_dir.glob('*.json.gz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -0,0 +1,336 @@
+"""
+Indexes the contents of each of an image's layers (the path and size of
+every file, and a content hash of larger ones) by streaming `docker save` output, without
+writing the archive or its layers to disk. The index is used to find
+what makes an image large: its largest files, files duplicated at
+different paths, files overwritten or deleted by later layers (which
+still take up space in the layers below), and known kinds of bloat
+(package caches, bytecode, static libraries, test suites, etc.).
+Indexes are cached on disk by image ID
+"""
+import argparse
+import hashlib
+import io
+import json
+import re
+import sys
+import tarfile
+from collections import defaultdict
+from os import getenv
+from pathlib import Path, PurePosixPath
+
+import docker
+
+from image_transfer import CHUNK_SIZE, ChunkReader, HashingReader
+from introspection_cache import IntrospectionCache
+
+
+DEFAULT_CACHE_DIR = Path.home().joinpath('.cache', 'cdl-docker-stacks', 'layers')
+DEFAULT_CACHE_MAX_MB = 256
+# only files at least this large are hashed (and so can be found as
+# duplicates). Smaller files aren't worth de-duplicating
+HASH_MIN_SIZE = 16 * 1024
+# members of the `docker save` archive at most this large are kept in
+# memory until the manifest has been read (as are all JSON members,
+# i.e. configs & manifests, regardless of size)
+SMALL_MEMBER_SIZE = 64 * 1024
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+# paths (relative to the filesystem root) of files that usually
+# shouldn't be shipped in an image
+BLOAT_CATEGORIES = {
+    'conda_pkgs': re.compile(r'(^|/)conda/pkgs/'),
+    'pip_cache': re.compile(r'(^|/)\.cache/pip/'),
+    'apt_lists': re.compile(r'^var/lib/apt/lists/(?!lock$|partial/$)'),
+    'apt_archives': re.compile(r'^var/cache/apt/archives/.+\.deb$'),
+    'pycache': re.compile(r'(^|/)__pycache__/'),
+    'static_libs': re.compile(r'\.a$'),
+    'test_dirs': re.compile(r'/site-packages/.+/tests?/'),
+}
+
+
+def _index_layer(fileobj):
+    """
+    indexes a single layer tarball. Returns the layer's sha256 digest
+    (its diff ID) and a dict of its files, whiteouts & opaque dirs
+    """
+    reader = HashingReader(fileobj)
+    files = list()
+    deleted = list()
+    opaque = list()
+    with tarfile.open(fileobj=reader, mode='r|') as tar:
+        for member in tar:
+            name = member.name[2:] if member.name.startswith('./') else member.name
+            path = PurePosixPath(name.lstrip('/'))
+            if path.name == OPAQUE_WHITEOUT:
+                opaque.append(str(path.parent))
+            elif path.name.startswith(WHITEOUT_PREFIX):
+                deleted.append(str(path.parent.joinpath(path.name[len(WHITEOUT_PREFIX):])))
+            elif member.isfile():
+                digest = None
+                if member.size >= HASH_MIN_SIZE:
+                    file_hasher = hashlib.blake2b(digest_size=16)
+                    contents = tar.extractfile(member)
+                    for chunk in iter(lambda: contents.read(CHUNK_SIZE), b''):
+                        file_hasher.update(chunk)
+                    digest = file_hasher.hexdigest()
+                files.append([str(path), member.size, digest])
+            elif member.issym() or member.islnk():
+                files.append([str(path), 0, None])
+
+    # consume the end-of-archive padding so the digest covers the
+    # whole layer
+    while reader.read(CHUNK_SIZE):
+        pass
+
+    layer = {'files': files, 'deleted': deleted, 'opaque': opaque}
+    return f'sha256:{reader.hasher.hexdigest()}', layer
+
+
+def build_index(client, ref):
+    """
+    streams `ref` from the Docker daemon and indexes each of its layers.
+    Returns a JSON-serializable dict
+    """
+    image = client.images.get(ref) if isinstance(ref, str) else ref
+    archive = io.BufferedReader(ChunkReader(image.save(chunk_size=CHUNK_SIZE)),
+                                buffer_size=CHUNK_SIZE)
+    # archive paths -> layer indexes & small (e.g., JSON) members. The
+    # manifest that says which is which may come last in the archive
+    layers = dict()
+    small_members = dict()
+    with tarfile.open(fileobj=archive, mode='r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            contents = tar.extractfile(member)
+            # an image's config can be larger than SMALL_MEMBER_SIZE (e.g.,
+            # with a long history), but is never a valid layer
+            if member.size <= SMALL_MEMBER_SIZE or contents.peek(1)[:1] in (b'{', b'['):
+                small_members[member.name] = contents.read()
+            else:
+                try:
+                    layers[member.name] = _index_layer(contents)
+                except tarfile.ReadError:
+                    # not a layer
+                    pass
+
+    manifest = json.loads(small_members['manifest.json'])[0]
+    config = json.loads(small_members[manifest['Config']])
+    # history entries that created a layer, oldest first
+    history = [entry for entry in config.get('history', list())
+               if not entry.get('empty_layer')]
+    indexed_layers = list()
+    for ix, layer_path in enumerate(manifest['Layers']):
+        if layer_path not in layers:
+            # small enough to have been kept in memory
+            layers[layer_path] = _index_layer(io.BytesIO(small_members[layer_path]))
+
+        diff_id, layer = layers[layer_path]
+        layer['diff_id'] = diff_id
+        layer['created_by'] = history[ix].get('created_by', '') if ix < len(history) else ''
+        indexed_layers.append(layer)
+
+    return {'image_id': image.id, 'layers': indexed_layers}
+
+
+class LayerIndex:
+    def __init__(self, index):
+        self.image_id = index['image_id']
+        self.layers = index['layers']
+        self._final = None
+        self._overwritten = None
+        self._deleted = None
+
+    def _apply_layers(self):
+        # path -> (layer index, size, digest) of files in the final
+        # filesystem, and files from lower layers hidden by upper ones
+        files = dict()
+        overwritten = list()
+        deleted = list()
+        for ix, layer in enumerate(self.layers):
+            removed = set(layer['deleted'])
+            hidden_dirs = removed | set(layer['opaque'])
+            if hidden_dirs:
+                for path in list(files):
+                    parent = path
+                    while parent:
+                        if parent in hidden_dirs and (parent != path or path in removed):
+                            deleted.append((path, files.pop(path), ix))
+                            break
+                        parent = parent.rpartition('/')[0]
+
+            for path, size, digest in layer['files']:
+                if path in files:
+                    overwritten.append((path, files[path], ix))
+                files[path] = (ix, size, digest)
+
+        self._final = files
+        self._overwritten = overwritten
+        self._deleted = deleted
+
+    @property
+    def files(self):
+        """path -> (layer index, size, digest) for files in the final image"""
+        if self._final is None:
+            self._apply_layers()
+        return self._final
+
+    @property
+    def overwritten(self):
+        """
+        (path, (layer index, size, digest), overwriting layer index) for
+        files replaced by a later layer
+        """
+        if self._overwritten is None:
+            self._apply_layers()
+        return self._overwritten
+
+    @property
+    def deleted(self):
+        """
+        (path, (layer index, size, digest), deleting layer index) for
+        files deleted by a later layer
+        """
+        if self._deleted is None:
+            self._apply_layers()
+        return self._deleted
+
+    @property
+    def total_size(self):
+        """size of every file in every layer, including hidden ones"""
+        return sum(size for layer in self.layers for _, size, _ in layer['files'])
+
+    @property
+    def wasted_size(self):
+        """size of files in lower layers that are hidden by later layers"""
+        return (sum(info[1] for _, info, _ in self.overwritten) +
+                sum(info[1] for _, info, _ in self.deleted))
+
+    def largest_files(self, n=20):
+        return sorted(((path, size, ix) for path, (ix, size, _) in self.files.items()),
+                      key=lambda f: f[1], reverse=True)[:n]
+
+    def duplicates(self):
+        """
+        groups of files in the final image with identical contents,
+        sorted by the space that would be saved by de-duplicating them
+        """
+        by_digest = defaultdict(list)
+        for path, (ix, size, digest) in self.files.items():
+            if digest is not None:
+                by_digest[digest].append((path, size, ix))
+
+        groups = [group for group in by_digest.values() if len(group) > 1]
+        return sorted(groups, key=lambda g: g[0][1] * (len(g) - 1), reverse=True)
+
+    def bloat(self):
+        """
+        category -> (total size, number of files) for BLOAT_CATEGORIES,
+        across all layers. Files deleted by a later layer are counted,
+        since they're still shipped in the layer that added them
+        """
+        totals = {category: [0, 0] for category in BLOAT_CATEGORIES}
+        for layer in self.layers:
+            for path, size, _ in layer['files']:
+                for category, pattern in BLOAT_CATEGORIES.items():
+                    if pattern.search(path):
+                        totals[category][0] += size
+                        totals[category][1] += 1
+
+        return {category: tuple(total) for category, total in totals.items()}
+
+    def check_budgets(self, budgets_mb):
+        """
+        compares bloat category sizes (plus 'wasted', the size of
+        overwritten & deleted files, and 'total', the size of all
+        layers) against `budgets_mb` ({category: max MB}). Returns a
+        list of messages for each budget exceeded
+        """
+        sizes = {category: size for category, (size, _) in self.bloat().items()}
+        sizes['wasted'] = self.wasted_size
+        sizes['total'] = self.total_size
+        violations = list()
+        for category, budget in budgets_mb.items():
+            if category not in sizes:
+                raise ValueError(f"unknown bloat category: {category}")
+            size_mb = sizes[category] / 1024 ** 2
+            if size_mb > budget:
+                violations.append(f'{category}: {size_mb:.1f} MB (budget: {budget} MB)')
+
+        return violations
+
+    def assert_within(self, budgets_mb):
+        """
+        raises an AssertionError listing every budget in `budgets_mb`
+        that's exceeded (see `check_budgets`), followed by the report
+        """
+        violations = self.check_budgets(budgets_mb)
+        if violations:
+            raise AssertionError('\n'.join(violations) + '\n' + self.report())
+
+    def report(self, n=20):
+        mb = 1024 ** 2
+        lines = [f'{len(self.files)} files in {len(self.layers)} layers, '
+                 f'{self.total_size / mb:.1f} MB total, '
+                 f'{self.wasted_size / mb:.1f} MB overwritten or deleted by later layers']
+        lines.append('largest files:')
+        for path, size, ix in self.largest_files(n):
+            lines.append(f'  {size / mb:8.1f} MB  /{path} (layer {ix})')
+
+        lines.append('duplicate files:')
+        for group in self.duplicates()[:n]:
+            wasted = group[0][1] * (len(group) - 1)
+            paths = ', '.join(f'/{path}' for path, _, _ in group)
+            lines.append(f'  {wasted / mb:8.1f} MB  {paths}')
+
+        lines.append('overwritten or deleted by later layers:')
+        hidden = [(path, info[1], info[0], ix, 'overwritten') for path, info, ix in self.overwritten]
+        hidden += [(path, info[1], info[0], ix, 'deleted') for path, info, ix in self.deleted]
+        for path, size, orig_ix, ix, how in sorted(hidden, key=lambda h: h[1], reverse=True)[:n]:
+            lines.append(f'  {size / mb:8.1f} MB  /{path} (layer {orig_ix}, {how} in layer {ix})')
+
+        lines.append('bloat:')
+        for category, (size, count) in self.bloat().items():
+            lines.append(f'  {size / mb:8.1f} MB  {category} ({count} files)')
+
+        return '\n'.join(lines)
+
+
+def load_index(client, image):
+    """returns the LayerIndex for `image`, building it if it isn't cached"""
+    cache = IntrospectionCache(cache_dir=getenv('LAYER_INDEX_CACHE_DIR', DEFAULT_CACHE_DIR),
+                               max_size_mb=float(getenv('LAYER_INDEX_CACHE_MAX_MB',
+                                                        DEFAULT_CACHE_MAX_MB)),
+                               namespace='layers')
+    if isinstance(image, str):
+        image = client.images.get(image)
+    return LayerIndex(cache.get_or_create(image.id, lambda: build_index(client, image)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('image')
+    parser.add_argument('-n', '--top', type=int, default=20,
+                        help="number of entries to list in each section")
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help="also write the full index as JSON to this file")
+    parser.add_argument('--budget', action='append', default=list(), metavar='CATEGORY=MB',
+                        help="fail if a bloat category (or 'wasted' or 'total') exceeds MB "
+                             "(may be passed multiple times)")
+    args = parser.parse_args()
+
+    client = docker.client.from_env()
+    index = load_index(client, args.image)
+    print(index.report(args.top))
+    if args.json_path is not None:
+        Path(args.json_path).write_text(json.dumps({'image_id': index.image_id,
+                                                    'layers': index.layers}))
+
+    budgets = {category: float(mb) for category, _, mb in
+               (budget.partition('=') for budget in args.budget)}
+    violations = index.check_budgets(budgets)
+    for violation in violations:
+        print(f'over budget: {violation}')
+
+    sys.exit(1 if violations else 0)
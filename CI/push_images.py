@@ -0,0 +1,274 @@
+"""
+Pushes images to Docker Hub (or another registry) with the Docker SDK.
+Independent images are pushed concurrently, but never before their
+parent image, so layers shared with the parent are uploaded once and
+skipped for its children. Completed pushes are recorded in a state file
+so that an interrupted run resumes where it stopped
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from os import getenv
+from pathlib import Path
+
+import docker
+import requests
+
+from image_tree import ImageTree
+
+
+DEFAULT_STATE_PATH = Path.home().joinpath('.cache', 'cdl-docker-stacks', 'push-state.json')
+# pushes are limited by network bandwidth rather than CPU
+DEFAULT_MAX_WORKERS = 4
+# statuses that let an image's children be pushed
+DONE_STATUSES = ('pushed', 'up-to-date', 'missing')
+
+
+class PushEngine:
+    def __init__(self, client, nodes, org=None, registry=None, state_path=None,
+                 max_workers=None):
+        self.client = client
+        self.nodes = list(nodes)
+        if org is None:
+            org = getenv('DOCKER_HUB_ORG', 'contextlab')
+        if state_path is None:
+            state_path = getenv('PUSH_STATE', DEFAULT_STATE_PATH)
+        if max_workers is None:
+            max_workers = int(getenv('MAX_PUSH_WORKERS', DEFAULT_MAX_WORKERS))
+
+        self.org = org
+        # e.g., "localhost:5000" to push to a local registry:2 instead
+        # of Docker Hub
+        self.registry = registry
+        self.state_path = Path(state_path)
+        self.state = self._load_state()
+        self._state_lock = threading.Lock()
+        self.max_workers = max(1, max_workers)
+        # maps each node to the nearest of its ancestors that's also
+        # being pushed
+        self.dependencies = {node: self._push_parent(node) for node in self.nodes}
+        self.results = dict()
+
+    def _load_state(self):
+        try:
+            return json.loads(self.state_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return dict()
+
+    def _record(self, remote_ref, result):
+        with self._state_lock:
+            self.state[remote_ref] = result
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_path.with_name(f'{self.state_path.name}.tmp')
+            tmp_path.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+            os.replace(tmp_path, self.state_path)
+
+    def _push_parent(self, node):
+        for ancestor in reversed(node.ancestors[:-1]):
+            if ancestor in self.nodes:
+                return ancestor
+
+        return None
+
+    def local_ref(self, node):
+        return f'{self.org}/{node}'
+
+    def remote_ref(self, node):
+        if self.registry is None:
+            return self.local_ref(node)
+        return f'{self.registry}/{self.local_ref(node)}'
+
+    def _push(self, node):
+        local_ref = self.local_ref(node)
+        try:
+            image = self.client.images.get(local_ref)
+        except docker.errors.ImageNotFound:
+            # not built locally, so nothing to push
+            return {'status': 'missing'}
+
+        remote_ref = self.remote_ref(node)
+        if self.state.get(remote_ref, dict()).get('image_id') == image.id:
+            # already pushed this exact image in a previous run
+            return dict(self.state[remote_ref], status='up-to-date')
+
+        repository, tag = remote_ref.rsplit(':', 1)
+        if remote_ref != local_ref:
+            image.tag(repository, tag)
+
+        # compressed size of each layer, from upload progress events
+        layer_sizes = dict()
+        pushed_layers = set()
+        existing_layers = set()
+        start = time.time()
+        for event in self.client.images.push(repository, tag, stream=True, decode=True):
+            if 'error' in event:
+                raise docker.errors.APIError(event['error'])
+
+            layer = event.get('id')
+            status = event.get('status', '')
+            if status == 'Pushing':
+                total = event.get('progressDetail', dict()).get('total')
+                if total:
+                    layer_sizes[layer] = total
+            elif status == 'Pushed':
+                pushed_layers.add(layer)
+            elif status == 'Layer already exists' or status.startswith('Mounted from'):
+                existing_layers.add(layer)
+
+        result = {
+            'status': 'pushed',
+            'image_id': image.id,
+            'pushed_at': time.time(),
+            'seconds': time.time() - start,
+            'bytes': sum(layer_sizes.get(layer, 0) for layer in pushed_layers),
+            'layers_pushed': len(pushed_layers),
+            'layers_existing': len(existing_layers)
+        }
+        self._record(remote_ref, result)
+        return result
+
+    def _skip_downstream(self, node):
+        for n, dep in self.dependencies.items():
+            if dep is node and n not in self.results:
+                self.results[n] = {'status': 'skipped'}
+                print(f"skipping {n}: push of {node} failed")
+                self._skip_downstream(n)
+
+    def run(self):
+        start = time.time()
+        pending = list(self.nodes)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [node for node in pending
+                         if self.dependencies[node] is None or
+                         self.results.get(self.dependencies[node], dict()).get('status')
+                         in DONE_STATUSES]
+                for node in ready:
+                    pending.remove(node)
+                    print(f"pushing {self.remote_ref(node)}...")
+                    running[executor.submit(self._push, node)] = node
+
+                if not running:
+                    # remaining nodes all depend on a failed push
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        self.results[node] = future.result()
+                    except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                        print(f"failed to push {self.remote_ref(node)}: {e}")
+                        self.results[node] = {'status': 'failed'}
+                        self._skip_downstream(node)
+                        pending = [n for n in pending if n not in self.results]
+
+        self.wall_time = time.time() - start
+        return all(result['status'] in DONE_STATUSES for result in self.results.values())
+
+    def summary(self):
+        lines = [f"{'image':<28}{'status':<12}{'MB':>8}{'seconds':>10}{'MB/s':>10}"]
+        for node in self.nodes:
+            result = self.results.get(node, {'status': 'skipped'})
+            if result['status'] == 'pushed':
+                mb = result['bytes'] / 1024 ** 2
+                seconds = result['seconds']
+                throughput = f'{mb / seconds:.1f}' if seconds > 0 else '-'
+                lines.append(f"{str(node):<28}{'pushed':<12}{mb:>8.1f}{seconds:>10.0f}"
+                             f"{throughput:>10}")
+            else:
+                lines.append(f"{str(node):<28}{result['status']:<12}{'-':>8}{'-':>10}{'-':>10}")
+
+        lines.append(f"wall-clock time: {self.wall_time:.0f} seconds "
+                     f"({self.max_workers} workers)")
+        return '\n'.join(lines)
+
+
+@contextmanager
+def local_registry(client, port=5000, timeout=30):
+    """
+    runs a registry:2 container to push to in place of Docker Hub (e.g.,
+    for testing) and yields its address
+    """
+    container = client.containers.run('registry:2',
+                                      detach=True,
+                                      remove=True,
+                                      ports={'5000/tcp': port},
+                                      name=f'cdl-registry-{port}')
+    address = f'localhost:{port}'
+    try:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                requests.get(f'http://{address}/v2/', timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                if time.time() > deadline:
+                    raise TimeoutError(f"registry at {address} did not start "
+                                       f"within {timeout} seconds")
+                time.sleep(0.5)
+        yield address
+    finally:
+        container.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('images',
+                        help="colon-separated list of images to push "
+                             "(e.g., cdl-python:cdl-jupyter), or 'all'")
+    parser.add_argument('-p', '--python-versions',
+                        default=getenv('PYTHON_VERSION', '3.6,3.7,3.8'),
+                        help="comma-separated list of Python versions to push "
+                             "images for (default: $PYTHON_VERSION or 3.6,3.7,3.8)")
+    parser.add_argument('--exclude-shared', action='store_true',
+                        help="don't push images shared across Python versions "
+                             "(e.g., cdl-base:latest)")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="max number of concurrent pushes (default: "
+                             f"$MAX_PUSH_WORKERS or {DEFAULT_MAX_WORKERS})")
+    parser.add_argument('--org', default=None, help="(default: $DOCKER_HUB_ORG or contextlab)")
+    parser.add_argument('--registry', default=None,
+                        help="registry to push to instead of Docker Hub (e.g., localhost:5000)")
+    parser.add_argument('--local-registry', type=int, default=None, metavar='PORT',
+                        help="start a registry:2 container on PORT and push to it")
+    parser.add_argument('--state', default=None,
+                        help=f"file recording completed pushes (default: $PUSH_STATE "
+                             f"or {DEFAULT_STATE_PATH})")
+    parser.add_argument('--repo-root',
+                        default=getenv('GITHUB_WORKSPACE',
+                                       str(Path(__file__).resolve().parents[1])))
+    args = parser.parse_args()
+
+    image_tree = ImageTree.load(args.repo_root)
+    if args.images == 'all':
+        images = image_tree.root_image.children[0].descendants
+    else:
+        images = args.images.split(':')
+
+    nodes = image_tree.build_nodes(args.python_versions.split(','), images)
+    if args.exclude_shared:
+        nodes = [node for node in nodes if node.python_version is not None]
+
+    client = docker.client.from_env()
+    with ExitStack() as stack:
+        registry = args.registry
+        if args.local_registry is not None:
+            registry = stack.enter_context(local_registry(client, args.local_registry))
+
+        engine = PushEngine(client,
+                            nodes,
+                            org=args.org,
+                            registry=registry,
+                            state_path=args.state,
+                            max_workers=args.workers)
+        succeeded = engine.run()
+        print(engine.summary())
+
+    sys.exit(0 if succeeded else 1)
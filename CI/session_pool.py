@@ -0,0 +1,167 @@
+"""
+Pool of long-lived containers that commands can be run in via
+`docker exec`, rather than starting a new container for each one
+"""
+import atexit
+import queue
+import shlex
+
+import docker
+
+
+# kills any processes left behind by previous commands (e.g., ones
+# started in the background) except PID 1, the session's `sleep`
+# process, and the shell running this command
+RESET_CMD = (
+    'kill -9 $(ps -e -o pid=,args= '
+    '| awk -v self=$$ \'$1 != 1 && $1 != self && $0 !~ /sleep infinity$/ {print $1}\') '
+    '2>/dev/null; true'
+)
+# seconds between `timeout` sending TERM & KILL to a command that
+# outlives its max_wait
+TIMEOUT_KILL_AFTER = 5
+# exit code of `timeout` when the command timed out
+TIMEOUT_EXIT_CODE = 124
+
+
+class ExecResult:
+    """
+    stand-in for a docker.models.containers.Container returned from
+    Container.run(detach=True) when the command was run in a session
+    """
+    def __init__(self, session, exit_code, stdout, stderr):
+        self.session = session
+        self.exit_code = exit_code
+        self.stdout = stdout or b''
+        self.stderr = stderr or b''
+        self.id = session.id
+        self.name = session.name
+        self.status = 'exited'
+
+    def __repr__(self):
+        return f'ExecResult(session={self.name}, exit_code={self.exit_code})'
+
+    def logs(self, stdout=True, stderr=True, **kwargs):
+        output = b''
+        if stdout:
+            output += self.stdout
+        if stderr:
+            output += self.stderr
+        return output
+
+    def wait(self, **kwargs):
+        return {'StatusCode': self.exit_code, 'Error': None}
+
+    # the session container outlives the command, so there's nothing to
+    # stop or remove
+    def stop(self, **kwargs):
+        pass
+
+    def remove(self, **kwargs):
+        pass
+
+
+class SessionPool:
+    def __init__(self, client, image_name, size=1, labels=None):
+        self.client = client
+        self.image_name = image_name
+        self.size = size
+        self.labels = labels
+        self.sessions = list()
+        self._available = queue.Queue()
+        # session ID -> filesystem changes right after it started, to
+        # tell whether commands have written to it since
+        self._initial_changes = dict()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _fs_changes(session):
+        return {(change['Path'], change['Kind']) for change in session.diff() or ()}
+
+    def _start_session(self):
+        session = self.client.containers.run(self.image_name,
+                                             command=['sleep', 'infinity'],
+                                             detach=True,
+                                             remove=True,
+                                             tty=False,
+                                             labels=self.labels)
+        self._initial_changes[session.id] = self._fs_changes(session)
+        self.sessions.append(session)
+        self._available.put(session)
+
+    def _stop_session(self, session):
+        self._initial_changes.pop(session.id, None)
+        try:
+            session.stop(timeout=1)
+        except (docker.errors.APIError, docker.errors.NotFound):
+            pass
+
+    def _checkout(self):
+        # sessions are started lazily, up to self.size
+        if self._available.empty() and len(self.sessions) < self.size:
+            self._start_session()
+
+        return self._available.get()
+
+    def exec(self, cmd, workdir=None, environment=None, max_wait=30, merge_output=False):
+        """
+        run `cmd` (a list of arguments) in an idle session container.
+        Returns (exit_code, session, stdout, stderr), raising a
+        TimeoutError if the command doesn't finish within `max_wait`
+        seconds. If `merge_output` is True, stdout & stderr are
+        returned together (in the order they were written) as stdout,
+        like the output of a container run with a TTY
+        """
+        session = self._checkout()
+        try:
+            if max_wait is not None and max_wait >= 0:
+                # sends TERM after max_wait seconds, then KILL if the
+                # command is still running TIMEOUT_KILL_AFTER seconds later
+                cmd = ['timeout', '-k', str(TIMEOUT_KILL_AFTER), str(max_wait)] + list(cmd)
+
+            exit_code, output = session.exec_run(cmd,
+                                                 workdir=workdir,
+                                                 environment=environment,
+                                                 stdout=True,
+                                                 stderr=True,
+                                                 tty=False,
+                                                 demux=not merge_output)
+        finally:
+            self._available.put(session)
+
+        if max_wait is not None and max_wait >= 0 and exit_code == TIMEOUT_EXIT_CODE:
+            # only `timeout` itself exits with 124. Commands killed for
+            # other reasons (e.g., the OOM killer) exit with 128 + 9
+            _cmd = ' '.join(shlex.quote(arg) for arg in cmd[4:])
+            raise TimeoutError(f"Command {_cmd} timed out after {max_wait} seconds")
+
+        if merge_output:
+            stdout, stderr = output, b''
+        else:
+            stdout, stderr = output
+        return exit_code, session, stdout, stderr
+
+    def reset(self):
+        """
+        restore sessions to a clean state between tests. Processes left
+        behind by previous commands are killed, and sessions whose
+        filesystem was changed are replaced (lazily) with new containers
+        """
+        clean = list()
+        for session in self.sessions:
+            session.exec_run(['/bin/bash', '-c', RESET_CMD], tty=False)
+            if self._fs_changes(session) == self._initial_changes.get(session.id):
+                clean.append(session)
+            else:
+                self._stop_session(session)
+
+        self.sessions = clean
+        self._available = queue.Queue()
+        for session in clean:
+            self._available.put(session)
+
+    def close(self):
+        while self.sessions:
+            self._stop_session(self.sessions.pop())
+
+        self._available = queue.Queue()
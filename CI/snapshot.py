@@ -0,0 +1,131 @@
+"""
+Collects everything needed to introspect an image's environment (conda
+config, installed & requested conda packages, apt history & package
+database) from a single container, rather than starting a separate
+container for each command
+"""
+import json
+from os import getenv
+
+import docker
+
+from conda_meta import STAGE_SCRIPT, STAGING_DIR, parse_staged_archive
+
+
+# increment when the structure of snapshots changes, so that cached
+# snapshots from older versions aren't reused
+SNAPSHOT_VERSION = 4
+SECTION_MARKER = '===CDL-SNAPSHOT:'
+
+# each section of the output is preceded by a marker line so they can
+# be split apart on the host
+SECTION_FUNC = f"""
+section() {{ echo; echo "{SECTION_MARKER}$1==="; }}
+"""
+
+# conda commands are run concurrently since most of their runtime is
+# spent starting up conda's Python process
+CONDA_SCRIPT = """
+if command -v conda > /dev/null; then
+    tmpdir=$(mktemp -d)
+    conda config --show --json > $tmpdir/conda_config &
+    conda env export --name base --json --no-builds > $tmpdir/conda_installed &
+    conda env export --name base --json --no-builds --from-history > $tmpdir/conda_requested &
+    wait
+    for f in conda_config conda_installed conda_requested; do
+        section $f
+        cat $tmpdir/$f
+    done
+    rm -rf $tmpdir
+fi
+"""
+
+APT_SCRIPT = """
+section apt_history
+# rotated logs (oldest first), then the current log
+for f in $(ls /var/log/apt/history.log.*.gz 2> /dev/null | sort -t . -k 3 -n -r); do
+    zcat $f
+done
+cat /var/log/apt/history.log 2> /dev/null
+section dpkg_status
+cat /var/lib/dpkg/status 2> /dev/null
+section apt_extended_states
+cat /var/lib/apt/extended_states 2> /dev/null
+true
+"""
+
+JSON_SECTIONS = ('conda_config', 'conda_installed', 'conda_requested')
+# 'meta' reads conda's metadata files directly; 'conda' runs conda commands
+DEFAULT_BACKEND = 'meta'
+
+
+def snapshot_backend():
+    return getenv('CONDA_INTROSPECTION', DEFAULT_BACKEND)
+
+
+def take_snapshot(client, image_name, backend=None):
+    """
+    gathers conda & apt info from a single container created from
+    `image_name` and returns it as a JSON-serializable dict. Conda-
+    related values are None for images without conda
+    """
+    if backend is None:
+        backend = snapshot_backend()
+
+    if backend == 'conda':
+        script = SECTION_FUNC + CONDA_SCRIPT + APT_SCRIPT
+        raw_output = client.containers.run(image_name,
+                                           command=['/bin/bash', '-c', script],
+                                           detach=False,
+                                           remove=True,
+                                           tty=False)
+        return parse_snapshot(raw_output.decode('utf-8'))
+
+    elif backend == 'meta':
+        script = SECTION_FUNC + STAGE_SCRIPT + APT_SCRIPT
+        container = client.containers.run(image_name,
+                                          command=['/bin/bash', '-c', script],
+                                          detach=True,
+                                          tty=False)
+        try:
+            container.wait()
+            raw_output = container.logs(stdout=True, stderr=False)
+            snapshot = parse_snapshot(raw_output.decode('utf-8'))
+            try:
+                stream, _ = container.get_archive(STAGING_DIR)
+            except docker.errors.NotFound:
+                # no conda in image, so nothing was staged
+                pass
+            else:
+                snapshot.update(parse_staged_archive(b''.join(stream)))
+        finally:
+            container.remove(force=True)
+
+        return snapshot
+
+    else:
+        raise ValueError(f"unknown introspection backend: {backend}")
+
+
+def parse_snapshot(raw_output):
+    snapshot = {section: None for section in JSON_SECTIONS}
+    snapshot.update(apt_history='', dpkg_status='', apt_extended_states='',
+                    package_sizes=None, conda_config_partial=False)
+    section = None
+    section_lines = list()
+    for line in raw_output.splitlines() + [f'{SECTION_MARKER}end===']:
+        if line.startswith(SECTION_MARKER):
+            if section is not None:
+                snapshot[section] = '\n'.join(section_lines).strip()
+            section = line.replace(SECTION_MARKER, '').rstrip('=')
+            section_lines = list()
+        elif section is not None:
+            section_lines.append(line)
+
+    for section in JSON_SECTIONS:
+        if snapshot[section]:
+            snapshot[section] = json.loads(snapshot[section])
+        else:
+            snapshot[section] = None
+
+    return snapshot
@@ -7,6 +7,14 @@ CDL_BASE_APT_PACKAGES = [
     'vim',
     'wget'
 ]
+# files left behind by package managers shouldn't end up in any image
+# (max MB per category, see CI/layer_index.py)
+BLOAT_BUDGETS = {
+    'conda_pkgs': 0,
+    'pip_cache': 0,
+    'apt_lists': 0,
+    'apt_archives': 0
+}
 
 
 ########################################
@@ -32,3 +40,8 @@ def test_apt_cache_removed(container):
                            detach=False,
                            remove=True)
     assert len(output) == 0, output
+
+
+def test_bloat_budgets(container):
+    # checks every layer of the image, not just the final filesystem
+    container.layer_index.assert_within(BLOAT_BUDGETS)
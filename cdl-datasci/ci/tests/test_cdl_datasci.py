@@ -1,4 +1,30 @@
-"""
-currently, no additional tests are needed on top of parent image tests
-"""
-# TODO: write tests for this
+import pytest
+
+
+# max seconds for the first import of each package in a new container.
+# Without the caches created at build time (see
+# cdl-python/warm_caches.py), this includes compiling bytecode and, for
+# matplotlib, building the font cache
+FIRST_IMPORT_MAX_SECONDS = {
+    'matplotlib.pyplot': 5,
+    'pandas': 5,
+    'sklearn': 5
+}
+
+
+@pytest.mark.parametrize('module', sorted(FIRST_IMPORT_MAX_SECONDS))
+def test_first_import_time(container, module):
+    cmd = f"""
+    import time
+    start = time.perf_counter()
+    import {module}
+    print(time.perf_counter() - start)
+    """.replace('\n    ', '\n')
+    # passing docker run options other than `environment` always starts
+    # a new container, even when sessions are enabled, so caches written
+    # by earlier runs aren't reused
+    output = container.run(command=cmd, shell='python', detach=False, remove=True,
+                           tty=False, network_disabled=True)
+    elapsed = float(output.splitlines()[-1])
+    assert elapsed < FIRST_IMPORT_MAX_SECONDS[module], \
+        f'first import of {module} took {elapsed:.2f}s'
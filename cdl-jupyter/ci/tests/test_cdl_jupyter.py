@@ -1,16 +1,30 @@
-import time
 from os import getenv
 
-
-CDL_JUPYTER_APT_PACKAGES = ['bc', 'bzip2']
+import pytest
 
 
-def start_notebook_server(container, wait_time=10):
-    """helper function for running notebook server"""
-    notebook_server = container.run(command=None, shell=None, max_wait=-1)
-    time.sleep(wait_time)
-    notebook_server.stop()
-    return notebook_server
+CDL_JUPYTER_APT_PACKAGES = ['bc', 'bzip2']
+# lines the notebook server logs once it's ready to accept connections
+NOTEBOOK_SERVER_READY_LOGS = ['Serving notebooks from local directory', '/?token=']
+
+
+@pytest.fixture(scope='session')
+def notebook_server(container):
+    """notebook server shared by all notebook server tests"""
+    notebook_server = container.run(command=None,
+                                    shell=None,
+                                    max_wait=-1,
+                                    name=container.container_name('notebook_server'))
+    # stop the server at the end of the session, rather than letting
+    # the manage_containers fixture remove it after the current test
+    container.curr_container_obj = None
+    try:
+        container.wait_until_ready(notebook_server,
+                                   log_patterns=NOTEBOOK_SERVER_READY_LOGS,
+                                   port=container.expected_attrs.get('port', '8888'))
+        yield notebook_server
+    finally:
+        notebook_server.remove(force=True)
 
 
 ########################################
@@ -66,11 +80,21 @@ def test_nbextensions_enabled(container):
     assert len(extensions) == 0, f"notebook extensions not configured:\n\t{', '.join(extensions)}"
 
 
+def test_entrypoint_sets_thread_counts(container):
+    # not a login shell, so the thread counts come from the entrypoint
+    # rather than /etc/profile.d
+    output = container.run('printenv OMP_NUM_THREADS MKL_NUM_THREADS OPENBLAS_NUM_THREADS',
+                           detach=False,
+                           remove=True,
+                           tty=False,
+                           nano_cpus=10 ** 9)
+    assert output.splitlines() == ['1', '1', '1']
+
+
 ########################################
 #         NOTEBOOK SERVER TESTS        #
 ########################################
-def test_nbextensions_configurator_enabled(container, conda_env):
-    notebook_server = start_notebook_server(container)
+def test_nbextensions_configurator_enabled(conda_env, notebook_server):
     configurator_version = conda_env.installed_packages.get(
         'jupyter_nbextensions_configurator'
     ).version
@@ -79,8 +103,7 @@ def test_nbextensions_configurator_enabled(container, conda_env):
     assert expected_log_msg in nb_server_logs
 
 
-def test_server_runs_from_workdir(container):
-    notebook_server = start_notebook_server(container)
+def test_server_runs_from_workdir(container, notebook_server):
     expected_workdir = container.expected_attrs.get('workdir')
     # if container.custom_build:
     #     # pop the value if it's a custom-built container in order to
@@ -92,18 +115,16 @@ def test_server_runs_from_workdir(container):
     assert expected_log_msg in nb_server_logs
 
 
-def test_server_provides_login_token(container):
-    notebook_server = start_notebook_server(container)
+def test_server_provides_login_token(notebook_server):
     notebook_server_logs = notebook_server.logs().decode('utf-8').strip()
     assert '/?token=' in notebook_server_logs
 
 
-def test_notebook_server_port(container):
+def test_notebook_server_port(container, notebook_server):
     expected_port = container.expected_attrs.get('port')
     # if container.custom_build:
     #     container.expected_attrs.pop('port')
 
-    notebook_server = start_notebook_server(container)
     notebook_server_logs = notebook_server.logs().decode('utf-8').strip()
     assert f':{expected_port}/' in notebook_server_logs
 
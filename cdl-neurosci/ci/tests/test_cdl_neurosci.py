@@ -1,4 +1,16 @@
-"""
-currently, no additional tests are needed on top of parent image tests
-"""
-# TODO: write tests for this
+import pytest
+
+
+# max MB per category of files that add to the image's size without
+# being needed (see CI/layer_index.py), so its size doesn't creep up
+BLOAT_BUDGETS = {
+    'static_libs': 100,
+    'test_dirs': 150,
+    'pycache': 400,
+    'wasted': 100
+}
+
+
+@pytest.mark.no_inherit_test
+def test_neurosci_bloat_budgets(container):
+    container.layer_index.assert_within(BLOAT_BUDGETS)
@@ -4,6 +4,33 @@ import tarfile
 import pytest
 
 
+# variables set from the container's CPU limits (see cdl-python/cpu_limits.py)
+THREAD_VARS = [
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'NUMBA_NUM_THREADS'
+]
+# (docker run options, CPUs the host needs to have, expected thread count)
+CPU_LIMITS = [
+    ({'nano_cpus': 10 ** 9}, 1, 1),
+    # fractional quotas are rounded down
+    ({'nano_cpus': 15 * 10 ** 8}, 2, 1),
+    ({'nano_cpus': 2 * 10 ** 9}, 2, 2),
+    ({'cpuset_cpus': '0'}, 1, 1),
+    ({'cpuset_cpus': '0,1'}, 2, 2),
+    # the lower of the two limits applies
+    ({'cpuset_cpus': '0,1', 'nano_cpus': 10 ** 9}, 2, 1)
+]
+
+
+@pytest.fixture(scope='session')
+def host_cpus(container):
+    """number of CPUs available to a container without CPU limits"""
+    return int(container.run('nproc', detach=False, remove=True, tty=False))
+
+
 ########################################
 #            CONTAINER TESTS           #
 ########################################
@@ -35,6 +62,32 @@ def test_pip_cache_removed(container):
     assert 'No such file or directory' in log
 
 
+@pytest.mark.parametrize('run_kwargs,min_cpus,expected', CPU_LIMITS)
+def test_thread_counts_match_cpu_limits(container, host_cpus, run_kwargs, min_cpus, expected):
+    if host_cpus < min_cpus:
+        pytest.skip(f'needs {min_cpus} CPUs, host has {host_cpus}')
+
+    # login shell, so /etc/profile.d is sourced
+    output = container.run(f"printenv {' '.join(THREAD_VARS)}",
+                           shell_flags='-lc',
+                           detach=False,
+                           remove=True,
+                           tty=False,
+                           **run_kwargs)
+    assert output.splitlines() == [str(expected)] * len(THREAD_VARS)
+
+
+def test_user_thread_counts_not_overridden(container):
+    output = container.run(f"printenv {' '.join(THREAD_VARS)}",
+                           shell_flags='-lc',
+                           detach=False,
+                           remove=True,
+                           tty=False,
+                           nano_cpus=10 ** 9,
+                           environment={'OMP_NUM_THREADS': '3'})
+    assert output.splitlines() == ['3'] + ['1'] * (len(THREAD_VARS) - 1)
+
+
 @pytest.mark.no_inherit_test
 def test_python_default_cmd(container):
     c = container.run(command=None, shell=None, max_wait=-1)
@@ -196,24 +249,24 @@ def test_strict_channel_priority(conda_env):
     assert priority == 'strict'
 
 
+def test_remote_max_retries(conda_env):
+    remote_max_retries = conda_env.config.get('remote_max_retries')
+    assert remote_max_retries == 5
+
+
 def test_conda_cache_cleaned(container, conda_env):
     pkgs_dirs = conda_env.config.get('pkgs_dirs')
-    for pkg_dir in pkgs_dirs:
-        c = container.run(f'ls -a {pkg_dir}', detach=True, remove=False)
-        log = c.logs().decode('utf-8').strip()
-        assert 'No such file or directory' in log
-        c.remove()
+    # checks all package cache directories at once, in parallel containers
+    results = container.run_many([f'ls -a {pkg_dir}' for pkg_dir in pkgs_dirs])
+    for pkg_dir, result in zip(pkgs_dirs, results):
+        log = result.logs().decode('utf-8').strip()
+        assert 'No such file or directory' in log, f'{pkg_dir} exists:\n{log}'
 
 
-# TODO: figure out how to parametrize this with pytest-cases rather than looping
 def test_pinned_versions_installed(conda_env):
-    for pkg_name, pinned_pkg in conda_env.pinned_packages.items():
-        installed_pkg = conda_env.installed_packages.get(pkg_name)
-        assert installed_pkg is not None, \
-            f'pinned package {pinned_pkg} is not installed'
-        assert installed_pkg.matches_version(pinned_pkg), \
-            f'installed version of {pkg_name} ({installed_pkg}) does not match ' \
-            f'pinned version ({pinned_pkg}'
+    # checks all pinned packages at once & reports every mismatch
+    mismatches = conda_env.check_versions({'pinned': conda_env.pinned_packages.values()})
+    assert len(mismatches) == 0, str(mismatches)
 
 
 # # TODO: figure out how to parametrize this with pytest-cases rather than looping
@@ -227,7 +280,11 @@ def test_pinned_versions_installed(conda_env):
 #             f'requested version ({requested_pkg})'
 
 
-# TODO: add test to import each module to check if installed properly and working
+def test_installed_packages_importable(conda_env):
+    # imports every installed package's top-level modules in one
+    # container, and lists the slowest imports if any fail
+    sweep = conda_env.import_sweep()
+    assert len(sweep.failures) == 0, sweep.report()
 
 
 ########################################
@@ -251,18 +308,9 @@ def test_custom_conda_packages_installed(container, conda_env):
     if isinstance(custom_conda_pkgs, str):
         custom_conda_pkgs = [custom_conda_pkgs]
 
-    for pkg_spec in custom_conda_pkgs:
-        # needs to handle both forms: pkg & pkg=version
-        pkg_name = pkg_spec.split('=')[0]
-        installed_pkg = conda_env.installed_packages.get(pkg_name)
-        assert installed_pkg is not None, \
-            f'conda package {pkg_spec} from build-arg not installed'
-        if '=' in pkg_spec:
-            pkg_version = pkg_spec.split('=')[1]
-            assert installed_pkg.matches_version(pkg_version), \
-                f'conda-installed version of package {pkg_name}, ' \
-                f'{installed_pkg.version} does not match build-arg specified ' \
-                f'version, {pkg_version}'
+    # handles both forms: pkg & pkg=version
+    mismatches = conda_env.check_versions({'CONDA_PACKAGES build-arg': custom_conda_pkgs})
+    assert len(mismatches) == 0, str(mismatches)
 
 
 @pytest.mark.custom_build_test
@@ -278,23 +326,18 @@ def test_custom_pip_packages_installed(container, conda_env):
     if isinstance(custom_pip_pkgs, str):
         custom_pip_pkgs = [custom_pip_pkgs]
     # needs to handle both forms: pkg & pkg==version
+    pip_specs = list()
     for pkg_spec in custom_pip_pkgs:
         if 'git' in pkg_spec:
-            pkg_name = pkg_spec.split('.git')[0].split('/')[-1]
+            # `conda env export` command shows most recent tag for
+            # git-based packages, so can't test that if installed from a
+            # commit hash. Just check that the package is installed
+            pip_specs.append(pkg_spec.split('.git')[0].split('/')[-1])
         else:
-            pkg_name = pkg_spec.split('=')[0]
-
-        installed_pkg = conda_env.installed_packages.get(pkg_name)
-        assert installed_pkg is not None, \
-            f'pip package {pkg_spec} from build-arg not installed'
-        # `conda env export` command shows most recent tag for git-based
-        # packages, so can't test that if installed from a commit hash
-        if '=' in pkg_spec:
-            pkg_version = pkg_spec.split('=')[1]
-            assert installed_pkg.matches_version(pkg_version), \
-                f'pip-installed version of package {pkg_name}, ' \
-                f'{installed_pkg.version} does not match build-arg specified ' \
-                f'version, {pkg_version}'
+            pip_specs.append(pkg_spec)
+
+    mismatches = conda_env.check_versions({'PIP_PACKAGES build-arg': pip_specs})
+    assert len(mismatches) == 0, str(mismatches)
 
 
 # @pytest.mark.custom_build_test
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Sets thread counts for common numerical libraries from the CPUs a
+container can actually use, rather than the host's core count they
+default to. Available CPUs are the fewest allowed by the container's
+cpuset (its CPU affinity) and its CFS quota (docker run --cpus), read
+from cgroup v2 or v1. Variables the user has already set are left alone.
+
+  cpu_limits.py                 print `export VAR=N` lines to `eval`
+  cpu_limits.py --count         print the number of available CPUs
+  cpu_limits.py -- CMD [ARGS]   run CMD with the variables set
+"""
+import argparse
+import math
+import os
+import sys
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# OpenMP also sets PyTorch's intra-op thread count
+THREAD_VARS = (
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'NUMBA_NUM_THREADS'
+)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_v2_dirs():
+    # the process's cgroup & its ancestors (whose limits also apply),
+    # from the unified hierarchy's "0::<path>" line
+    cgroups = _read('/proc/self/cgroup') or ''
+    for line in cgroups.splitlines():
+        if line.startswith('0::'):
+            path = line[3:].strip('/')
+            break
+    else:
+        path = ''
+
+    parts = path.split('/') if path else list()
+    for i in range(len(parts), -1, -1):
+        yield os.path.join(CGROUP_ROOT, *parts[:i])
+
+
+def cpu_quota():
+    """
+    CPUs allowed by the cgroup's CFS quota (e.g., 1.5), or None if it
+    isn't limited
+    """
+    limits = list()
+    if os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        # cgroup v2: "<quota> <period>", or "max <period>" if unlimited
+        for cgroup_dir in _cgroup_v2_dirs():
+            cpu_max = _read(os.path.join(cgroup_dir, 'cpu.max'))
+            if cpu_max is not None:
+                quota, _, period = cpu_max.partition(' ')
+                if quota != 'max':
+                    limits.append(int(quota) / int(period))
+    else:
+        for controller in ('cpu', 'cpu,cpuacct'):
+            quota = _read(os.path.join(CGROUP_ROOT, controller, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(CGROUP_ROOT, controller, 'cpu.cfs_period_us'))
+            if quota is not None and period is not None:
+                # quota is -1 if unlimited
+                if int(quota) > 0:
+                    limits.append(int(quota) / int(period))
+                break
+
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    try:
+        # reflects the container's cpuset (docker run --cpuset-cpus)
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = cpu_quota()
+    if quota is not None:
+        # round down, since more threads than the quota allows get
+        # throttled, but always allow at least 1
+        cpus = min(cpus, max(1, math.floor(quota)))
+
+    return cpus
+
+
+def thread_env(environ=None):
+    """thread count variables to set that aren't already set in `environ`"""
+    if environ is None:
+        environ = os.environ
+
+    n_threads = str(available_cpus())
+    return {var: n_threads for var in THREAD_VARS if not environ.get(var)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', action='store_true',
+                        help="print the number of available CPUs and exit")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="command to run with the variables set")
+    args = parser.parse_args()
+
+    if args.count:
+        print(available_cpus())
+        sys.exit(0)
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if command:
+        env = dict(os.environ, **thread_env())
+        os.execvpe(command[0], command, env)
+    else:
+        for var, value in sorted(thread_env().items()):
+            print('export {}={}'.format(var, value))
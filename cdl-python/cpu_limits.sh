@@ -0,0 +1,7 @@
+# sets thread counts for OpenMP, MKL, OpenBLAS, numexpr & numba (and so
+# PyTorch) from the container's CPU limits, rather than the host's core
+# count, unless they're already set (see /usr/local/bin/cpu_limits.py)
+
+if [ -x /usr/local/bin/cpu_limits.py ]; then
+    eval "$(/usr/local/bin/cpu_limits.py)"
+fi
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Warms caches that would otherwise be rebuilt by every new container the
+first time a package is used. Meant to be run at build time, in its own
+RUN step (so its size shows up as a separate layer in the build metrics):
+  - compiles bytecode for any module in site-packages that doesn't
+    already have it (e.g., files installed without it by pip or conda)
+  - imports each module passed on the command line in a fresh
+    interpreter, which creates caches that packages write on first
+    import (e.g., matplotlib's font cache) and compiles bytecode for
+    anything imported from outside site-packages
+"""
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+import sysconfig
+import time
+
+
+def site_packages_dirs():
+    paths = sysconfig.get_paths()
+    return sorted({paths['purelib'], paths['platlib']})
+
+
+def compile_bytecode(workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    for path in site_packages_dirs():
+        start = time.time()
+        # some packages ship files that aren't valid for every Python
+        # version (e.g., test data, optional backports), so failures to
+        # compile individual files are reported but don't fail the build
+        success = compileall.compile_dir(path, quiet=2, workers=workers)
+        print("compiled bytecode for {} in {:.1f}s{}".format(
+            path, time.time() - start, '' if success else ' (some files failed to compile)'
+        ))
+
+
+def warm_import(module):
+    start = time.time()
+    result = subprocess.run([sys.executable, '-c', 'import {}'.format(module)])
+    if result.returncode != 0:
+        sys.exit("failed to import {} (exit code {})".format(module, result.returncode))
+
+    print("imported {} in {:.1f}s".format(module, time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', metavar='MODULE',
+                        help="modules to import (in separate interpreters)")
+    parser.add_argument('--no-bytecode', action='store_false', dest='bytecode',
+                        help="don't compile bytecode for site-packages")
+    args = parser.parse_args()
+
+    if args.bytecode:
+        compile_bytecode()
+    for module in args.modules:
+        warm_import(module)
@@ -1,3 +1,16 @@
+import pytest
+
+
+# max MB per category of files that add to the image's size without
+# being needed (see CI/layer_index.py), so its size doesn't creep up
+BLOAT_BUDGETS = {
+    'static_libs': 150,
+    'test_dirs': 100,
+    'pycache': 400,
+    'wasted': 100
+}
+
+
 def test_no_cuda_env_set(container):
     env = container.run('printenv', detach=False, remove=True, tty=False)
     assert 'NO_CUDA=1' in env
@@ -15,3 +28,8 @@ def test_pytorch(container):
     output = container.run(command=cmd, shell='python', detach=False, remove=True)
     result = output.splitlines()
     assert result == expected
+
+
+@pytest.mark.no_inherit_test
+def test_pytorch_bloat_budgets(container):
+    container.layer_index.assert_within(BLOAT_BUDGETS)
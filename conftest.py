@@ -31,6 +31,7 @@ def container():
     image = matching_images[0]
     container = Container(image)
     yield container
+    container.close()
 
 
 @pytest.fixture(scope='session')
@@ -43,7 +44,7 @@ def conda_env(container):
 def manage_containers(request, container):
     # set container name based on test function name for tracking
     test_func_name = request.function.__name__
-    container.curr_container_name = f'{test_func_name}_container'
+    container.curr_container_name = container.container_name(test_func_name)
     yield
 
     # remove container created during test function if:
@@ -77,7 +78,7 @@ def pytest_collection_modifyitems(items):
     build_style = getenv("BUILD_STYLE")
     repo_path = Path(getenv("GITHUB_WORKSPACE"))
 
-    image_obj = ImageTree(repo_path).get_image(image_name)
+    image_obj = ImageTree.load(repo_path).get_image(image_name)
     ancestor_imgs = list(map(str, image_obj.ancestors))
 
     skip_child_image_test = pytest.mark.skip(reason="test intended for child image")